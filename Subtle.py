@@ -1 +1,6 @@
 from web import app
+
+if __name__ == '__main__':
+    import sys
+    from subtle.cli import main
+    sys.exit(main())
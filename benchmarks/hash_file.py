@@ -0,0 +1,108 @@
+"""
+Compares the throughput of the OpenSubtitles hash implementation in
+subtle.components against the original 8-bytes-per-read version, using
+synthetic sparse files of different sizes.
+
+Usage: python3 benchmarks/hash_file.py [--files N] [--rounds N]
+"""
+import argparse
+import importlib.util
+import os
+import struct
+import sys
+import tempfile
+import time
+
+# Load subtle/components.py on its own, since importing the subtle package
+# requires a config.json and the web interface's dependencies
+_components_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'subtle', 'components.py')
+_spec = importlib.util.spec_from_file_location('components', _components_path)
+components = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(components)
+
+SIZES = [('128 KiB', 128 * 1024), ('700 MiB', 700 * 1024 ** 2),
+         ('4 GiB', 4 * 1024 ** 3), ('40 GiB', 40 * 1024 ** 3)]
+
+
+def legacy_hash_file(file, file_size):
+    # The original implementation, kept here as the reference to compare with
+    try:
+
+        long_long_format = '<q'  # little-endian long long
+        byte_size = struct.calcsize(long_long_format)
+        file_hash = file_size
+
+        if file_size < 65536 * 2:
+            return "SizeError"
+
+        for x in range(65536 // byte_size):
+            buffer = file.read(byte_size)
+            (l_value,) = struct.unpack(long_long_format, buffer)
+            file_hash += l_value
+            file_hash = file_hash & 0xFFFFFFFFFFFFFFFF
+
+        file.seek(max(0, file_size - 65536), 0)
+        for x in range(65536 // byte_size):
+            buffer = file.read(byte_size)
+            (l_value,) = struct.unpack(long_long_format, buffer)
+            file_hash += l_value
+            file_hash = file_hash & 0xFFFFFFFFFFFFFFFF
+
+        file.close()
+        returned_hash = "%016x" % file_hash
+        return returned_hash
+
+    except IOError:
+        return "IOError"
+
+
+def make_sparse_file(directory, name, size):
+    # Only the hashed head and tail blocks are written, the rest stays a hole
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(65536))
+        f.truncate(size)
+        f.seek(size - 65536)
+        f.write(os.urandom(65536))
+    return path
+
+
+def run(hash_function, paths, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for path in paths:
+            hash_function(open(path, 'rb'), os.path.getsize(path))
+    return len(paths) * rounds / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--files', type=int, default=20,
+                        help='number of files per size (default: 20)')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='number of passes over the files (default: 5)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print('{0:>10} {1:>14} {2:>14} {3:>8}'.format(
+            'size', 'legacy files/s', 'new files/s', 'speedup'))
+        for label, size in SIZES:
+            paths = [make_sparse_file(directory, '{0}-{1}.mkv'
+                                      .format(size, i), size)
+                     for i in range(args.files)]
+            for path in paths:
+                size = os.path.getsize(path)
+                if legacy_hash_file(open(path, 'rb'), size) != \
+                        components.hash_file(open(path, 'rb'), size):
+                    sys.exit("Hash mismatch for '{0}'".format(path))
+            legacy = run(legacy_hash_file, paths, args.rounds)
+            new = run(components.hash_file, paths, args.rounds)
+            print('{0:>10} {1:>14.1f} {2:>14.1f} {3:>7.1f}x'.format(
+                label, legacy, new, new / legacy))
+            for path in paths:
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+"""
+Measures the latency of the web interface end to end, against the local
+stub server instead of OpenSubtitles. Every client browses to the library,
+selects a video, loads its results and downloads a subtitle, and the
+p50/p95/p99 latency and throughput of each route are reported, along with
+those of hash_file.
+
+Usage: python3 benchmarks/latency.py [--clients N] [--rounds N] ...
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from benchmarks.stub_server import StubServer  # noqa: E402
+from benchmarks.hash_file import make_sparse_file  # noqa: E402
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Recorder(object):
+    """Collects the latency of every request, by route"""
+
+    def __init__(self):
+        self.samples = dict()
+        self.failures = dict()
+        self._lock = threading.Lock()
+
+    def record(self, route, seconds, ok=True):
+        with self._lock:
+            self.samples.setdefault(route, []).append(seconds)
+            if not ok:
+                self.failures[route] = self.failures.get(route, 0) + 1
+
+    def timed(self, route, request, expected=(200, 302)):
+        start = time.perf_counter()
+        response = request()
+        self.record(route, time.perf_counter() - start,
+                    response.status_code in expected)
+        return response
+
+    def report(self, elapsed):
+        print('{0:<12} {1:>7} {2:>6} {3:>9} {4:>9} {5:>9} {6:>9}'.format(
+            'route', 'count', 'failed', 'p50 ms', 'p95 ms', 'p99 ms',
+            'req/s'))
+        for route, samples in self.samples.items():
+            print('{0:<12} {1:>7} {2:>6} {3:>9.1f} {4:>9.1f} {5:>9.1f} '
+                  '{6:>9.1f}'.format(
+                      route, len(samples), self.failures.get(route, 0),
+                      percentile(samples, 0.50) * 1000,
+                      percentile(samples, 0.95) * 1000,
+                      percentile(samples, 0.99) * 1000,
+                      len(samples) / elapsed))
+
+
+def make_library(directory, videos, size):
+    library = os.path.join(directory, 'library')
+    os.makedirs(library)
+    for index in range(videos):
+        make_sparse_file(library, 'Movie {0:04}.mkv'.format(index), size)
+    return library
+
+
+def write_config(directory, library, stub_url):
+    # Subtle reads config.json from the working directory on import
+    settings = {
+        "os_username": "benchmark", "os_password": "", "hash": "0" * 32,
+        "root": library, "debug": "no", "server_url": stub_url,
+        "hash_cache": "", "result_cache": "",
+        "state_store": os.path.join(directory, 'state.db'),
+        "token_store": os.path.join(directory, 'tokens.db'),
+        "prefetch": "no"}
+    with open(os.path.join(directory, 'config.json'), 'w') as config:
+        json.dump(settings, config, indent=4)
+
+
+def find_link(body, prefix):
+    # The index in the first link to the given route on a page
+    start = body.find(prefix)
+    if start == -1:
+        return None
+    start += len(prefix)
+    end = start
+    while end < len(body) and body[end].isdigit():
+        end += 1
+    return int(body[start:end]) if end > start else None
+
+
+def client_session(app, recorder, rounds, first_video):
+    client = app.test_client()
+    for round_number in range(rounds):
+        recorder.timed('browse', lambda: client.get('/subtle/browse'))
+        recorder.timed('select', lambda: client.get(
+            '/subtle/select?file={0}'.format(first_video + round_number)))
+        response = recorder.timed('results',
+                                  lambda: client.get('/subtle/results'))
+        body = response.get_data(as_text=True)
+        download_id = find_link(body, '/subtle/download/eng/')
+        if download_id is not None:
+            recorder.timed('download', lambda: client.post(
+                '/subtle/download/eng/{0}'.format(download_id)))
+
+
+def benchmark_routes(args, directory, stub):
+    library = make_library(directory, args.clients * args.rounds,
+                           args.video_size)
+    write_config(directory, library, stub.url)
+    os.chdir(directory)
+    from web import app
+    app.config['TESTING'] = True
+
+    recorder = Recorder()
+    threads = [threading.Thread(target=client_session,
+                                args=(app, recorder, args.rounds,
+                                      index * args.rounds))
+               for index in range(args.clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    print('Web interface, {0} clients x {1} rounds ({2:.1f}s)'.format(
+        args.clients, args.rounds, elapsed))
+    recorder.report(elapsed)
+    print('Stub server calls: {0} ({1} failed)'.format(
+        ', '.join('{0}={1}'.format(method, count)
+                  for method, count in sorted(stub.calls.items())),
+        stub.errors))
+
+
+def benchmark_hash_file(args, directory):
+    from subtle.components import hash_file
+    paths = [make_sparse_file(directory, 'hash-{0}.mkv'.format(index),
+                              args.video_size)
+             for index in range(args.hash_files)]
+    recorder = Recorder()
+    start = time.perf_counter()
+    for path in paths:
+        started = time.perf_counter()
+        with open(path, 'rb') as video_file:
+            file_hash = hash_file(video_file, os.path.getsize(path))
+        recorder.record('hash_file', time.perf_counter() - started,
+                        len(file_hash) == 16)
+    elapsed = time.perf_counter() - start
+    print('\nhash_file, {0} files of {1} bytes'.format(
+        args.hash_files, args.video_size))
+    recorder.report(elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--clients', type=int, default=4,
+                        help='number of users at the same time (default: 4)')
+    parser.add_argument('--rounds', type=int, default=10,
+                        help='videos looked up per user (default: 10)')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='latency of the stub server (default: 0.05)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of stub calls that fail')
+    parser.add_argument('--results', type=int, default=100,
+                        help='results per search (default: 100)')
+    parser.add_argument('--video-size', type=int, default=700 * 1024 ** 2,
+                        help='size of the (sparse) videos in bytes')
+    parser.add_argument('--hash-files', type=int, default=200,
+                        help='number of files to hash (default: 200)')
+    args = parser.parse_args()
+
+    stub = StubServer(latency=args.latency, error_rate=args.error_rate,
+                      results=args.results).start()
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        try:
+            benchmark_routes(args, directory, stub)
+            benchmark_hash_file(args, directory)
+        finally:
+            os.chdir(cwd)
+    stub.stop()
+    # The web interface leaves its timer threads running
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
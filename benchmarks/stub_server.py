@@ -0,0 +1,194 @@
+"""
+A local stand-in for the OpenSubtitles XML-RPC API, for measuring Subtle
+without touching api.opensubtitles.org. Every method answers after a
+configurable latency, fails with HTTP 503 at a configurable rate, and
+returns as many results as asked for (up to the 500-result limit).
+
+Usage: python3 benchmarks/stub_server.py [--port N] [--latency S] ...
+Then set "server_url" in config.json to the URL it prints.
+"""
+import argparse
+import base64
+import gzip
+import random
+import threading
+import time
+from socketserver import ThreadingMixIn
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+LANGUAGES = [('eng', 'en', 'English'), ('dut', 'nl', 'Dutch'),
+             ('fre', 'fr', 'French'), ('ger', 'de', 'German')]
+MATCHES = ('moviehash', 'imdbid', 'tag', 'fulltext')
+
+
+class _RequestHandler(SimpleXMLRPCRequestHandler):
+    # Keep connections alive, and answer on any path, like the real server
+    protocol_version = 'HTTP/1.1'
+    rpc_paths = ()
+
+    def do_POST(self):
+        stub = self.server.stub
+        if stub.error_rate and random.random() < stub.error_rate:
+            length = int(self.headers.get('content-length', 0))
+            self.rfile.read(length)
+            with stub.lock:
+                stub.errors += 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        super().do_POST()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class StubServer(object):
+    """
+    Serves ServerInfo, LogIn, LogOut, NoOperation, CheckMovieHash,
+    SearchSubtitles and DownloadSubtitles on a background thread
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0,
+                 error_rate=0.0, results=50, subtitle_size=40000,
+                 languages=('eng',)):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.results = results
+        self.languages = list(languages)
+        self.calls = dict()
+        self.errors = 0
+        self.lock = threading.Lock()
+        self._payload = base64.b64encode(gzip.compress(
+            b'1\n00:00:01,000 --> 00:00:02,000\nSubtitle\n\n' *
+            max(1, subtitle_size // 44))).decode('ascii')
+        self._server = _Server((host, port), _RequestHandler,
+                               allow_none=True, logRequests=False)
+        self._server.stub = self
+        for method in (self.ServerInfo, self.LogIn, self.LogOut,
+                       self.NoOperation, self.CheckMovieHash,
+                       self.SearchSubtitles, self.DownloadSubtitles):
+            self._server.register_function(self._timed(method),
+                                           method.__name__)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{0}:{1}/xml-rpc'.format(host, port)
+
+    def _timed(self, method):
+        def call(*args):
+            with self.lock:
+                self.calls[method.__name__] = \
+                    self.calls.get(method.__name__, 0) + 1
+            delay = self.latency + random.uniform(0, self.jitter)
+            if delay > 0:
+                time.sleep(delay)
+            return method(*args)
+        return call
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='StubServer', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+        self._server.server_close()
+
+    @staticmethod
+    def ServerInfo():
+        return {'status': '200 OK', 'application': 'Subtle stub server',
+                'xmlrpc_version': '1.0'}
+
+    def LogIn(self, user_name, password, language, user_agent):
+        return {'status': '200 OK', 'token': 'stub{0:08x}'.format(
+                    random.getrandbits(32)),
+                'data': {'UserPreferedLanguages': ','.join(self.languages)}}
+
+    @staticmethod
+    def LogOut(token):
+        return {'status': '200 OK'}
+
+    @staticmethod
+    def NoOperation(token):
+        return {'status': '200 OK'}
+
+    @staticmethod
+    def CheckMovieHash(token, hashes):
+        return {'status': '200 OK', 'data': {
+            file_hash: {'MovieImdbID': str(int(file_hash[:6], 16)),
+                        'MovieName': 'Movie {0}'.format(file_hash[:6]),
+                        'MovieYear': '2000'}
+            for file_hash in hashes}}
+
+    def SearchSubtitles(self, token, queries, options=None):
+        limit = min(500, (options or {}).get('limit', 500))
+        data = []
+        for query in queries:
+            matched_by = next((match for match in MATCHES
+                               if match in query), 'fulltext')
+            count = min(self.results, limit)
+            for index in range(count):
+                code, iso639, name = LANGUAGES[index % len(LANGUAGES)]
+                if code not in self.languages:
+                    code, iso639, name = LANGUAGES[0]
+                data.append({
+                    'SubLanguageID': code, 'ISO639': iso639,
+                    'LanguageName': name, 'MatchedBy': matched_by,
+                    'IDSubtitleFile': str(1000000 + index),
+                    'SubFileName': 'Movie.{0}.{1}.srt'.format(index, code),
+                    'SubRating': '{0:.1f}'.format(index % 10),
+                    'SubHD': str(index % 2), 'SubHearingImpaired':
+                        str(int(index % 7 == 0)),
+                    'SubDownloadsCnt': str(index * 37 % 5000),
+                    'MovieFPS': '23.976'})
+        return {'status': '200 OK', 'data': data}
+
+    def DownloadSubtitles(self, token, ids):
+        return {'status': '200 OK', 'data': [
+            {'idsubtitlefile': str(download_id), 'data': self._payload}
+            for download_id in ids]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8980)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds before every answer (default: 0.05)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='random extra latency, up to this many seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of calls that fail with HTTP 503')
+    parser.add_argument('--results', type=int, default=50,
+                        help='results per search (default: 50, max: 500)')
+    parser.add_argument('--subtitle-size', type=int, default=40000,
+                        help='bytes per downloaded subtitle')
+    parser.add_argument('--languages', default='eng',
+                        help='preferred languages of the user (default: eng)')
+    args = parser.parse_args()
+
+    stub = StubServer(args.host, args.port, args.latency, args.jitter,
+                      args.error_rate, args.results, args.subtitle_size,
+                      args.languages.split(','))
+    print('Serving on {0}'.format(stub.url))
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,37 @@
-from subtle.osapi import OSHandler
+from subtle.osapi import OSClient, OSHandler
+from subtle.cache import HashCache, RateLimitStore, ResultCache, \
+    TokenStore
+from subtle.components import TimedEvent
+from subtle.library import LibraryIndex
+from subtle.metrics import MetricsStore, metrics
+from subtle.prefetch import Prefetcher
+from subtle.profiling import RequestProfiler
+from subtle.store import SubtitleStore
+from subtle import profiling
+from subtle.types import Video
 from pathlib import Path
 from collections import OrderedDict
-from web import log, wz_log, logger, navigator, root_location
+from web import log, wz_log, logger, root_location
 import sys
 import json
 import hashlib
 
-try:
-    os_handler = OSHandler()
-except Exception:
-    log.error("ERROR: Could not connect to OpenSubtitles.")
-    sys.exit(1)
 config_exists = Path("config.json").is_file()
 settings = None
+os_handler = None
+result_cache = None
+library = None
+prefetcher = None
+profiler = None
 
 if config_exists:
     try:
         with open('config.json', 'r') as json_settings:
             settings = json.load(json_settings, object_pairs_hook=OrderedDict)
 
+        # Nothing is sent to OpenSubtitles until it's needed
+        os_handler = OSHandler(settings.get("server_url") or None)
+
         # Get OS credentials
         if not settings["os_username"] and \
            (not settings["os_password"] or not settings["hash"]):
@@ -46,6 +59,74 @@ if config_exists:
         if Path(settings["root"]).is_dir():
             root_location = settings["root"]
 
+        # Set the number of connections to OpenSubtitles and their timeout
+        os_handler.xml_rpc.size = int(settings.get("pool_size", 4))
+        os_handler.xml_rpc.timeout = float(settings.get("timeout", 30))
+
+        # Share the session with every worker, and keep it across restarts
+        if settings.get("token_store", "tokens.db"):
+            OSHandler.token_store = TokenStore(
+                settings.get("token_store", "tokens.db"))
+
+        # Limit the number of calls to OpenSubtitles per 10 seconds, shared
+        # by every worker and command unless the store is disabled
+        os_handler.scheduler.rate = int(settings.get("rate_limit", 40))
+        if settings.get("rate_limit_store", "ratelimit.db"):
+            os_handler.scheduler.store = RateLimitStore(
+                settings.get("rate_limit_store", "ratelimit.db"))
+
+        # Set the way subtitles are searched for
+        if settings.get("search_mode", "sequential") in \
+                ('sequential', 'combined', 'concurrent'):
+            os_handler.search_mode = settings.get("search_mode", "sequential")
+
+        # Keep hashes in a cache on disk, unless it has been disabled
+        if settings.get("hash_cache", "hashes.db"):
+            Video.hash_cache = HashCache(
+                settings.get("hash_cache", "hashes.db"),
+                int(settings.get("hash_cache_size", 100000)))
+
+        # Keep search results in memory, and on disk if a file is set
+        result_cache = ResultCache(
+            settings.get("result_cache") or None,
+            int(settings.get("result_cache_size", 1000)),
+            int(settings.get("result_cache_ttl", 21600)))
+        TimedEvent(3600, result_cache.prune)
+
+        # Keep downloaded subtitles, so they're only downloaded once
+        if settings.get("subtitle_store", "subtitles"):
+            OSClient.subtitle_store = SubtitleStore(
+                settings.get("subtitle_store", "subtitles"),
+                int(settings.get("subtitle_store_size", 104857600)))
+
+        # Keep track of the videos that are missing subtitles
+        if settings.get("library_index", "library.db"):
+            library = LibraryIndex(settings.get("library_index", "library.db"))
+            TimedEvent(int(settings.get("library_interval", 600)),
+                       library.update_in_background, root_location)
+
+        # Look up the videos in the folder being browsed in the background
+        if settings.get("prefetch", "no").lower() == 'yes':
+            prefetcher = Prefetcher(
+                os_handler, result_cache,
+                int(settings.get("prefetch_budget", 100)),
+                store=os_handler.scheduler.store)
+
+        # Add up the metrics of every worker in a shared file
+        if settings.get("metrics_store", "metrics.db"):
+            metrics.store = MetricsStore(
+                settings.get("metrics_store", "metrics.db"))
+            TimedEvent(15, metrics.flush)
+
+        # Profile every request, or only those with the profile key in them
+        if settings.get("profile", "no").lower() == 'yes' or \
+                settings.get("profile_key", ""):
+            profiling.enabled = True
+            profiler = RequestProfiler(
+                settings.get("profile_dir", "profiles"),
+                int(settings.get("profile_max_files", 100)),
+                int(settings.get("profile_max_size", 104857600)))
+
     except Exception as e:
         log.error(e.args[0])
         sys.exit(1)
@@ -0,0 +1,304 @@
+import asyncio
+import ssl
+from collections import OrderedDict
+from urllib.parse import urlsplit
+from xmlrpc.client import ProtocolError, dumps, loads
+from subtle.osapi import OSClient
+from subtle.scheduler import AsyncRequestScheduler
+from web import log
+
+
+class _Connection(object):
+    """A keep-alive HTTP connection to the XML RPC server"""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reused = False
+
+    async def request(self, host, path, user_agent, body):
+        self.writer.write(
+            "POST {path} HTTP/1.1\r\n"
+            "Host: {host}\r\n"
+            "User-Agent: {agent}\r\n"
+            "Content-Type: text/xml\r\n"
+            "Content-Length: {length}\r\n"
+            "\r\n".format(path=path, host=host, agent=user_agent,
+                          length=len(body)).encode('latin-1') + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by server")
+        version, status, reason = \
+            (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) +
+             [''])[:3]
+        headers = dict()
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await self.reader.readline()
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readline()
+            response = b''.join(chunks)
+        elif 'content-length' in headers:
+            response = await self.reader.readexactly(
+                int(headers['content-length']))
+        else:
+            response = await self.reader.read()
+            headers['connection'] = 'close'
+
+        keep_alive = version == 'HTTP/1.1' and \
+            headers.get('connection', '').lower() != 'close'
+        if status != '200':
+            self.close()
+            raise ProtocolError(host + path, int(status), reason, headers)
+        return response, keep_alive
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncOSHandler(OSClient):
+    """"Provides the connection to and communication with the
+    OpenSubtitles server using XML RPC on asyncio streams, so a single
+    thread can run many requests at the same time"""
+
+    keep_alive_interval = 900
+
+    def __init__(self, server_url=None, concurrency=100, pool_size=8,
+                 timeout=30):
+        if server_url is not None:
+            self.server_url = server_url
+        url = urlsplit(self.server_url)
+        self._host = url.hostname
+        self._port = url.port or (443 if url.scheme == 'https' else 80)
+        self._host_header = url.netloc
+        self._path = url.path or '/'
+        self._ssl = ssl.create_default_context() \
+            if url.scheme == 'https' else None
+        self.concurrency = concurrency
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.language = []
+        self.user_name = None
+        self.hash = None
+        self.user_token = None
+        self.logged_in = False
+        self.keep_alive = False
+        self.server_info = None
+        self._semaphore = None
+        self._idle = []
+        self._keep_alive_task = None
+        self.scheduler = AsyncRequestScheduler(self._send)
+
+    async def _connect(self):
+        if self._idle:
+            connection = self._idle.pop()
+            connection.reused = True
+            return connection
+        reader, writer = await asyncio.open_connection(
+            self._host, self._port, ssl=self._ssl)
+        return _Connection(reader, writer)
+
+    async def _request(self, body):
+        connection = await self._connect()
+        try:
+            response, keep_alive = await connection.request(
+                self._host_header, self._path, self.user_agent, body)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            connection.close()
+            if not connection.reused:
+                raise
+            # The server closed the idle connection, try a new one
+            return await self._request(body)
+        except BaseException:
+            connection.close()
+            raise
+        if keep_alive and len(self._idle) < self.pool_size:
+            self._idle.append(connection)
+        else:
+            connection.close()
+        return response
+
+    async def _send(self, method, *params):
+        # The semaphore has to be created inside the event loop it's used in
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        body = dumps(params, method, allow_none=True).encode('utf-8')
+        async with self._semaphore:
+            response = await asyncio.wait_for(self._request(body),
+                                              self.timeout)
+        return loads(response)[0][0]
+
+    async def call(self, method, *params):
+        # Every call goes through the scheduler, just like with OSHandler
+        return await self.scheduler.call(method, *params)
+
+    async def get_server_info(self):
+        self.server_info = await self.call('ServerInfo')
+        return self.server_info
+
+    async def login(self):
+        if not self.logged_in:
+            log.info("Logging in...")
+            result = await self.call('LogIn', self.user_name, self.hash,
+                                     self.language, self.user_agent)
+            self._read_login(result)
+            self.logged_in = True
+            self.keep_alive = True
+            self._keep_alive_task = asyncio.ensure_future(
+                self._keep_alive_loop())
+        else:
+            self.keep_alive = True
+            log.info("Already logged in")
+
+    async def logout(self):
+        log.info("Logging out...")
+        if self._keep_alive_task is not None:
+            self._keep_alive_task.cancel()
+            self._keep_alive_task = None
+        if self.logged_in:
+            try:
+                await self.call('LogOut', self.user_token)
+                log.info("Successfully logged out. Thanks for using Subtle!")
+            except (OSError, ProtocolError, asyncio.TimeoutError):
+                log.warning("Could not connect to OpenSubtitles; "
+                            "you've been logged out.")
+        self.logged_in = False
+        self.keep_alive = False
+        self.user_token = None
+
+    async def _keep_alive_loop(self):
+        # Keeps the session alive as long as it's being used, and logs out
+        # after a whole interval without any calls
+        while self.logged_in:
+            await asyncio.sleep(self.keep_alive_interval)
+            if not self.keep_alive:
+                self._keep_alive_task = None
+                await self.logout()
+                return
+            self.keep_alive = False
+            try:
+                result = await self.call('NoOperation', self.user_token)
+                if result['status'].split()[0] != '200':
+                    self.logged_in = False
+                    log.warning("Your session timed out, please "
+                                "login before doing anything else")
+                else:
+                    log.info("Staying alive...")
+            except (OSError, ProtocolError, asyncio.TimeoutError):
+                self.logged_in = False
+                log.warning("Could not connect to OpenSubtitles; "
+                            "you've been logged out.")
+
+    async def get_video_info(self, video):
+        if video is not None:
+            await self.get_video_info_many([video])
+
+    async def get_video_info_many(self, videos):
+        # Looks up all batches of videos at the same time
+        videos = [v for v in videos if v is not None]
+        if not self.logged_in or len(videos) == 0:
+            return
+        self.keep_alive = True
+
+        async def check(batch):
+            result = await self.call(
+                'CheckMovieHash', self.user_token,
+                sorted(set(video.file_hash for video in batch)))
+            found = self._extract_data(result, 'data') or {}
+            for video in batch:
+                self._set_video_info(video, found.get(video.file_hash))
+
+        await asyncio.gather(*[
+            check(videos[i:i + self.check_hash_batch_size])
+            for i in range(0, len(videos), self.check_hash_batch_size)])
+
+    async def _search(self, params, limit):
+        result = await self.call('SearchSubtitles', self.user_token,
+                                 params, {'limit': limit})
+        return self._extract_data(result, 'data') or []
+
+    async def search_subtitles(self, video, limit=500):
+        if not self.logged_in or video is None or limit > 500:
+            return None
+        self.keep_alive = True
+        log.info("Looking for subtitles for '{0}'...".format(video.file_name))
+        request_params = self._search_params(video)
+
+        if self.search_mode == 'sequential':
+            data = []
+            for params in request_params:
+                data = await self._search([params], limit)
+                if data:
+                    break
+        else:
+            # Leave out the IMDb query if there's no IMDb ID to use
+            request_params = [params for params in request_params
+                              if params.get('imdbid', True)]
+            if self.search_mode == 'concurrent':
+                data = [sub for found in await asyncio.gather(*[
+                            self._search([params], limit)
+                            for params in request_params])
+                        for sub in found]
+            else:
+                data = await self._search(request_params, limit)
+            data = self._rank_matches(data)
+
+        if len(data) > 0:
+            return self._parse_results(video, data)
+        log.info('Sorry - could not find any matching subtitles')
+        return dict()
+
+    async def download_subtitle(self, video, sub_result):
+        if sub_result is not None:
+            saved = await self.download_subtitles([(video, sub_result)])
+            return saved.get((video.full_path, sub_result.download_id))
+
+    async def download_subtitles(self, downloads):
+        # Downloads all batches at the same time, and writes the subtitles
+        # to disk in the default executor. Subtitles in the subtitle store
+        # are saved from there instead
+        loop = asyncio.get_running_loop()
+        downloads, repeats = self._split_repeats(downloads)
+        saved, downloads = await loop.run_in_executor(
+            None, self._from_store, downloads)
+
+        async def download(batch):
+            result = await self.call('DownloadSubtitles', self.user_token,
+                                     list(batch))
+            return await loop.run_in_executor(
+                None, self._save_subtitles, batch,
+                self._extract_data(result, 'data'))
+
+        if self.logged_in and len(downloads) > 0:
+            self.keep_alive = True
+            for found in await asyncio.gather(*[
+                    download(OrderedDict(
+                        (sub_result.download_id, (video, sub_result))
+                        for video, sub_result in
+                        downloads[i:i + self.download_batch_size]))
+                    for i in range(0, len(downloads),
+                                   self.download_batch_size)]):
+                saved.update(found)
+        if repeats:
+            saved.update(await loop.run_in_executor(
+                None, self._save_repeats, repeats, saved))
+        return saved
+
+    async def close(self):
+        await self.logout()
+        for connection in self._idle:
+            connection.close()
+        self._idle = []
@@ -0,0 +1,362 @@
+import os
+import pickle
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import RLock
+from web import log
+
+
+class SQLiteStore(object):
+    """
+    Base class for the small SQLite databases Subtle keeps next to config.json
+    """
+
+    schema = ''
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = RLock()
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        # Connect lazily, and reconnect in forked workers rather than sharing
+        # the parent's connection
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None,
+                check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.executescript(self.schema)
+            self._pid = os.getpid()
+        return self._connection
+
+    def execute(self, sql, params=()):
+        with self._lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+
+class HashCache(SQLiteStore):
+    """
+    Persistent cache of OpenSubtitles hashes, keyed by the device, inode,
+    size and modification time of the video file
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS hashes (
+            device INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            hash TEXT NOT NULL,
+            last_used REAL NOT NULL,
+            PRIMARY KEY (device, inode, size, mtime_ns));
+        CREATE INDEX IF NOT EXISTS hashes_last_used ON hashes (last_used);
+    '''
+
+    # Most of the least recently used entries checked for files that were
+    # deleted or changed, before the least recently used ones are dropped
+    stale_check_limit = 1000
+
+    def __init__(self, path, max_entries=100000):
+        super().__init__(path)
+        self.max_entries = max_entries
+        self._inserts = 0
+
+    @staticmethod
+    def _key(stat):
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def get(self, path, stat):
+        # Returns the cached hash for the file, or None on a cache miss
+        key = self._key(stat)
+        with self._lock:
+            row = self.execute('SELECT hash FROM hashes WHERE device = ? AND '
+                               'inode = ? AND size = ? AND mtime_ns = ?', key)
+            if not row:
+                return None
+            self.execute('UPDATE hashes SET last_used = ?, path = ? WHERE '
+                         'device = ? AND inode = ? AND size = ? AND '
+                         'mtime_ns = ?', (time.time(), path) + key)
+            return row[0][0]
+
+    def put(self, path, stat, file_hash):
+        with self._lock:
+            self.execute('INSERT OR REPLACE INTO hashes VALUES '
+                         '(?, ?, ?, ?, ?, ?, ?)',
+                         self._key(stat) + (path, file_hash, time.time()))
+            self._inserts += 1
+            inserts = self._inserts
+        # Only count the rows every so often to keep inserts cheap
+        if inserts % 1000 == 0 or inserts == 1:
+            self.prune()
+
+    def prune(self):
+        # Drop entries for files that have been deleted or changed first,
+        # checking only the least recently used ones, then the least
+        # recently used ones until the cache fits again
+        with self._lock:
+            count = self.execute('SELECT COUNT(*) FROM hashes')[0][0]
+            if count <= self.max_entries:
+                return 0
+            target = int(self.max_entries * 0.9)
+            oldest = self.execute(
+                'SELECT device, inode, size, mtime_ns, path FROM hashes '
+                'ORDER BY last_used LIMIT ?', (self.stale_check_limit,))
+        # Files can be slow to stat, e.g. on a NAS, so don't hold the lock
+        stale = []
+        for row in oldest:
+            try:
+                if self._key(os.stat(row[4])) != tuple(row[:4]):
+                    stale.append(row[:4])
+            except OSError:
+                stale.append(row[:4])
+        with self._lock:
+            connection = self.connection
+            connection.execute('BEGIN')
+            try:
+                removed = sum(connection.execute(
+                    'DELETE FROM hashes WHERE device = ? AND inode = ? AND '
+                    'size = ? AND mtime_ns = ?', key).rowcount
+                    for key in stale)
+                count = connection.execute(
+                    'SELECT COUNT(*) FROM hashes').fetchone()[0]
+                if count > target:
+                    removed += connection.execute(
+                        'DELETE FROM hashes WHERE rowid IN (SELECT rowid '
+                        'FROM hashes ORDER BY last_used LIMIT ?)',
+                        (count - target,)).rowcount
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        log.info("Removed {0} entries from the hash cache".format(removed))
+        return removed
+
+
+class CachedResult(object):
+    """Subtitle search results for a video, and the video's info"""
+
+    def __init__(self, video, results, expires, misses=0):
+        self.title = video.title
+        self.imdb_id = video.imdb_id
+        self.year = video.year
+        self.results = results
+        self.expires = expires
+        self.misses = misses
+
+    def apply(self, video):
+        video.title = self.title
+        video.imdb_id = self.imdb_id
+        video.year = self.year
+
+
+class ResultCache(SQLiteStore):
+    """
+    LRU cache of subtitle search results with a time to live, keyed by the
+    hash and size of the video and the languages searched for. Searches
+    without results are cached too, for a period that doubles with every
+    search that still doesn't find anything. If a path is given, results
+    are kept on disk as well, so they survive restarts
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS results (
+            key TEXT PRIMARY KEY,
+            expires REAL NOT NULL,
+            result BLOB NOT NULL);
+        CREATE INDEX IF NOT EXISTS results_expires ON results (expires);
+    '''
+
+    def __init__(self, path=None, max_entries=1000, ttl=21600,
+                 retry_after=600, max_retry_after=86400):
+        super().__init__(path)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self.max_retry_after = max_retry_after
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def cacheable(video):
+        # Videos that couldn't be hashed would all share the same key
+        return video.file_hash is not None and len(video.file_hash) == 16
+
+    @staticmethod
+    def _key(video, languages):
+        return "{0}:{1}:{2}".format(video.file_hash, video.file_size,
+                                    ','.join(sorted(languages)))
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None and self.path:
+            row = self.execute('SELECT result FROM results WHERE key = ? AND '
+                               'expires > ?', (key, time.time()))
+            if row:
+                try:
+                    entry = pickle.loads(row[0][0])
+                except (pickle.UnpicklingError, AttributeError, TypeError,
+                        EOFError):
+                    # Cached by an older version of Subtle
+                    return None
+                self._remember(key, entry)
+        return entry
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, video, languages):
+        # Returns a CachedResult, whose results are None if nothing was
+        # found, or None if the video has to be looked up again
+        if not self.cacheable(video):
+            return None
+        key = self._key(video, languages)
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None or entry.expires <= time.time():
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, video, languages, results):
+        # Only searches that completed belong here, a failed search says
+        # nothing about whether there are subtitles
+        if not self.cacheable(video):
+            return None
+        key = self._key(video, languages)
+        with self._lock:
+            if results:
+                entry = CachedResult(video, results, time.time() + self.ttl)
+            else:
+                previous = self._lookup(key)
+                misses = previous.misses + 1 \
+                    if previous is not None and not previous.results else 1
+                entry = CachedResult(
+                    video, None, time.time() + min(
+                        self.retry_after * 2 ** (misses - 1),
+                        self.max_retry_after), misses)
+            self._remember(key, entry)
+            if self.path:
+                # Keep expired negative results around to remember how often
+                # the video was looked up in vain
+                self.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)',
+                             (key, entry.expires if results else
+                              entry.expires + self.max_retry_after,
+                              pickle.dumps(entry)))
+            return entry
+
+    def prune(self):
+        with self._lock:
+            now = time.time()
+            for key in [key for key, entry in self._entries.items()
+                        if entry.expires <= now and entry.results]:
+                del self._entries[key]
+            if self.path:
+                self.execute('DELETE FROM results WHERE expires <= ?', (now,))
+
+
+class TokenStore(SQLiteStore):
+    """
+    The OpenSubtitles session token of each user, with the time it expires,
+    so every worker process and restart can use the same session. Sessions
+    expire after 15 minutes without any calls
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS tokens (
+            user TEXT PRIMARY KEY,
+            token TEXT NOT NULL,
+            languages TEXT NOT NULL,
+            expires REAL NOT NULL);
+    '''
+
+    def __init__(self, path, lifetime=840):
+        super().__init__(path)
+        self.lifetime = lifetime
+
+    def get(self, user):
+        # Returns the token, languages and expiry time, or None if there's
+        # no session that's still valid
+        row = self.execute('SELECT token, languages, expires FROM tokens '
+                           'WHERE user = ? AND expires > ?',
+                           (user, time.time()))
+        if not row:
+            return None
+        token, languages, expires = row[0]
+        return token, languages.split(','), expires
+
+    def put(self, user, token, languages):
+        self.execute('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)',
+                     (user, token, ','.join(languages),
+                      time.time() + self.lifetime))
+
+    def touch(self, user, token):
+        # The session was used, so it's valid for a while longer
+        self.execute('UPDATE tokens SET expires = ? WHERE user = ? AND '
+                     'token = ?', (time.time() + self.lifetime, user, token))
+
+    def delete(self, user, token):
+        self.execute('DELETE FROM tokens WHERE user = ? AND token = ?',
+                     (user, token))
+
+
+class RateLimitStore(SQLiteStore):
+    """
+    Token buckets shared by every worker process, the daemon and the batch
+    commands, so together they stay within the limits of OpenSubtitles.
+    Each bucket holds up to 'rate' tokens and gets 'rate' new ones every
+    'per' seconds
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS buckets (
+            name TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated REAL NOT NULL);
+    '''
+
+    def _update(self, name, rate, per, change):
+        # Refills the bucket, and applies change to the tokens left. Returns
+        # the tokens there were before that
+        with self._lock:
+            connection = self.connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                row = connection.execute(
+                    'SELECT tokens, updated FROM buckets WHERE name = ?',
+                    (name,)).fetchall()
+                tokens = float(rate) if not row else min(
+                    float(rate), row[0][0] + max(0.0, now - row[0][1]) *
+                    rate / per)
+                connection.execute(
+                    'INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)',
+                    (name, change(tokens), now))
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        return tokens
+
+    def take(self, name, rate, per, count=1):
+        # Takes count tokens and returns 0, or if there aren't enough, takes
+        # none and returns the number of seconds until there will be
+        tokens = self._update(name, rate, per, lambda tokens: tokens - count
+                              if tokens >= count else tokens)
+        return 0 if tokens >= count else (count - tokens) * per / rate
+
+    def empty(self, name, rate, per):
+        # Uses up the tokens that are left
+        self._update(name, rate, per, lambda tokens: min(tokens, 0.0))
@@ -0,0 +1,199 @@
+import argparse
+import os
+import signal
+import sys
+import time
+from subtle import library, os_handler, root_location
+from subtle.daemon import WatchDaemon
+from subtle.library import LibraryIndex
+from subtle.pipeline import BatchJob
+from subtle.scanner import LibraryScanner
+from subtle.scheduler import BULK
+from web import log, logger
+
+
+class ProgressReporter(object):
+    """Writes progress to stderr, at most once per interval"""
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self._last_report = 0
+
+    def __call__(self, progress):
+        if progress.finished or \
+                time.time() - self._last_report >= self.interval:
+            self._last_report = time.time()
+            sys.stderr.write("\r{0}{1}".format(
+                progress, '\n' if progress.finished else ''))
+            sys.stderr.flush()
+
+
+def print_videos(videos, with_info=False):
+    for video in videos:
+        columns = [video.file_hash, str(video.file_size)]
+        if with_info:
+            columns += [str(video.imdb_id), video.title, str(video.year)]
+        print('\t'.join(columns + [video.full_path]))
+
+
+def scan(args):
+    scanner = LibraryScanner(args.root or root_location, args.workers,
+                             on_progress=ProgressReporter())
+    if args.info:
+        os_handler.scheduler.set_priority(BULK)
+        os_handler.login()
+    # Look up video info for a whole batch of videos at once
+    batch_size = os_handler.check_hash_batch_size if args.info else 1
+    batch = []
+    for video in scanner.scan():
+        batch.append(video)
+        if len(batch) >= batch_size:
+            if args.info:
+                os_handler.get_video_info_many(batch)
+            print_videos(batch, args.info)
+            batch = []
+    if batch:
+        if args.info:
+            os_handler.get_video_info_many(batch)
+        print_videos(batch, args.info)
+
+
+def daemon(args):
+    # Log to the terminal as well as to subtle.log
+    handler = log.StreamHandler()
+    handler.setFormatter(log.Formatter('%(asctime)s %(message)s'))
+    logger.addHandler(handler)
+    if logger.level > log.INFO:
+        logger.setLevel(log.INFO)
+
+    os_handler.login()
+    watcher = WatchDaemon(os_handler, args.root or root_location,
+                          workers=args.workers,
+                          poll_interval=args.interval,
+                          scan_existing=args.scan)
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
+    # A shared session might still be used by the web interface
+    if os_handler.token_store is None:
+        os_handler.logout()
+
+
+def batch(args):
+    os_handler.login()
+    preference = {'yes': True, 'no': False}
+    job = BatchJob(os_handler, args.root or root_location,
+                   checkpoint=args.checkpoint,
+                   hash_workers=args.hash_workers,
+                   search_workers=args.search_workers,
+                   is_HD=preference.get(args.hd),
+                   is_HI=preference.get(args.hi),
+                   on_progress=ProgressReporter())
+    signal.signal(signal.SIGTERM, lambda signum, frame: job.stop())
+    try:
+        job.run()
+    except KeyboardInterrupt:
+        job.stop()
+        sys.stderr.write("\nStopped, run the same command again to "
+                         "carry on\n")
+    print('\n'.join(job.pipeline.report()))
+    print("{0} videos skipped".format(job.skipped))
+    if os_handler.token_store is None:
+        os_handler.logout()
+
+
+def missing(args):
+    # The library index only keeps track of the root in config.json, other
+    # directories (or all of them, without an index) are listed in full
+    root = args.root or root_location
+    index = library if library is not None and \
+        os.path.abspath(root) == os.path.abspath(root_location) \
+        else LibraryIndex(':memory:')
+    index.update(root, hash_videos=args.hash)
+    languages = args.lang.split(',') if args.lang \
+        else os_handler.known_languages()
+    for path, file_hash, existing in index.missing(languages):
+        print('\t'.join([file_hash or '', ','.join(existing), path]))
+    total, missing_count = index.count_missing(languages)
+    sys.stderr.write("{0} of {1} videos are missing subtitles\n"
+                     .format(missing_count, total))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='Subtle',
+        description="Run without a command to start the web interface.")
+    commands = parser.add_subparsers(dest='command')
+
+    scan_parser = commands.add_parser(
+        'scan', help="hash every video in a directory tree")
+    scan_parser.add_argument('root', nargs='?',
+                             help="directory to scan (default: root in "
+                                  "config.json)")
+    scan_parser.add_argument('-w', '--workers', type=int, default=8,
+                             help="number of files to hash at the same time "
+                                  "(default: 8)")
+    scan_parser.add_argument('-i', '--info', action='store_true',
+                             help="look up the IMDb ID, title and year of "
+                                  "each video on OpenSubtitles")
+    scan_parser.set_defaults(func=scan)
+
+    daemon_parser = commands.add_parser(
+        'daemon', help="fetch subtitles for new videos as they appear")
+    daemon_parser.add_argument('root', nargs='?',
+                               help="directory to watch (default: root in "
+                                    "config.json)")
+    daemon_parser.add_argument('-w', '--workers', type=int, default=2,
+                               help="number of videos to look up at the "
+                                    "same time (default: 2)")
+    daemon_parser.add_argument('-s', '--scan', action='store_true',
+                               help="fetch subtitles for the videos that "
+                                    "are there already, too")
+    daemon_parser.add_argument('--interval', type=int, default=60,
+                               help="seconds between scans when inotify "
+                                    "isn't available (default: 60)")
+    daemon_parser.set_defaults(func=daemon)
+
+    batch_parser = commands.add_parser(
+        'batch', help="fetch the best subtitles for every video that "
+                      "doesn't have them yet")
+    batch_parser.add_argument('root', nargs='?',
+                              help="directory to go through (default: root "
+                                   "in config.json)")
+    batch_parser.add_argument('-c', '--checkpoint', default='batch.log',
+                              help="file to keep track of the videos that "
+                                   "are done in, so an interrupted run can "
+                                   "be resumed (default: batch.log)")
+    batch_parser.add_argument('--hash-workers', type=int, default=4,
+                              help="number of files to hash at the same "
+                                   "time (default: 4)")
+    batch_parser.add_argument('--search-workers', type=int, default=2,
+                              help="number of videos to search for at the "
+                                   "same time (default: 2)")
+    batch_parser.add_argument('--hd', choices=('yes', 'no'),
+                              help="prefer subtitles for HD video, or not")
+    batch_parser.add_argument('--hi', choices=('yes', 'no'),
+                              help="prefer subtitles for the hearing "
+                                   "impaired, or not")
+    batch_parser.set_defaults(func=batch)
+
+    missing_parser = commands.add_parser(
+        'missing', help="list the videos that are missing subtitles")
+    missing_parser.add_argument('root', nargs='?',
+                                help="directory to look in (default: root "
+                                     "in config.json)")
+    missing_parser.add_argument('-l', '--lang',
+                                help="comma separated languages to look "
+                                     "for (default: your preferred "
+                                     "languages)")
+    missing_parser.add_argument('--hash', action='store_true',
+                                help="hash new and changed videos as well")
+    missing_parser.set_defaults(func=missing)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 1
+    return args.func(args)
@@ -1,75 +1,288 @@
-from threading import Timer, Lock
+from threading import Condition, Lock, Thread
+import binascii
+import codecs
+import heapq
+import itertools
+import logging as log
+import os
 import struct
+import time
+import uuid
+import zlib
+
+SUPPORTED_EXTENSIONS = ('.mkv', '.avi', '.mp4')
+# The ISO 639-1 codes used in subtitle file names, by OpenSubtitles language
+LANGUAGE_CODES = {
+    'ara': 'ar', 'bul': 'bg', 'cat': 'ca', 'chi': 'zh', 'cze': 'cs',
+    'dan': 'da', 'dut': 'nl', 'ell': 'el', 'eng': 'en', 'est': 'et',
+    'fin': 'fi', 'fre': 'fr', 'ger': 'de', 'heb': 'he', 'hin': 'hi',
+    'hrv': 'hr', 'hun': 'hu', 'ind': 'id', 'ita': 'it', 'jpn': 'ja',
+    'kor': 'ko', 'lav': 'lv', 'lit': 'lt', 'may': 'ms', 'nor': 'no',
+    'per': 'fa', 'pob': 'pb', 'pol': 'pl', 'por': 'pt', 'rum': 'ro',
+    'rus': 'ru', 'scc': 'sr', 'slo': 'sk', 'slv': 'sl', 'spa': 'es',
+    'swe': 'sv', 'tha': 'th', 'tur': 'tr', 'ukr': 'uk', 'vie': 'vi',
+}
+HASH_BLOCK_SIZE = 65536
+_hash_block = struct.Struct('<{}q'.format(HASH_BLOCK_SIZE // 8))
+
+
+class TimerQueue(object):
+    """
+    Runs the TimedEvents of a process on a single thread, which sleeps until
+    the earliest deadline in a heap. Events are run one at a time, so their
+    actions should be short, or else run on a thread of their own
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = Condition()
+        self._thread = None
+        self._pid = None
+
+    def _start(self):
+        # Start the thread on first use, in every forked worker process
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = Thread(target=self._run, name='TimerQueue',
+                                  daemon=True)
+            self._thread.start()
+
+    def _push(self, event, deadline):
+        heapq.heappush(self._heap, (deadline, next(self._counter), event))
+        event._queued = deadline
+
+    def schedule(self, event, deadline):
+        # Moving a deadline back only updates the event, the thread moves
+        # its heap entry when it gets to it
+        with self._condition:
+            self._start()
+            event._deadline = deadline
+            if event._queued is None or deadline < event._queued:
+                self._push(event, deadline)
+                if self._heap[0][2] is event:
+                    self._condition.notify()
+
+    def cancel(self, event):
+        with self._condition:
+            event._deadline = None
+
+    def _next_due(self):
+        # Waits for the next event that's due and takes it off the heap
+        with self._condition:
+            while True:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                deadline, _, event = self._heap[0]
+                if event._queued != deadline:
+                    # Left behind when the deadline was moved forward
+                    heapq.heappop(self._heap)
+                elif event._deadline is None:
+                    heapq.heappop(self._heap)
+                    event._queued = None
+                elif event._deadline > deadline:
+                    heapq.heappop(self._heap)
+                    self._push(event, event._deadline)
+                elif deadline > time.monotonic():
+                    self._condition.wait(deadline - time.monotonic())
+                else:
+                    heapq.heappop(self._heap)
+                    event._queued = None
+                    event._deadline = None
+                    return event
+
+    def _run(self):
+        while True:
+            event = self._next_due()
+            try:
+                event._run()
+            except Exception:
+                log.exception("Error: Timed event {0!r} failed"
+                              .format(event.action))
+
+
+timer_queue = TimerQueue()
 
 
 class TimedEvent(object):
-    # Based on source from: https://stackoverflow.com/questions/2398661/schedule-a-repeating-event-in-python-3
     """
-    A periodic task running in threading.Timers
+    A periodic task, run every 'interval' seconds by the shared TimerQueue.
+    Actions that can take a while, like calls to OpenSubtitles, should be
+    'threaded', so they're run on a thread of their own and don't hold up
+    the other events. A threaded action is skipped while it's still running
     """
 
     def __init__(self, interval, action, *args, **kwargs):
-        self._lock = Lock()
-        self._timer = None
         self.action = action
         self.interval = interval
+        self._deadline = None
+        self._queued = None
+        self._running = False
+        self._lock = Lock()
+        self._thread = None
+        autostart = kwargs.pop('autostart', True)
+        self.threaded = kwargs.pop('threaded', False)
         self.args = args
         self.kwargs = kwargs
-        self._stopped = True
-        if kwargs.pop('autostart', True):
+        if autostart:
             self.start()
 
-    def start(self, from_run=False):
-        self._lock.acquire()
-        if from_run or self._stopped:
-            self._stopped = False
-            self._timer = Timer(self.interval, self._run)
-            self._timer.start()
-            self._lock.release()
+    def start(self):
+        with self._lock:
+            if not self._running:
+                self._running = True
+                timer_queue.schedule(self, time.monotonic() + self.interval)
 
     def _run(self):
-        self.start(from_run=True)
+        with self._lock:
+            if not self._running:
+                return
+            timer_queue.schedule(self, time.monotonic() + self.interval)
+            if self.threaded:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = Thread(
+                        target=self.action, args=self.args,
+                        kwargs=self.kwargs, daemon=True,
+                        name='TimedEvent-{0}'.format(
+                            getattr(self.action, '__name__', 'action')))
+                    self._thread.start()
+                return
         self.action(*self.args, **self.kwargs)
 
     def stop(self):
-        self._lock.acquire()
-        self._stopped = True
-        self._timer.cancel()
-        self._lock.release()
+        with self._lock:
+            self._running = False
+            timer_queue.cancel(self)
 
     def reset(self):
-        if not self._stopped:
-            self.stop()
-            self.start()
+        # Starts the interval over, without waking up the timer thread
+        with self._lock:
+            if self._running:
+                timer_queue.schedule(self, time.monotonic() + self.interval)
 
 
 def hash_file(file, file_size):
     # Based on source: http://trac.opensubtitles.org/projects<script%20type=/opensubtitles/wiki/HashSourceCodes
+    # Each 64 KiB block is read in one call and summed as 8192 little-endian
+    # long longs at once, which gives the same result as adding them one by one
     try:
-
-        long_long_format = '<q'  # little-endian long long
-        byte_size = struct.calcsize(long_long_format)
-        file_hash = file_size
-
-        if file_size < 65536 * 2:
+        if file_size < HASH_BLOCK_SIZE * 2:
             return "SizeError"
 
-        for x in range(65536 // byte_size):
-            buffer = file.read(byte_size)
-            (l_value,) = struct.unpack(long_long_format, buffer)
-            file_hash += l_value
-            file_hash = file_hash & 0xFFFFFFFFFFFFFFFF  # to remain as 64bit number
+        file_hash = file_size
+        file_hash += sum(_hash_block.unpack(file.read(HASH_BLOCK_SIZE)))
 
-        file.seek(max(0, file_size - 65536), 0)
-        for x in range(65536 // byte_size):
-            buffer = file.read(byte_size)
-            (l_value,) = struct.unpack(long_long_format, buffer)
-            file_hash += l_value
-            file_hash = file_hash & 0xFFFFFFFFFFFFFFFF
+        file.seek(max(0, file_size - HASH_BLOCK_SIZE), 0)
+        file_hash += sum(_hash_block.unpack(file.read(HASH_BLOCK_SIZE)))
 
         file.close()
-        returned_hash = "%016x" % file_hash
+        returned_hash = "%016x" % (file_hash & 0xFFFFFFFFFFFFFFFF)
         return returned_hash
 
     except IOError:
         return "IOError"
+
+
+def subtitle_path(video_path, lang_id):
+    # Subtitles are named after their video, e.g. 'Movie.en.srt'
+    return "{path}.{lang}.{ext}".format(
+        path=os.path.splitext(video_path)[0], lang=lang_id, ext='srt')
+
+
+def subtitle_language(name, prefix):
+    # The language code of a subtitle named prefix + '<code>.srt', or None
+    # if it belongs to another video, like 'Movie.part2.en.srt' or
+    # 'Movie 2.srt' do for 'Movie.mkv'. ISO 639-1 codes, and the few
+    # OpenSubtitles made up itself (like 'pb'), are two letters
+    if not name.startswith(prefix) or not name.endswith('.srt'):
+        return None
+    code = name[len(prefix):-len('.srt')]
+    return code if len(code) == 2 and code.isalpha() else None
+
+
+def directory_subtitles(names):
+    # The language codes of the subtitles among the names in a directory,
+    # by the name of the video they belong to without its extension
+    subtitles = dict()
+    for name in names:
+        stem = name[:-len('.srt')].rpartition('.')[0]
+        code = subtitle_language(name, stem + '.')
+        if code is not None:
+            subtitles.setdefault(stem, set()).add(code)
+    return subtitles
+
+
+def missing_languages(video_path, languages, subtitles=None):
+    # The OpenSubtitles language codes there's no subtitle for yet. If the
+    # subtitles in the video's directory aren't passed in, as returned by
+    # directory_subtitles, the few subtitles the video could have are
+    # looked for instead of listing a directory of possibly many videos
+    if subtitles is None:
+        return [lang for lang in languages if not os.path.exists(
+            subtitle_path(video_path, LANGUAGE_CODES.get(lang, lang)))]
+    existing = subtitles.get(
+        os.path.splitext(os.path.basename(video_path))[0], ())
+    return [lang for lang in languages
+            if LANGUAGE_CODES.get(lang, lang) not in existing]
+
+
+def base64_chunks(payload, chunk_size=65536):
+    # Decodes a base64 encoded payload a chunk at a time
+    remainder = b''
+    for i in range(0, len(payload), chunk_size):
+        chunk = remainder + ''.join(
+            payload[i:i + chunk_size].split()).encode('ascii')
+        # Base64 can only be decoded four characters at a time
+        usable = len(chunk) - len(chunk) % 4
+        remainder = chunk[usable:]
+        yield binascii.a2b_base64(chunk[:usable])
+
+
+def write_subtitle(payload, path, chunk_size=65536):
+    """
+    Decodes a base64 encoded, gzipped subtitle into path a chunk at a time.
+    Returns False if the subtitle isn't valid UTF-8, in which case it's
+    written as is.
+    """
+    return write_compressed_subtitle(base64_chunks(payload, chunk_size),
+                                     path)
+
+
+def write_compressed_subtitle(chunks, path):
+    """
+    Decompresses a gzipped subtitle, given as chunks of bytes, into path.
+    The subtitle is written to a temporary file first and then renamed, so
+    path never contains a partially written subtitle. Returns False if the
+    subtitle isn't valid UTF-8, in which case it's written as is.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    is_utf8 = True
+    temp_path = "{0}.{1}.tmp".format(path, uuid.uuid4().hex)
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as sub_file:
+            for chunk in chunks:
+                data = decompressor.decompress(chunk)
+                if is_utf8:
+                    try:
+                        decoder.decode(data)
+                    except UnicodeDecodeError:
+                        is_utf8 = False
+                sub_file.write(data)
+            data = decompressor.flush()
+            if is_utf8:
+                try:
+                    decoder.decode(data, final=True)
+                except UnicodeDecodeError:
+                    is_utf8 = False
+            sub_file.write(data)
+        if not decompressor.eof:
+            raise zlib.error("Error -5 while decompressing data: "
+                             "incomplete or truncated stream")
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return is_utf8
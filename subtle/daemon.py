@@ -0,0 +1,340 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import queue
+import select
+import struct
+import time
+from threading import Event, Lock, Thread
+from subtle.components import SUPPORTED_EXTENSIONS, missing_languages
+from subtle.scanner import iter_videos
+from subtle.scheduler import BACKGROUND
+from subtle.selection import pick_best
+from subtle.types import Video
+from web import log
+
+
+class Inotify(object):
+    """
+    Minimal inotify binding through ctypes, watching whole directory trees.
+    Raises OSError if inotify isn't available on this system
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+
+    watch_mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    _event = struct.Struct('iIII')
+
+    def __init__(self):
+        library = ctypes.util.find_library('c')
+        if library is None:
+            raise OSError(errno.ENOSYS, "Could not find the C library")
+        self._libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "inotify is not supported")
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "Could not start inotify")
+        self._paths = dict()
+
+    def add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                          self.watch_mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(),
+                          "Could not watch '{0}'".format(path))
+        self._paths[wd] = path
+
+    def watch_tree(self, root):
+        # Returns the directories that are watched now
+        directories = []
+        pending = [root]
+        while pending:
+            directory = pending.pop()
+            try:
+                self.add_watch(directory)
+                directories.append(directory)
+                for entry in os.scandir(directory):
+                    if entry.is_dir(follow_symlinks=False) and \
+                            not entry.name.startswith('.'):
+                        pending.append(entry.path)
+            except OSError as e:
+                log.warning("Could not watch '{0}': {1}"
+                            .format(directory, e.strerror))
+        return directories
+
+    def read(self, timeout=None):
+        # Waits for events and returns them as (path, mask) tuples, and
+        # (None, IN_Q_OVERFLOW) if the kernel had to drop any
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self._event.unpack_from(data, offset)
+            offset += self._event.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            directory = self._paths.get(wd)
+            if mask & self.IN_IGNORED:
+                self._paths.pop(wd, None)
+            if directory is not None:
+                events.append((os.path.join(directory, os.fsdecode(name))
+                               if name else directory, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher(object):
+    """
+    Finds new and changed videos by scanning the tree every 'interval'
+    seconds. Only directories whose modification time changed are listed
+    again, and files are only reported once they haven't changed for
+    'settle' seconds, so files that are still being copied are left alone
+    """
+
+    def __init__(self, root, interval=60, settle=30):
+        self.root = root
+        self.interval = interval
+        self.settle = settle
+        self._directories = dict()
+        self._files = dict()
+        self._unsettled = set()
+
+    def _changed_directories(self):
+        changed = []
+        seen = set()
+        pending = [self.root]
+        while pending:
+            directory = pending.pop()
+            seen.add(directory)
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+                sub_directories = [
+                    entry.path for entry in os.scandir(directory)
+                    if entry.is_dir(follow_symlinks=False) and
+                    not entry.name.startswith('.')]
+            except OSError:
+                continue
+            if self._directories.get(directory) != mtime_ns or \
+                    directory in self._unsettled:
+                self._directories[directory] = mtime_ns
+                changed.append(directory)
+            pending.extend(sub_directories)
+        # Forget about directories that were removed
+        for directory in set(self._directories) - seen:
+            del self._directories[directory]
+        return changed
+
+    def poll(self):
+        # Returns the paths of the videos that are new or have changed
+        # since the last poll
+        found = []
+        now = time.time()
+        for directory in self._changed_directories():
+            self._unsettled.discard(directory)
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if not entry.name.endswith(SUPPORTED_EXTENSIONS):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                key = stat.st_size, stat.st_mtime_ns
+                if self._files.get(entry.path) == key:
+                    continue
+                if now - stat.st_mtime < self.settle:
+                    # Look at the directory again until the file settles
+                    self._unsettled.add(directory)
+                    continue
+                self._files[entry.path] = key
+                found.append(entry.path)
+        return found
+
+
+class WatchDaemon(object):
+    """
+    Watches a directory tree for new or changed videos and fetches the
+    best subtitle in each of the user's languages for them. Videos are
+    looked up by a fixed number of worker threads, from a bounded queue
+    that makes the watcher wait when the workers can't keep up
+    """
+
+    def __init__(self, os_handler, root, workers=2, max_queued=1000,
+                 poll_interval=60, settle=30, scan_existing=False):
+        self.os_handler = os_handler
+        self.root = root
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.settle = settle
+        self.scan_existing = scan_existing
+        self.fetched = 0
+        self.skipped = 0
+        self.failed = 0
+        self._queue = queue.Queue(max_queued)
+        self._queued = set()
+        self._lock = Lock()
+        self._stop = Event()
+        self._threads = []
+
+    def enqueue(self, path):
+        # Blocks while the queue is full, unless the daemon is stopping
+        with self._lock:
+            if path in self._queued:
+                return
+            self._queued.add(path)
+        while not self._stop.is_set():
+            try:
+                self._queue.put(path, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def missing_languages(self, path):
+        # The languages the video doesn't have a subtitle for yet
+        return missing_languages(path, self.os_handler.language)
+
+    def fetch(self, path):
+        # Returns whether any subtitles were saved for the video, or None
+        # if it couldn't be looked up
+        if not self.missing_languages(path):
+            return False
+        video = Video(path)
+        if video.file_hash is None or len(video.file_hash) != 16:
+            log.warning("Could not hash '{0}'".format(path))
+            return None
+        if not self.os_handler.logged_in:
+            self.os_handler.login()
+        self.os_handler.get_video_info(video)
+        results = self.os_handler.search_subtitles(video)
+        if results is None:
+            return None
+        # Check again, a subtitle might have been added in the meantime
+        downloads = []
+        for lang in self.missing_languages(path):
+            best = pick_best(results.get(lang),
+                             self.os_handler.match_ranking)
+            if best is not None:
+                downloads.append((video, best))
+        saved = self.os_handler.download_subtitles(downloads)
+        for sub_filename in saved.values():
+            log.info("Saved '{0}'".format(sub_filename))
+        return len(saved) > 0
+
+    def _work(self):
+        # Let requests from the web interface go first
+        self.os_handler.scheduler.set_priority(BACKGROUND)
+        while not self._stop.is_set():
+            try:
+                path = self._queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            with self._lock:
+                self._queued.discard(path)
+            try:
+                fetched = self.fetch(path)
+            except Exception:
+                fetched = None
+                log.exception("Error: Could not fetch subtitles for '{0}'"
+                              .format(path))
+            with self._lock:
+                if fetched is None:
+                    self.failed += 1
+                elif fetched:
+                    self.fetched += 1
+                else:
+                    self.skipped += 1
+
+    def _is_video(self, path):
+        return path.endswith(SUPPORTED_EXTENSIONS) and \
+            not os.path.basename(path).startswith('.')
+
+    def _watch_inotify(self, inotify):
+        inotify.watch_tree(self.root)
+        while not self._stop.is_set():
+            for path, mask in inotify.read(timeout=1):
+                if path is None:
+                    # Events were dropped, so look at everything again
+                    log.warning("Too many changes at once, rescanning "
+                                "'{0}'".format(self.root))
+                    inotify.watch_tree(self.root)
+                    self._scan(self.root)
+                elif mask & Inotify.IN_ISDIR:
+                    if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO) and \
+                            not os.path.basename(path).startswith('.'):
+                        # Files can be added before the watch is in place
+                        inotify.watch_tree(path)
+                        self._scan(path)
+                elif mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO) \
+                        and self._is_video(path):
+                    self.enqueue(path)
+
+    def _watch_polling(self):
+        watcher = PollingWatcher(self.root, self.poll_interval, self.settle)
+        # The first poll only records what's there already
+        if self.scan_existing:
+            watcher.settle = 0
+        for path in watcher.poll():
+            if self.scan_existing:
+                self.enqueue(path)
+        watcher.settle = self.settle
+        while not self._stop.wait(self.poll_interval):
+            for path in watcher.poll():
+                self.enqueue(path)
+
+    def _scan(self, root):
+        for path in iter_videos(root):
+            if self._stop.is_set():
+                return
+            self.enqueue(path)
+
+    def run(self):
+        # Watches the tree until stop() is called
+        self._stop.clear()
+        for number in range(self.workers):
+            thread = Thread(target=self._work, daemon=True,
+                            name='Fetcher-{0}'.format(number + 1))
+            thread.start()
+            self._threads.append(thread)
+        try:
+            inotify = Inotify()
+        except OSError as e:
+            log.info("Could not use inotify ({0}), scanning '{1}' every {2} "
+                     "seconds instead".format(e.strerror, self.root,
+                                              self.poll_interval))
+            self._watch_polling()
+        else:
+            log.info("Watching '{0}' for new videos".format(self.root))
+            try:
+                if self.scan_existing:
+                    self._scan(self.root)
+                self._watch_inotify(inotify)
+            finally:
+                inotify.close()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        log.info("Fetched subtitles for {0} videos, skipped {1}, {2} failed"
+                 .format(self.fetched, self.skipped, self.failed))
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,332 @@
+import os
+import time
+import uuid
+from threading import Lock, Thread
+from subtle.cache import SQLiteStore
+from subtle.components import HASH_BLOCK_SIZE, LANGUAGE_CODES, \
+    SUPPORTED_EXTENSIONS, subtitle_language
+from subtle.types import Video
+from web import log
+
+
+class LibraryIndex(SQLiteStore):
+    """
+    Index of every video below a root directory, with its hash (if known)
+    and the languages of the subtitles saved next to it. Each directory is
+    listed in a single os.scandir pass, and only listed again when its
+    modification time changed, so updating the index of a library that
+    didn't change only takes a stat call per directory
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS directories (
+            path TEXT PRIMARY KEY,
+            parent TEXT,
+            mtime_ns INTEGER NOT NULL);
+        CREATE INDEX IF NOT EXISTS directories_parent
+            ON directories (parent);
+        CREATE TABLE IF NOT EXISTS videos (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            directory TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            hash TEXT,
+            languages TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS videos_directory ON videos (directory);
+        CREATE INDEX IF NOT EXISTS videos_path_languages
+            ON videos (path, languages);
+        CREATE TABLE IF NOT EXISTS language_sets (
+            languages TEXT PRIMARY KEY,
+            videos INTEGER NOT NULL) WITHOUT ROWID;
+        CREATE TRIGGER IF NOT EXISTS videos_added AFTER INSERT ON videos
+        BEGIN
+            INSERT OR IGNORE INTO language_sets VALUES (new.languages, 0);
+            UPDATE language_sets SET videos = videos + 1
+                WHERE languages = new.languages;
+        END;
+        CREATE TRIGGER IF NOT EXISTS videos_removed AFTER DELETE ON videos
+        BEGIN
+            UPDATE language_sets SET videos = videos - 1
+                WHERE languages = old.languages;
+            DELETE FROM language_sets
+                WHERE languages = old.languages AND videos = 0;
+        END;
+        CREATE TABLE IF NOT EXISTS updater (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            owner TEXT NOT NULL,
+            expires REAL NOT NULL);
+    '''
+
+    # Directories listed per transaction, so the index can be read from
+    # in between while it's being built
+    batch_size = 200
+    # Seconds an update can go without writing before another process may
+    # take over, in case the one updating was killed
+    claim_timeout = 300
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._updating = Lock()
+
+    def update(self, root, hash_videos=False):
+        """
+        Brings the index of the tree below root up to date, and returns the
+        number of directories that had to be listed again. New and changed
+        videos are hashed if hash_videos is set. Only one process updates
+        the index at a time, the others return 0 right away
+        """
+        root = os.path.abspath(root)
+        owner = uuid.uuid4().hex
+        if not self._claim(owner):
+            log.info("The library index is being updated by another process")
+            return 0
+        try:
+            known, children = self._directories()
+            # Forget trees that used to be the root
+            old_roots = [path for path in children.get(None, [])
+                         if path != root]
+            if old_roots:
+                self._write(owner, [(path, None, None, None, None)
+                                    for path in old_roots], children)
+                known, children = self._directories()
+
+            listed = 0
+            pending = [(root, None)]
+            while pending:
+                # Directories are listed and videos hashed without holding
+                # the lock, so the index can still be read in the meantime
+                listings = []
+                while pending and len(listings) < self.batch_size:
+                    path, parent = pending.pop()
+                    try:
+                        mtime_ns = os.stat(path).st_mtime_ns
+                    except OSError:
+                        listings.append((path, parent, None, None, None))
+                        continue
+                    if known.get(path) == mtime_ns:
+                        sub_directories = children.get(path, [])
+                    else:
+                        sub_directories, videos = self._list(path,
+                                                             hash_videos)
+                        listings.append((path, parent, mtime_ns,
+                                         sub_directories, videos))
+                        listed += 1
+                    pending.extend((sub_directory, path)
+                                   for sub_directory in sub_directories)
+                if not self._write(owner, listings, children):
+                    log.warning("Another process took over updating the "
+                                "library index")
+                    break
+        finally:
+            self._release(owner)
+        if listed:
+            log.info("Updated the library index of '{0}', {1} directories "
+                     "changed".format(root, listed))
+        return listed
+
+    def _claim(self, owner):
+        # Makes owner the one process updating the index, unless another
+        # one is and it wrote something recently
+        with self._lock:
+            connection = self.connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                claimed = self._renew(owner)
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+        return claimed
+
+    def _renew(self, owner):
+        # Within a transaction, extends owner's claim if nobody else holds one
+        row = self.connection.execute(
+            'SELECT owner, expires FROM updater').fetchall()
+        if row and row[0][0] != owner and row[0][1] > time.time():
+            return False
+        self.connection.execute(
+            'INSERT OR REPLACE INTO updater VALUES (0, ?, ?)',
+            (owner, time.time() + self.claim_timeout))
+        return True
+
+    def _release(self, owner):
+        self.execute('DELETE FROM updater WHERE owner = ?', (owner,))
+
+    def _directories(self):
+        # The modification time of every directory, and the sub directories
+        # of each one
+        known = dict()
+        children = dict()
+        for path, parent, mtime_ns in self.execute(
+                'SELECT path, parent, mtime_ns FROM directories'):
+            known[path] = mtime_ns
+            children.setdefault(parent, []).append(path)
+        return known, children
+
+    def _list(self, path, hash_videos):
+        # Lists a directory that changed, and returns its sub directories
+        # and its videos, as (path, size, mtime_ns, hash, languages) tuples
+        sub_directories = []
+        videos = dict()
+        subtitles = []
+        try:
+            for entry in os.scandir(path):
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not entry.name.startswith('.'):
+                            sub_directories.append(entry.path)
+                    elif entry.name.endswith('.srt'):
+                        subtitles.append(entry.name)
+                    elif entry.name.endswith(SUPPORTED_EXTENSIONS) and \
+                            entry.is_file():
+                        stat = entry.stat()
+                        videos[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    log.warning("Could not read '{0}'".format(entry.path))
+        except OSError:
+            log.warning("Could not open directory '{0}'".format(path))
+
+        # Keep the hashes of the videos that didn't change
+        stored = {row[0]: row[1:] for row in self.execute(
+            'SELECT path, size, mtime_ns, hash FROM videos WHERE '
+            'directory = ?', (path,))}
+        rows = []
+        for video_path, (size, mtime_ns) in videos.items():
+            previous = stored.get(video_path)
+            file_hash = previous[2] \
+                if previous is not None and previous[:2] == (size, mtime_ns) \
+                else None
+            if file_hash is None and hash_videos and \
+                    size >= HASH_BLOCK_SIZE * 2:
+                file_hash = Video(video_path).file_hash
+            # Subtitles are saved as <name of the video>.<language>.srt
+            prefix = os.path.splitext(os.path.basename(video_path))[0] + '.'
+            codes = set(subtitle_language(name, prefix) for name in subtitles)
+            codes.discard(None)
+            rows.append((video_path, size, mtime_ns, file_hash,
+                         ','.join(sorted(codes))))
+        return sub_directories, rows
+
+    def _write(self, owner, listings, children):
+        # Writes the directories listed by _list in a single transaction, or
+        # forgets those whose videos are None. Returns False, without
+        # writing anything, if owner no longer has the claim
+        with self._lock:
+            connection = self.connection
+            execute = connection.execute
+            execute('BEGIN IMMEDIATE')
+            try:
+                if not self._renew(owner):
+                    execute('ROLLBACK')
+                    return False
+                for path, parent, mtime_ns, sub_directories, videos in \
+                        listings:
+                    if videos is None:
+                        self._remove_tree(path)
+                        continue
+                    for sub_directory in set(children.get(path, [])) - \
+                            set(sub_directories):
+                        self._remove_tree(sub_directory)
+                    execute('DELETE FROM videos WHERE directory = ?', (path,))
+                    connection.executemany(
+                        'INSERT INTO videos (path, directory, size, mtime_ns, '
+                        'hash, languages) VALUES (?, ?, ?, ?, ?, ?)',
+                        [(video_path, path, size, mtime_ns, file_hash,
+                          languages) for video_path, size, mtime_ns,
+                         file_hash, languages in videos])
+                    execute('INSERT OR REPLACE INTO directories VALUES '
+                            '(?, ?, ?)', (path, parent, mtime_ns))
+                execute('COMMIT')
+            except Exception:
+                execute('ROLLBACK')
+                raise
+        return True
+
+    def _remove_tree(self, path):
+        # Forgets a directory and everything below it. Paths below it sort
+        # between 'path/' and 'path0', as '0' comes right after '/'
+        start, end = path + os.sep, path + chr(ord(os.sep) + 1)
+        execute = self.connection.execute
+        execute('DELETE FROM videos WHERE directory = ? OR '
+                '(directory >= ? AND directory < ?)', (path, start, end))
+        execute('DELETE FROM directories WHERE path = ? OR '
+                '(path >= ? AND path < ?)', (path, start, end))
+
+    def update_in_background(self, root, hash_videos=False):
+        # Updates the index on a thread of its own, unless that's happening
+        # already. Returns whether an update was started
+        if not self._updating.acquire(blocking=False):
+            return False
+
+        def run():
+            try:
+                self.update(root, hash_videos)
+            except Exception:
+                log.exception("Error: Could not update the library index")
+            finally:
+                self._updating.release()
+        Thread(target=run, name='LibraryIndex', daemon=True).start()
+        return True
+
+    @property
+    def updating(self):
+        return self._updating.locked()
+
+    @property
+    def is_empty(self):
+        return not self.execute('SELECT 1 FROM directories LIMIT 1')
+
+    def _language_sets(self):
+        # The number of videos with each set of subtitle languages, kept up
+        # to date by the triggers in the schema. There are only as many of
+        # these as combinations of languages, so they're read in no time
+        return [(frozenset(languages.split(',')) if languages else
+                 frozenset(), count) for languages, count in self.execute(
+                     'SELECT languages, videos FROM language_sets')]
+
+    def _incomplete(self, codes):
+        # The language sets of the videos that lack one of the languages
+        codes = set(codes)
+        return [','.join(sorted(languages))
+                for languages, _ in self._language_sets()
+                if not codes <= languages]
+
+    def count_missing(self, languages):
+        # The number of videos, and of those that lack a subtitle in one of
+        # the languages (OpenSubtitles or ISO 639-1 codes)
+        codes = set(iso_codes(languages))
+        total = missing = 0
+        for existing, count in self._language_sets():
+            total += count
+            if not codes <= existing:
+                missing += count
+        return total, missing
+
+    def missing(self, languages, limit=-1, offset=0):
+        """
+        The videos that lack a subtitle in one of the languages, by path,
+        as (path, hash, languages of the subtitles it has) tuples
+        """
+        codes = iso_codes(languages)
+        if not codes:
+            return []
+        with self._lock:
+            incomplete = self._incomplete(codes)
+            if not incomplete:
+                return []
+            # Walk the index on path, which has the languages as well, so
+            # only the videos on the page are read from the table
+            rows = self.execute(
+                'SELECT path, hash, languages FROM videos INDEXED BY '
+                'videos_path_languages WHERE languages IN ({0}) ORDER BY '
+                'path LIMIT ? OFFSET ?'.format(
+                    ', '.join('?' * len(incomplete))),
+                incomplete + [limit, offset])
+        return [(path, file_hash, languages.split(',') if languages else [])
+                for path, file_hash, languages in rows]
+
+
+def iso_codes(languages):
+    # Subtitles are named after the ISO 639-1 code of their language
+    return sorted(set(LANGUAGE_CODES.get(lang, lang) for lang in languages))
@@ -0,0 +1,79 @@
+import os
+from collections import OrderedDict
+from threading import Lock
+from subtle.components import SUPPORTED_EXTENSIONS
+
+
+class DirectoryListing(object):
+    """The sub directories and supported videos in a directory"""
+
+    def __init__(self, path, mtime_ns, dirs, files):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.dirs = dirs
+        self.files = files
+
+    def __len__(self):
+        return len(self.dirs) + len(self.files)
+
+    def page(self, number, size):
+        # Returns the directories and files on a page as (index, name) pairs,
+        # with directories first, and the number of pages
+        pages = max(1, -(-len(self) // size))
+        number = min(max(1, number), pages)
+        start, end = (number - 1) * size, number * size
+        dirs = [(i, self.dirs[i])
+                for i in range(start, min(end, len(self.dirs)))]
+        files = [(i, self.files[i]) for i in range(
+            max(0, start - len(self.dirs)),
+            min(max(0, end - len(self.dirs)), len(self.files)))]
+        return dirs, files, number, pages
+
+
+def list_directory(path):
+    """
+    Lists a directory in a single os.scandir pass, using the type of each
+    entry scandir already knows about instead of a stat call per entry
+    """
+    mtime_ns = os.stat(path).st_mtime_ns
+    dirs = []
+    files = []
+    for entry in os.scandir(path):
+        try:
+            if entry.is_dir():
+                if not entry.name.startswith('.'):
+                    dirs.append(entry.name)
+            elif entry.name.endswith(SUPPORTED_EXTENSIONS) and entry.is_file():
+                files.append(entry.name)
+        except OSError:
+            continue
+    return DirectoryListing(path, mtime_ns, sorted(dirs), sorted(files))
+
+
+class ListingCache(object):
+    """
+    Keeps the listings of recently visited directories, and only lists a
+    directory again when its modification time has changed
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._listings = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, path, listing=None):
+        # An earlier listing of the directory can be passed in, which is
+        # used if it's still up to date
+        mtime_ns = os.stat(path).st_mtime_ns
+        with self._lock:
+            cached = self._listings.get(path)
+        if cached is None or cached.mtime_ns != mtime_ns:
+            cached = listing if listing is not None and \
+                listing.path == path and listing.mtime_ns == mtime_ns \
+                else list_directory(path)
+        with self._lock:
+            self._listings[path] = cached
+            self._listings.move_to_end(path)
+            while len(self._listings) > self.max_entries:
+                self._listings.popitem(last=False)
+        return cached
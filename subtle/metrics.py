@@ -0,0 +1,258 @@
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+from subtle.cache import SQLiteStore
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n') \
+        .replace('"', r'\"')
+
+
+def _format_labels(names, values):
+    labels = ','.join('{0}="{1}"'.format(name, _escape(value))
+                      for name, value in zip(names, values))
+    return '{' + labels + '}' if labels else ''
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, registry, name, documentation, labels=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = dict()
+
+    def inc(self, *label_values, amount=1):
+        with self.registry.lock:
+            self.values[label_values] = \
+                self.values.get(label_values, 0) + amount
+
+    def fields(self, label_values):
+        # The separate numbers that make up the value for some labels
+        return [('', self.values[label_values])]
+
+    def render(self, rows):
+        # Renders the (labels, field, value) rows of this metric
+        return ['{0}{1} {2}'.format(self.name, labels, repr(float(value)))
+                for labels, field, value in sorted(rows)]
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = dict()
+
+    def observe(self, value, *label_values):
+        # Bucket counts aren't cumulative until they're rendered
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        with self.registry.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = \
+                    [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def fields(self, label_values):
+        counts = self.values[label_values]
+        return [('le=' + repr(float(bound)), count) for bound, count in
+                zip(self.buckets, counts)] + \
+            [('le=+Inf', counts[-2]), ('sum', counts[-1])]
+
+    def render(self, rows):
+        series = dict()
+        for labels, field, value in rows:
+            series.setdefault(labels, dict())[field] = value
+        lines = []
+        for labels in sorted(series):
+            fields = series[labels]
+            total = 0
+            for bound in [repr(float(b)) for b in self.buckets] + ['+Inf']:
+                total += fields.get('le=' + bound, 0)
+                lines.append('{0}_bucket{1} {2}'.format(
+                    self.name, self._with_bound(labels, bound), int(total)))
+            lines.append('{0}_sum{1} {2}'.format(
+                self.name, labels, repr(float(fields.get('sum', 0)))))
+            lines.append('{0}_count{1} {2}'.format(self.name, labels,
+                                                   int(total)))
+        return lines
+
+    @staticmethod
+    def _with_bound(labels, bound):
+        extra = 'le="{0}"'.format(bound)
+        return '{' + labels[1:-1] + ',' + extra + '}' if labels \
+            else '{' + extra + '}'
+
+
+class MetricsStore(SQLiteStore):
+    """
+    The sum of the metrics of every worker process, which each add what
+    they recorded since their last flush
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS metrics (
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            field TEXT NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (name, labels, field));
+    '''
+
+    def add(self, deltas):
+        with self._lock:
+            connection = self.connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                for name, labels, field, delta in deltas:
+                    if connection.execute(
+                            'UPDATE metrics SET value = value + ? WHERE '
+                            'name = ? AND labels = ? AND field = ?',
+                            (delta, name, labels, field)).rowcount == 0:
+                        connection.execute(
+                            'INSERT INTO metrics VALUES (?, ?, ?, ?)',
+                            (name, labels, field, delta))
+                connection.execute('COMMIT')
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+
+    def rows(self):
+        return self.execute('SELECT name, labels, field, value FROM metrics')
+
+
+class Registry(object):
+    """
+    Counters and histograms that are kept in memory, and added to a shared
+    MetricsStore every so often if there is one, so all gunicorn workers
+    are reported together
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self.lock = Lock()
+        self.metrics = []
+        self._flush_lock = Lock()
+        self._flushed = dict()
+        self._pid = os.getpid()
+
+    def counter(self, name, documentation, labels=()):
+        metric = Counter(self, name, documentation, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labels=(),
+                  buckets=LATENCY_BUCKETS):
+        metric = Histogram(self, name, documentation, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def _snapshot(self):
+        # The current value of every field, by (name, labels, field)
+        with self.lock:
+            return {(metric.name,
+                     _format_labels(metric.labels, label_values), field):
+                    value
+                    for metric in self.metrics
+                    for label_values in list(metric.values)
+                    for field, value in metric.fields(label_values)}
+
+    def flush(self):
+        if self.store is None:
+            return
+        with self._flush_lock:
+            snapshot = self._snapshot()
+            if self._pid != os.getpid():
+                # A forked worker's parent already reported what it inherited
+                self._pid = os.getpid()
+                self._flushed = snapshot
+                return
+            deltas = [key + (value - self._flushed.get(key, 0),)
+                      for key, value in snapshot.items()
+                      if value != self._flushed.get(key, 0)]
+            if deltas:
+                self.store.add(deltas)
+            self._flushed = snapshot
+
+    def render(self):
+        # The metrics in the Prometheus text format
+        if self.store is not None:
+            self.flush()
+            all_rows = self.store.rows()
+        else:
+            all_rows = [key + (value,)
+                        for key, value in self._snapshot().items()]
+        rows = dict()
+        for name, labels, field, value in all_rows:
+            rows.setdefault(name, []).append((labels, field, value))
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name,
+                                                 metric.documentation))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            lines.extend(metric.render(rows.get(metric.name, [])))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Registry()
+
+rpc_calls = metrics.counter(
+    'subtle_rpc_calls_total', 'XML-RPC calls made to OpenSubtitles',
+    ('method',))
+rpc_errors = metrics.counter(
+    'subtle_rpc_errors_total', 'XML-RPC calls that failed, by error',
+    ('method', 'error'))
+rpc_retries = metrics.counter(
+    'subtle_rpc_retries_total', 'XML-RPC calls that were retried',
+    ('method',))
+rpc_coalesced = metrics.counter(
+    'subtle_rpc_coalesced_total',
+    'XML-RPC calls that shared the result of an identical call',
+    ('method',))
+rpc_duration = metrics.histogram(
+    'subtle_rpc_duration_seconds', 'Time taken by XML-RPC calls',
+    ('method',))
+hash_duration = metrics.histogram(
+    'subtle_hash_duration_seconds', 'Time taken to hash a video')
+hash_bytes = metrics.counter(
+    'subtle_hash_bytes_read_total', 'Bytes read to hash videos')
+hash_cache_lookups = metrics.counter(
+    'subtle_hash_cache_lookups_total', 'Hash cache lookups, by result',
+    ('result',))
+result_cache_lookups = metrics.counter(
+    'subtle_result_cache_lookups_total', 'Result cache lookups, by result',
+    ('result',))
+subtitle_store_lookups = metrics.counter(
+    'subtle_subtitle_store_lookups_total',
+    'Subtitle store lookups before downloading, by result', ('result',))
+request_duration = metrics.histogram(
+    'subtle_request_duration_seconds', 'Time taken to handle web requests',
+    ('endpoint',))
+request_count = metrics.counter(
+    'subtle_requests_total', 'Web requests handled, by status',
+    ('endpoint', 'status'))
@@ -1,49 +1,302 @@
-import base64
+import binascii
 import os
-import sys
+import shutil
+import time
 import zlib
-from socket import gaierror
-from xmlrpc.client import ServerProxy, ProtocolError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from xmlrpc.client import ProtocolError
 from http.client import ResponseNotReady
-from subtle.components import TimedEvent
-from subtle.types import SubResult
+from subtle.components import TimedEvent, subtitle_path, write_subtitle
+from subtle.metrics import subtitle_store_lookups
+from subtle.profiling import phase
+from subtle.scheduler import RequestScheduler
+from subtle.transport import ServerPool
+from subtle.types import SubResult, SubResults
 from web import log
 
 
-class OSHandler(object):
-    """"Provides the connection to and communication with the
-    OpenSubtitles server using XML RPC"""
+class OSClient(object):
+    """Settings and helpers shared by the OpenSubtitles clients, which
+    don't depend on how the XML RPC calls are made"""
 
     version = '1'
     server_url = 'https://api.opensubtitles.org:443/xml-rpc'
     # Please do not change the user agent, nor use it in any other API
     user_agent = 'Subtle' + version
+    # Maximum number of hashes per CheckMovieHash call
+    check_hash_batch_size = 200
+    # Maximum number of subtitles per DownloadSubtitles call, which also
+    # bounds the memory used by a single response
+    download_batch_size = 20
+    # How to send the search strategies: one at a time until there's a match
+    # ('sequential'), all in one call ('combined') or all at once in separate
+    # calls ('concurrent')
+    search_mode = 'sequential'
+    # Search strategies by the MatchedBy value of their results, best first
+    match_ranking = ('moviehash', 'imdbid', 'tag', 'fulltext')
+    # Shared SubtitleStore, set up from config.json
+    subtitle_store = None
 
-    def __init__(self):
-        log.info("Welcome to Subtle!"
-                 "Attempting to connect to OpenSubtitles...")
+    @staticmethod
+    def _extract_data(result, key):
+        return result.get(key) if \
+            result['status'].split()[0] == '200' else None
+
+    def _read_login(self, result):
+        if not self._extract_data(result, 'token'):
+            raise ValueError("Error: Login unsuccessful. "
+                             "Please check your login information"
+                             "and try again.")
+        self.user_token = self._extract_data(result, 'token')
         try:
-            self.xml_rpc = ServerProxy(OSHandler.server_url, allow_none=True)
-            self.language = []
-            self.user_name = None
-            self.hash = None
-            self.user_token = None
-            self.__logged_in = False
-            self.keep_alive_timer = TimedEvent(
-                900, self._no_operation, autostart=False)
-            self.keep_alive = False
-            self.query_result = None
-            self.server_info = self.xml_rpc.ServerInfo()
-        except (gaierror, ProtocolError):
-            # Throw exception and exit if we can't connect to OpenSubtitles
-            log.exception("Error: Could not connect to OpenSubtitles.org")
-            sys.exit(1)
+            self.language = \
+                (self._extract_data(result, 'data')
+                 ['UserPreferedLanguages']).split(",")
+        # Set language to English if no preferred languages set in OS
+        except KeyError:
+            self.language = {'eng'}
+        log.info("""Login successful. Token set to "{t:s}","""
+                 " preferred language for subtitles set to '{lang:s}'."
+                 .format(t=self.user_token,
+                         lang=",".join(self.language)))
+
+    @staticmethod
+    def _set_video_info(video, data):
+        if data:
+            video.imdb_id = data['MovieImdbID']
+            video.title = data['MovieName']
+            video.year = data['MovieYear']
+        else:
+            video.title = video.file_name
+
+    def _search_params(self, video):
+        # Search strategies, from the most to the least precise one
+        languages = ','.join(self.language)
+        hash_params = \
+            {
+                'sublanguageid': languages,
+                'moviehash': video.file_hash,
+                'moviebytesize': str(video.file_size)
+            }
+
+        imdb_match = video.imdb_id if video.imdb_id != 0 else None
+        imdb_params = \
+            {
+                'sublanguageid': languages,
+                'imdbid': imdb_match
+            }
+
+        tag_params = \
+            {
+                'sublanguageid': languages,
+                'tag': video.file_name
+            }
+
+        file_params = \
+            {
+                'sublanguageid': languages,
+                'query': os.path.splitext(video.file_name)[0]
+            }
+
+        folder_params = \
+            {
+                'sublanguageid': languages,
+                'query': os.path.basename(video.directory)
+            }
+
+        return [hash_params, imdb_params, tag_params,
+                file_params, folder_params]
+
+    def _match_rank(self, matched_by):
+        return self.match_ranking.index(matched_by) \
+            if matched_by in self.match_ranking else len(self.match_ranking)
+
+    def _rank_matches(self, data):
+        # Keep a single entry per subtitle file, matched by the best strategy
+        def rank(sub):
+            return self._match_rank(sub['MatchedBy'])
+
+        best = OrderedDict()
+        for sub in data:
+            current = best.get(sub['IDSubtitleFile'])
+            if current is None or rank(sub) < rank(current):
+                best[sub['IDSubtitleFile']] = sub
+        return sorted(best.values(), key=rank)
+
+    def _parse_results(self, video, data):
+        # Returns the subtitles as SubResults grouped by language, in a
+        # single pass over the data
+        found = dict((lang, []) for lang in self.language)
+        for sub in data:
+            subs = found.get(sub['SubLanguageID'])
+            if subs is not None:
+                subs.append(SubResult(
+                    video.id,
+                    file_name=sub['SubFileName'],
+                    download_id=int(sub['IDSubtitleFile']),
+                    lang_id=sub['ISO639'],
+                    language=sub['LanguageName'],
+                    rating=float(sub['SubRating']),
+                    is_HD=sub['SubHD'] == '1',
+                    is_HI=sub['SubHearingImpaired'] == '1',
+                    download_count=int(sub['SubDownloadsCnt']),
+                    fps=float(sub['MovieFPS']),
+                    matched_by=sub['MatchedBy']))
+
+        results = dict()
+        for lang in self.language:
+            if not found[lang]:
+                continue
+            # Best matches first, most downloaded first
+            results[lang] = SubResults(sorted(
+                found[lang], key=lambda x: (self._match_rank(x.matched_by),
+                                            -x.download_count)))
+            log.info("Found {0} '{1}' subtitles for '{2}'".format(
+                len(results[lang]), lang, video.title))
+            if log.getLogger().isEnabledFor(log.DEBUG):
+                for index, s in enumerate(results[lang]):
+                    log.debug('{0:0>2}. {1} [[ ID: {2} - Download Count: '
+                              '{3} ]]'.format(index + 1, s.file_name,
+                                              s.download_id,
+                                              s.download_count))
+        return results
+
+    @classmethod
+    def _save_subtitles(cls, batch, data):
+        # Saves the subtitles in a DownloadSubtitles response next to their
+        # videos, and in the subtitle store. Returns the path of each saved
+        # subtitle by video path and download ID
+        saved = dict()
+        for sub in data or []:
+            video, sub_result = batch[int(sub['idsubtitlefile'])]
+            sub_filename = subtitle_path(video.full_path, sub_result.lang_id)
+            try:
+                is_utf8 = None
+                if cls.subtitle_store is not None:
+                    cls.subtitle_store.put(sub_result.download_id,
+                                           sub['data'])
+                    is_utf8 = cls.subtitle_store.save(
+                        sub_result.download_id, sub_filename)
+                if is_utf8 is None:
+                    is_utf8 = write_subtitle(sub['data'], sub_filename)
+                if not is_utf8:
+                    log.warning("'{0}' is not UTF-8 encoded, saved it "
+                                "without converting it".format(sub_filename))
+                saved[video.full_path, sub_result.download_id] = sub_filename
+            except (binascii.Error, zlib.error):
+                log.error("Error: Could not decompress subtitle "
+                          "{0}".format(sub_result.download_id))
+        return saved
+
+    @classmethod
+    def _from_store(cls, downloads):
+        # Saves the subtitles that are in the subtitle store from there.
+        # Returns the path of each saved subtitle by video path and download
+        # ID, and the downloads that are left
+        if cls.subtitle_store is None:
+            return dict(), downloads
+        saved = dict()
+        left = []
+        for video, sub_result in downloads:
+            sub_filename = subtitle_path(video.full_path, sub_result.lang_id)
+            is_utf8 = cls.subtitle_store.save(sub_result.download_id,
+                                              sub_filename)
+            subtitle_store_lookups.inc('miss' if is_utf8 is None else 'hit')
+            if is_utf8 is None:
+                left.append((video, sub_result))
+                continue
+            if not is_utf8:
+                log.warning("'{0}' is not UTF-8 encoded, saved it "
+                            "without converting it".format(sub_filename))
+            saved[video.full_path, sub_result.download_id] = sub_filename
+        return saved, left
+
+    @classmethod
+    def _split_repeats(cls, downloads):
+        # Splits off the downloads of a subtitle that's downloaded for
+        # another video already, which are saved by _save_repeats once
+        # that's done
+        first = []
+        repeats = []
+        download_ids = set()
+        for video, sub_result in downloads:
+            if sub_result.download_id in download_ids:
+                repeats.append((video, sub_result))
+            else:
+                download_ids.add(sub_result.download_id)
+                first.append((video, sub_result))
+        return first, repeats
+
+    @classmethod
+    def _save_repeats(cls, repeats, saved):
+        # Saves the repeats from the subtitle store, or else copies the
+        # subtitle that was saved for the first video. Returns the path of
+        # each saved subtitle by video path and download ID
+        sources = {download_id: path
+                   for (_, download_id), path in saved.items()}
+        found, left = cls._from_store(repeats)
+        for video, sub_result in left:
+            source = sources.get(sub_result.download_id)
+            if source is None:
+                continue
+            sub_filename = subtitle_path(video.full_path, sub_result.lang_id)
+            if os.path.abspath(source) != os.path.abspath(sub_filename):
+                try:
+                    shutil.copyfile(source, sub_filename)
+                except OSError:
+                    log.exception("Error: Could not save '{0}'"
+                                  .format(sub_filename))
+                    continue
+            found[video.full_path, sub_result.download_id] = sub_filename
+        return found
+
+
+class OSHandler(OSClient):
+    """"Provides the connection to and communication with the
+    OpenSubtitles server using XML RPC"""
+
+    # Maximum number of connections to OpenSubtitles, and the number of
+    # seconds after which a call to OpenSubtitles is given up on
+    pool_size = 4
+    timeout = 30
+
+    # Shared TokenStore, set up from config.json
+    token_store = None
+    # Seconds between updates of the session's expiry in the token store
+    touch_interval = 60
+
+    def __init__(self, server_url=None):
+        # Nothing is sent to OpenSubtitles until it's needed
+        if server_url is not None:
+            self.server_url = server_url
+        self.xml_rpc = ServerPool(self.server_url, self.pool_size,
+                                  self.timeout)
+        # Every call to OpenSubtitles goes through the scheduler
+        self.scheduler = RequestScheduler(self.xml_rpc)
+        self.language = []
+        self.user_name = None
+        self.hash = None
+        self.user_token = None
+        self.__logged_in = False
+        # The keep-alive call can take a while, so it gets its own thread
+        self.keep_alive_timer = TimedEvent(
+            900, self._no_operation, autostart=False, threaded=True)
+        self.keep_alive = False
+        self.server_info = None
+        self._login_lock = Lock()
+        self._touched = 0
 
     @property
     def logged_in(self):
         # Resets the timer that keeps the connection alive
         self.keep_alive_timer.reset()
         self.keep_alive = True
+        if self.__logged_in and self.token_store is not None and \
+                time.monotonic() - self._touched > self.touch_interval:
+            self._touched = time.monotonic()
+            self.token_store.touch(self.user_name, self.user_token)
         return self.__logged_in
 
     @logged_in.setter
@@ -53,62 +306,100 @@ class OSHandler(object):
         self.keep_alive_timer.start() if \
             value else self.keep_alive_timer.stop()
 
-    def _extract_data(self, key):
-        return self.query_result.get(key) if \
-            self.query_result['status'].split()[0] == '200' else None
+    @property
+    def has_session(self):
+        # Whether there's a session, without counting as activity the way
+        # checking logged_in does
+        return self.__logged_in
+
+    def get_server_info(self):
+        self.server_info = self.scheduler.ServerInfo()
+        return self.server_info
+
+    def known_languages(self):
+        # The user's languages without logging in: those of the current or
+        # stored session, or English if there's neither
+        if self.language:
+            return self.language
+        stored = self.token_store.get(self.user_name) \
+            if self.token_store is not None else None
+        return stored[1] if stored is not None else ['eng']
 
     def login(self):
+        # Raises ValueError if the credentials are wrong, and OSError or
+        # ProtocolError if OpenSubtitles can't be reached
+        with self._login_lock:
+            self._login()
+
+    def _login(self):
         if not self.logged_in:
+            if self._reuse_session():
+                return
             log.info("Logging in...")
             try:
-                self.query_result = self.xml_rpc.LogIn(
-                                        self.user_name, self.hash,
-                                        self.language, self.user_agent)
-                if not self._extract_data('token'):
-                    raise ValueError("Error: Login unsuccessful. "
-                                     "Please check your login information"
-                                     "and try again.")
-                self.user_token = self._extract_data('token')
-                try:
-                    self.language = \
-                        (self._extract_data('data')['UserPreferedLanguages']) \
-                        .split(",")
-                # Set language to English if no preferred languages set in OS
-                except KeyError:
-                    self.language = {'eng'}
-                log.info("""Login successful. Token set to "{t:s}","""
-                         " preferred language for subtitles set to '{lang:s}'."
-                         .format(t=self.user_token,
-                                 lang=",".join(self.language)))
-                self.query_result = None
+                result = self.scheduler.LogIn(
+                    self.user_name, self.hash,
+                    self.language, self.user_agent)
+                self._read_login(result)
                 self.logged_in = True
+                if self.token_store is not None:
+                    self._touched = time.monotonic()
+                    self.token_store.put(self.user_name, self.user_token,
+                                         self.language)
             except ValueError as e:
-                log.exception(e.args[0])
-                sys.exit(1)
-            except TimeoutError:
-                # Throw exception if we can't connect to OpenSubtitles
+                log.error(e.args[0])
+                raise
+            except (OSError, ProtocolError, ResponseNotReady):
                 log.exception("Error: Could not connect to OpenSubtitles.org")
-                sys.exit(1)
+                raise
         else:
             log.info("Already logged in")
 
+    def _reuse_session(self):
+        # Uses the session of another worker, or from before a restart
+        stored = self.token_store.get(self.user_name) \
+            if self.token_store is not None else None
+        if stored is None:
+            return False
+        token, languages, expires = stored
+        # Check the session is still valid, unless it was used just now
+        if time.time() + self.token_store.lifetime - expires > \
+                self.touch_interval:
+            result = self.scheduler.NoOperation(token)
+            if not self._extract_data(result, 'status'):
+                self.token_store.delete(self.user_name, token)
+                return False
+            self.token_store.touch(self.user_name, token)
+        self._touched = time.monotonic()
+        self.user_token = token
+        self.language = languages
+        self.logged_in = True
+        log.info("Using the existing session")
+        return True
+
+    def _end_session(self):
+        self.logged_in = False
+        self.keep_alive = False
+        self.user_token = None
+
     def logout(self):
         log.info("Logging out...")
         try:
             if self.logged_in:
-                self.query_result = self.xml_rpc.LogOut(self.user_token)
-                if self._extract_data('status'):
-                    self.logged_in = False
-                    self.user_token = None
-                    self.keep_alive = False
+                result = self.scheduler.LogOut(self.user_token)
+                if self._extract_data(result, 'status'):
+                    if self.token_store is not None:
+                        self.token_store.delete(self.user_name,
+                                                self.user_token)
+                    self._end_session()
                     log.info("Successfully logged out."
                              " Thanks for using Subtle!")
                 else:
                     log.error("Error: {}".format(
-                        self._extract_data('status')))
+                        self._extract_data(result, 'status')))
             else:
                 log.info("Already logged out")
-        except (TimeoutError, ProtocolError, ResponseNotReady):
+        except (OSError, ProtocolError, ResponseNotReady):
             self.logged_in = False
             self.keep_alive = False
             log.warn(
@@ -119,141 +410,115 @@ class OSHandler(object):
             if self.__logged_in:
                 if self.keep_alive:
                     self.keep_alive = False
-                    self.query_result = \
-                        self.xml_rpc.NoOperation(self.user_token)
-                    if self._extract_data('status').split()[0] != '200':
-                        self.logged_in = False
+                    result = self.scheduler.NoOperation(self.user_token)
+                    if result['status'].split()[0] != '200':
+                        if self.token_store is not None:
+                            self.token_store.delete(self.user_name,
+                                                    self.user_token)
+                        self._end_session()
                         log.warn("Your session timed out, please  "
                                  "login before doing anything else")
                     else:
                         log.info("Staying alive...")
+                elif self.token_store is not None:
+                    # Other workers might still use the session, so leave
+                    # it to expire on its own
+                    self._end_session()
                 else:
                     self.logout()
-        except (TimeoutError, ProtocolError, ResponseNotReady):
+        except (OSError, ProtocolError, ResponseNotReady):
             self.logged_in = False
             self.keep_alive = False
             log.warn(
                 "Could not connect to OpenSubtitles; you've been logged out.")
 
     def get_video_info(self, video):
-        if self.logged_in and video is not None:
+        if video is not None:
+            return self.get_video_info_many([video])
+
+    def get_video_info_many(self, videos):
+        # Looks up many videos with as few CheckMovieHash calls as possible
+        videos = [v for v in videos if v is not None]
+        if self.logged_in and len(videos) > 0:
             try:
-                    # Send query and return result
-                    self.query_result = self.xml_rpc.CheckMovieHash(
-                        self.user_token, [video.file_hash])
-                    if len(self._extract_data('data')[video.file_hash]) > 0:
-                        data = self._extract_data('data')[video.file_hash]
-                        video.imdb_id = data['MovieImdbID']
-                        video.title = data['MovieName']
-                        video.year = data['MovieYear']
-                    else:
-                        video.title = video.file_name
+                for i in range(0, len(videos), self.check_hash_batch_size):
+                    batch = videos[i:i + self.check_hash_batch_size]
+                    # Send query and map the results back onto each video
+                    result = self.scheduler.CheckMovieHash(
+                        self.user_token,
+                        sorted(set(video.file_hash for video in batch)))
+                    found = self._extract_data(result, 'data') or {}
+                    for video in batch:
+                        self._set_video_info(video, found.get(video.file_hash))
 
             except TimeoutError:
                 # Catch exception if we can't connect to OpenSubtitles
                 log.error("Error: Could not connect to OpenSubtitles.org")
                 return None
 
-            except TypeError:
+            except (TypeError, AttributeError):
                 log.error("Error: Are you sure you're using a Video instance?")
                 return None
 
+    def _search_sequential(self, request_params, limit):
+        # Try each param dictionary until we find a subtitle match
+        for params in request_params:
+            result = self.scheduler.SearchSubtitles(
+                self.user_token, [params], {'limit': limit})
+            data = self._extract_data(result, 'data')
+            if data:
+                return data
+        return []
+
+    def _search_combined(self, request_params, limit):
+        # Send every strategy in a single SearchSubtitles call
+        result = self.scheduler.SearchSubtitles(
+            self.user_token, request_params, {'limit': limit})
+        return self._extract_data(result, 'data') or []
+
+    def _search_concurrent(self, request_params, limit):
+        # Send every strategy in its own call, all at the same time, with
+        # the priority of the calling thread
+        priority = self.scheduler.current_priority
+
+        def search(params):
+            with self.scheduler.priority(priority):
+                result = self.scheduler.SearchSubtitles(
+                    self.user_token, [params], {'limit': limit})
+            return self._extract_data(result, 'data') or []
+
+        with ThreadPoolExecutor(max_workers=len(request_params)) as pool:
+            return [sub for data in pool.map(search, request_params)
+                    for sub in data]
+
     def search_subtitles(self, video, limit=500):
+        # Returns the matching subtitles as SubResults grouped by language,
+        # an empty dict if the search didn't find any, or None if it failed
         if self.logged_in and video is not None and limit <= 500:
             try:
                 log.info("Looking for subtitles for '{0}'..."
                          .format(video.file_name))
-                # Set params
-                languages = ','.join(self.language)
-                hash_params = \
-                    {
-                        'sublanguageid': languages,
-                        'moviehash': video.file_hash,
-                        'moviebytesize': str(video.file_size)
-                    }
-
-                imdb_match = video.imdb_id if video.imdb_id is not 0 else None
-                imdb_params = \
-                    {
-                        'sublanguageid': languages,
-                        'imdbid': imdb_match
-                    }
-
-                tag_params = \
-                    {
-                        'sublanguageid': languages,
-                        'tag': video.file_name
-                    }
-
-                file_params = \
-                    {
-                        'sublanguageid': languages,
-                        'query': os.path.splitext(video.file_name)[0]
-                    }
-
-                folder_params = \
-                    {
-                        'sublanguageid': languages,
-                        'query': os.path.basename(video.directory)
-                    }
-
-                request_params = \
-                    [hash_params, imdb_params, tag_params,
-                     file_params, folder_params]
-                request_count = 0
-                first_try = True
-
-                # Try each param dictionary until we finda subtitle match
-                while (first_try or len(self.query_result['data']) == 0) \
-                        and request_count < 5:
-                    first_try = False
-                    self.query_result = \
-                        self.xml_rpc.SearchSubtitles(
-                            self.user_token,
-                            [request_params[request_count]],
-                            {'limit': limit})
-                    request_count += 1
+                request_params = self._search_params(video)
+
+                if self.search_mode == 'sequential':
+                    data = self._search_sequential(request_params, limit)
+                else:
+                    # Leave out the IMDb query if there's no IMDb ID to use
+                    request_params = [params for params in request_params
+                                      if params.get('imdbid', True)]
+                    if self.search_mode == 'concurrent':
+                        data = self._search_concurrent(request_params, limit)
+                    else:
+                        data = self._search_combined(request_params, limit)
+                    data = self._rank_matches(data)
 
                 # Return matching subs as SubResults grouped by language
-                if len(self.query_result['data']) > 0:
-                    results = dict()
-                    for lang in self.language:
-                        log.info(
-                            "The following '{0}' subtitles are "
-                            "available for '{1}':"
-                            .format(lang, video.title))
-                        log.info("=" * 10)
-                        for sub in self._extract_data('data'):
-                            if sub['SubLanguageID'] == lang:
-                                if lang not in results:
-                                    results[lang] = []
-                                s = SubResult(video.id)
-                                s.file_name = sub['SubFileName']
-                                s.download_id = int(sub['IDSubtitleFile'])
-                                s.lang_id = sub['ISO639']
-                                s.language = sub['LanguageName']
-                                s.rating = float(sub['SubRating'])
-                                s.is_HD = sub['SubHD'] is '1'
-                                s.is_HI = sub['SubHearingImpaired'] is '1'
-                                s.download_count = int(sub['SubDownloadsCnt'])
-                                s.fps = float(sub['MovieFPS'])
-                                s.matched_by = sub['MatchedBy']
-                                results[lang].append(s)
-                                log.info(
-                                    '{0:0>2}. {1} '
-                                    '[[ ID: {2} - Download Count: {3} ]]'
-                                    .format(
-                                        (self._extract_data('data'))
-                                        .index(sub) + 1,
-                                        s.file_name, s.download_id,
-                                        s.download_count))
-                        results[lang].sort(
-                            key=lambda x: x.download_count, reverse=True)
-                        log.info('')
-                    return results
+                if len(data) > 0:
+                    with phase('parse'):
+                        return self._parse_results(video, data)
 
                 log.info('Sorry - could not find any matching subtitles')
-                return None
+                return dict()
 
             except TimeoutError:
                 log.error('Error: Could not connect to OpenSubtitles.org')
@@ -266,31 +531,37 @@ class OSHandler(object):
                 return None
 
     def download_subtitle(self, video, sub_result):
-        if self.logged_in and sub_result is not None:
+        if sub_result is not None:
+            return self.download_subtitles([(video, sub_result)]) \
+                .get((video.full_path, sub_result.download_id))
+
+    def download_subtitles(self, downloads):
+        # Downloads a list of (Video, SubResult) pairs with as few
+        # DownloadSubtitles calls as possible, leaving out those in the
+        # subtitle store. Returns the path of each subtitle that was saved,
+        # by video path and download ID, so a subtitle that's downloaded for
+        # more than one video is listed once for every video
+        downloads, repeats = self._split_repeats(downloads)
+        saved, downloads = self._from_store(downloads)
+        if len(downloads) > 0 and self.logged_in:
             try:
-                sub_id = sub_result.download_id
-                self.query_result = self.xml_rpc.DownloadSubtitles(
-                    self.user_token, [sub_id])
-                sub = zlib.decompress(base64.b64decode(
-                    self._extract_data('data')[0]['data']), 16 +
-                    zlib.MAX_WBITS).decode('utf-8')
-                sub_filename = "{path}.{lang}.{ext}".format(
-                    path=os.path.join(video.directory, video.file_name[:-4]),
-                    lang=sub_result.lang_id, ext='srt')
-                sub_file = open(
-                    sub_filename, 'w', encoding='utf-8', newline='')
-                sub_file.write(sub)
-                sub_file.close()
+                for i in range(0, len(downloads), self.download_batch_size):
+                    batch = OrderedDict(
+                        (sub_result.download_id, (video, sub_result))
+                        for video, sub_result in
+                        downloads[i:i + self.download_batch_size])
+                    result = self.scheduler.DownloadSubtitles(
+                        self.user_token, list(batch))
+                    saved.update(self._save_subtitles(
+                        batch, self._extract_data(result, 'data')))
 
             except TimeoutError:
                 log.error('Error: Could not connect to OpenSubtitles.org')
 
-            except UnicodeDecodeError:
-                log.error(
-                    'Error: Could not decode downloaded subtitle to UTF-8'
-                    ' character encoding')
-
-            except TypeError:
+            except (TypeError, AttributeError):
                 log.exception(
                     'Error: Are you sure you are using Video and SubResult'
                     ' instances as parameters?')
+        if repeats:
+            saved.update(self._save_repeats(repeats, saved))
+        return saved
@@ -0,0 +1,353 @@
+import json
+import os
+import queue
+import time
+from threading import Event, Lock, Thread
+from subtle.components import directory_subtitles, missing_languages
+from subtle.scanner import iter_videos
+from subtle.scheduler import BULK
+from subtle.selection import pick_best, video_fps
+from subtle.types import Video
+from web import log
+
+# Tells the workers of a stage that nothing more is coming
+_DONE = object()
+
+
+class Checkpoint(object):
+    """
+    The videos a batch job is done with, appended to a file one at a time,
+    so an interrupted job can carry on where it left off
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.done = set()
+        self._lock = Lock()
+        self._file = None
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as checkpoint:
+                for line in checkpoint:
+                    try:
+                        self.done.add(json.loads(line)['path'])
+                    except (ValueError, KeyError, TypeError):
+                        # The last line can be cut short by an interruption
+                        pass
+
+    def __contains__(self, path):
+        return path in self.done
+
+    def add(self, path, saved):
+        with self._lock:
+            self.done.add(path)
+            if not self.path:
+                return
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(json.dumps({'path': path, 'saved': saved}) +
+                             '\n')
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class Stage(object):
+    """
+    One step of a Pipeline. Its workers take batches of up to 'batch_size'
+    items from a queue of at most 'max_queued' items, and pass everything
+    'function' returns for a batch on to the next stage. A batch is sent
+    off once it's full, or when no more items came in for 'batch_wait'
+    seconds
+    """
+
+    def __init__(self, name, function, workers=1, max_queued=100,
+                 batch_size=1, batch_wait=0.5):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue = queue.Queue(max(max_queued, batch_size))
+        self.received = 0
+        self.sent = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.started = None
+        self.finished = None
+        self._running = workers
+        self._lock = Lock()
+
+    @property
+    def rate(self):
+        # Items passed on per second, while the stage was running
+        if self.started is None:
+            return 0.0
+        elapsed = (self.finished or time.time()) - self.started
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+    def __str__(self):
+        return "{0} {1}".format(self.name, self.sent)
+
+
+class Pipeline(object):
+    """
+    Runs stages at the same time, each with its own worker threads, so
+    slow stages overlap with the others. Every stage waits when the queue
+    of the next one is full, which keeps memory use bounded however many
+    items go through. 'initializer' is called in every worker thread
+    before it starts
+    """
+
+    def __init__(self, stages, initializer=None, on_progress=None):
+        self.stages = stages
+        self.initializer = initializer
+        self.on_progress = on_progress
+        self.started = None
+        self.finished = False
+        self._stop = Event()
+
+    def _put(self, stage, item):
+        # Returns False if the pipeline stopped before there was room
+        while not self._stop.is_set():
+            try:
+                stage.queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _take(self, stage):
+        # Waits for an item, then takes what else arrives in time to fill a
+        # batch. Returns None once the stage is done or the pipeline stopped
+        while True:
+            if self._stop.is_set():
+                return None
+            try:
+                item = stage.queue.get(timeout=1)
+                break
+            except queue.Empty:
+                pass
+        if item is _DONE:
+            return None
+        batch = [item]
+        while len(batch) < stage.batch_size:
+            try:
+                item = stage.queue.get(timeout=stage.batch_wait)
+            except queue.Empty:
+                break
+            if item is _DONE:
+                # Leave it for the next take, nothing follows it
+                stage.queue.put(item)
+                break
+            batch.append(item)
+        return batch
+
+    def _work(self, index):
+        stage = self.stages[index]
+        next_stage = self.stages[index + 1] \
+            if index + 1 < len(self.stages) else None
+        if self.initializer is not None:
+            self.initializer()
+        while True:
+            batch = self._take(stage)
+            if batch is None:
+                break
+            started = time.time()
+            with stage._lock:
+                if stage.started is None:
+                    stage.started = started
+                stage.received += len(batch)
+            sent = 0
+            try:
+                for output in stage.function(batch):
+                    sent += 1
+                    if next_stage is not None and \
+                            not self._put(next_stage, output):
+                        break
+            except (OSError, ValueError) as e:
+                log.warning("{0}: {1}".format(stage.name, e))
+                with stage._lock:
+                    stage.failed += len(batch)
+            except Exception:
+                log.exception("Error: {0} failed".format(stage.name))
+                with stage._lock:
+                    stage.failed += len(batch)
+            with stage._lock:
+                stage.sent += sent
+                stage.busy += time.time() - started
+        with stage._lock:
+            stage._running -= 1
+            last = stage._running == 0
+            if last:
+                stage.finished = time.time()
+        if last and next_stage is not None:
+            for number in range(next_stage.workers):
+                self._put(next_stage, _DONE)
+
+    def run(self, items):
+        # Sends items through every stage, and returns once they're all
+        # through, or stop() was called
+        self.started = time.time()
+        self._stop.clear()
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for number in range(stage.workers):
+                thread = Thread(target=self._work, args=(index,), daemon=True,
+                                name='{0}-{1}'.format(stage.name, number + 1))
+                thread.start()
+                threads.append(thread)
+        for item in items:
+            if not self._put(self.stages[0], item):
+                break
+        for number in range(self.stages[0].workers):
+            self._put(self.stages[0], _DONE)
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1)
+                if self.on_progress is not None:
+                    self.on_progress(self)
+        self.finished = True
+        if self.on_progress is not None:
+            self.on_progress(self)
+
+    def stop(self):
+        self._stop.set()
+
+    def report(self):
+        # The throughput of every stage, as lines of a table
+        lines = ['{0:<10} {1:>7} {2:>8} {3:>8} {4:>7} {5:>9} {6:>8}'.format(
+            'stage', 'workers', 'received', 'sent', 'failed', 'busy s',
+            'sent/s')]
+        for stage in self.stages:
+            lines.append(
+                '{0:<10} {1:>7} {2:>8} {3:>8} {4:>7} {5:>9.1f} {6:>8.1f}'
+                .format(stage.name, stage.workers, stage.received,
+                        stage.sent, stage.failed, stage.busy, stage.rate))
+        return lines
+
+    def __str__(self):
+        return ', '.join(str(stage) for stage in self.stages)
+
+
+class BatchJob(object):
+    """
+    Fetches the best subtitle in each of the user's languages for every
+    video below a root directory that doesn't have one yet. The videos go
+    through a Pipeline that scans the tree, hashes the videos, looks them
+    up in batches, searches for their subtitles, picks the best ones and
+    downloads those in batches. Videos that are done are recorded in the
+    checkpoint, and skipped when the job is run again
+    """
+
+    def __init__(self, os_handler, root, checkpoint=None, hash_workers=4,
+                 search_workers=2, max_queued=100, is_HD=None, is_HI=None,
+                 on_progress=None):
+        self.os_handler = os_handler
+        # Paths in the checkpoint don't depend on the working directory
+        self.root = os.path.abspath(root)
+        self.checkpoint = Checkpoint(checkpoint)
+        self.is_HD = is_HD
+        self.is_HI = is_HI
+        self.skipped = 0
+        self.pipeline = Pipeline([
+            Stage('scan', self._scan, 1, max_queued),
+            Stage('hash', self._hash, hash_workers, max_queued),
+            Stage('lookup', self._lookup, 1, max_queued,
+                  batch_size=os_handler.check_hash_batch_size,
+                  batch_wait=1.0),
+            Stage('search', self._search, search_workers, max_queued),
+            Stage('score', self._score, 1, max_queued),
+            Stage('download', self._download, 1, max_queued,
+                  batch_size=os_handler.download_batch_size)],
+            # Let requests from the web interface go first
+            initializer=lambda: os_handler.scheduler.set_priority(BULK),
+            on_progress=on_progress)
+
+    def _scan(self, roots):
+        # iter_videos yields the videos in a directory one after the other,
+        # so each directory's subtitles are only listed once
+        directory = subtitles = None
+        for root in roots:
+            for path in iter_videos(root):
+                if os.path.dirname(path) != directory:
+                    directory = os.path.dirname(path)
+                    subtitles = self._list_subtitles(directory)
+                if path in self.checkpoint or not missing_languages(
+                        path, self.os_handler.language, subtitles):
+                    self.skipped += 1
+                else:
+                    yield path
+
+    @staticmethod
+    def _list_subtitles(directory):
+        try:
+            return directory_subtitles(os.listdir(directory))
+        except OSError:
+            # Look for each video's subtitles instead
+            return None
+
+    def _hash(self, paths):
+        for path in paths:
+            video = Video(path)
+            if video.file_hash is None or len(video.file_hash) != 16:
+                raise ValueError("Could not hash '{0}'".format(path))
+            yield video
+
+    def _lookup(self, videos):
+        self.os_handler.get_video_info_many(videos)
+        return videos
+
+    def _search(self, videos):
+        for video in videos:
+            results = self.os_handler.search_subtitles(video)
+            if results is None:
+                # Counted as failed, and not checkpointed so it's tried again
+                raise TimeoutError("Could not search for subtitles for "
+                                   "'{0}'".format(video.full_path))
+            yield video, results
+
+    def _score(self, searches):
+        for video, results in searches:
+            fps = video_fps(results)
+            picks = []
+            for lang in missing_languages(video.full_path,
+                                          self.os_handler.language):
+                best = pick_best(results.get(lang),
+                                 self.os_handler.match_ranking, fps,
+                                 self.is_HD, self.is_HI)
+                if best is not None:
+                    picks.append(best)
+            if picks:
+                yield video, picks
+            else:
+                # Nothing to download, there's no need to search again
+                self.checkpoint.add(video.full_path, 0)
+
+    def _download(self, videos):
+        saved = self.os_handler.download_subtitles(
+            [(video, pick) for video, picks in videos for pick in picks])
+        for video, picks in videos:
+            paths = [saved[video.full_path, pick.download_id]
+                     for pick in picks
+                     if (video.full_path, pick.download_id) in saved]
+            if paths:
+                self.checkpoint.add(video.full_path, len(paths))
+                for sub_filename in paths:
+                    log.info("Saved '{0}'".format(sub_filename))
+                    yield sub_filename
+            else:
+                log.warning("Could not download subtitles for '{0}'"
+                            .format(video.full_path))
+
+    def run(self):
+        try:
+            self.pipeline.run([self.root])
+        finally:
+            self.checkpoint.close()
+
+    def stop(self):
+        self.pipeline.stop()
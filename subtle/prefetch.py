@@ -0,0 +1,126 @@
+import os
+import queue
+import time
+from collections import deque
+from threading import Lock, Thread
+from subtle.metrics import result_cache_lookups
+from subtle.scheduler import BULK
+from subtle.types import Video
+from web import log
+
+
+class Prefetcher(object):
+    """
+    Hashes and looks up videos on a background thread before they're
+    selected, and puts the results in the shared ResultCache. Only
+    'budget' requests to OpenSubtitles are made per 'period' seconds, so
+    prefetching can't use up the request quota. With a RateLimitStore as
+    'store', that budget is shared by every worker process
+    """
+
+    # Most requests a single search can take, by search mode: one for each
+    # of the five strategies, except when they're combined into one call
+    search_cost = {'sequential': 5, 'combined': 1, 'concurrent': 5}
+    # Name of the shared budget in the store
+    bucket = 'prefetch'
+
+    def __init__(self, os_handler, result_cache, budget=100, period=3600,
+                 batch_size=10, max_queued=200, store=None):
+        self.os_handler = os_handler
+        self.result_cache = result_cache
+        self.budget = budget
+        self.period = period
+        self.store = store
+        self.batch_size = batch_size
+        self._queue = queue.Queue(max_queued)
+        self._queued = set()
+        self._requests = deque()
+        self._lock = Lock()
+        self._thread = None
+        self._pid = None
+
+    def _start(self):
+        # Start the worker on first use, in every forked worker process
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._queue = queue.Queue(self._queue.maxsize)
+            self._queued = set()
+            self._thread = Thread(target=self._run, name='Prefetcher',
+                                  daemon=True)
+            self._thread.start()
+
+    def enqueue(self, paths):
+        with self._lock:
+            self._start()
+            for path in paths:
+                if path in self._queued:
+                    continue
+                try:
+                    self._queue.put_nowait(path)
+                    self._queued.add(path)
+                except queue.Full:
+                    break
+
+    def _spend(self, requests):
+        # Returns whether the requests fit in the budget, and spends them
+        if self.store is not None:
+            return self.store.take(self.bucket, self.budget, self.period,
+                                   requests) == 0
+        now = time.time()
+        while self._requests and self._requests[0] <= now - self.period:
+            self._requests.popleft()
+        if len(self._requests) + requests > self.budget:
+            return False
+        self._requests.extend([now] * requests)
+        return True
+
+    def _next_batch(self):
+        paths = [self._queue.get()]
+        while len(paths) < self.batch_size:
+            try:
+                paths.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        with self._lock:
+            self._queued.difference_update(paths)
+        return paths
+
+    def _run(self):
+        # Prefetching is only worth it when nobody else is waiting
+        self.os_handler.scheduler.set_priority(BULK)
+        while True:
+            paths = self._next_batch()
+            try:
+                self._prefetch(paths)
+            except Exception:
+                log.exception("Error: Could not prefetch subtitles")
+
+    def _is_cached(self, video, languages):
+        cached = self.result_cache.get(video, languages) is not None
+        result_cache_lookups.inc('hit' if cached else 'miss')
+        return cached
+
+    def _prefetch(self, paths):
+        # Don't log in, or keep the session alive, just to prefetch, and
+        # skip what's cached already
+        if not self.os_handler.has_session:
+            return
+        videos = [Video(path) for path in paths]
+        languages = self.os_handler.language
+        videos = [video for video in videos
+                  if self.result_cache.cacheable(video) and
+                  not self._is_cached(video, languages)]
+        if not videos or not self._spend(1):
+            return
+        self.os_handler.get_video_info_many(videos)
+        cost = self.search_cost.get(self.os_handler.search_mode, 5)
+        for video in videos:
+            if not self._spend(cost):
+                log.info("Prefetch budget used up, skipping the rest")
+                return
+            results = self.os_handler.search_subtitles(video)
+            if results is None:
+                # Leave it to the user, rather than cache a failed search
+                log.info("Could not prefetch subtitles, skipping the rest")
+                return
+            self.result_cache.put(video, languages, results)
@@ -0,0 +1,125 @@
+import cProfile
+import itertools
+import os
+import time
+from threading import Lock, local
+from web import log
+
+# Whether phases are timed at all, only set when profiling is configured
+enabled = False
+_local = local()
+
+
+class _NoPhase(object):
+    """Stands in for a Phase when nothing is being profiled"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_no_phase = _NoPhase()
+
+
+class Phase(object):
+    """Adds the time spent in a with block to the current request's phase"""
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings[self.name] = self.timings.get(self.name, 0.0) + \
+            time.perf_counter() - self.started
+        return False
+
+
+def phase(name):
+    # Times a part of the request being profiled on this thread, if any
+    if not enabled:
+        return _no_phase
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        return _no_phase
+    return Phase(timings, name)
+
+
+class RequestProfiler(object):
+    """
+    Runs requests under cProfile and writes one profile per request to
+    'directory'. Only the newest 'max_files' profiles are kept, up to
+    'max_size' bytes altogether
+    """
+
+    def __init__(self, directory, max_files=100, max_size=100 * 1024 ** 2):
+        self.directory = directory
+        self.max_files = max_files
+        self.max_size = max_size
+        self._lock = Lock()
+        self._counter = itertools.count(1)
+
+    def start(self):
+        # Returns the profiler for the request, or None if it can't run
+        _local.timings = dict()
+        _local.started = time.perf_counter()
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Only one profiler can run at a time in some Python versions
+            return None
+        return profiler
+
+    def stop(self, profiler, name):
+        # Returns the time spent in each phase, and in the whole request
+        timings = getattr(_local, 'timings', None) or dict()
+        timings['total'] = time.perf_counter() - _local.started
+        _local.timings = None
+        if profiler is not None:
+            profiler.disable()
+            self._save(profiler, name)
+        return timings
+
+    def _save(self, profiler, name):
+        with self._lock:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(
+                    self.directory, '{0}-{1}-{2}-{3}.prof'.format(
+                        time.strftime('%Y%m%d-%H%M%S'), os.getpid(),
+                        next(self._counter), name))
+                profiler.dump_stats(path)
+                self._rotate()
+            except OSError:
+                log.exception("Error: Could not save the profile of '{0}'"
+                              .format(name))
+
+    def _rotate(self):
+        # Removes the oldest profiles until the limits are met
+        profiles = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.prof') and entry.is_file():
+                stat = entry.stat()
+                profiles.append((stat.st_mtime, entry.path, stat.st_size))
+        profiles.sort()
+        size = sum(profile[2] for profile in profiles)
+        while profiles and (len(profiles) > self.max_files or
+                            size > self.max_size):
+            mtime, path, file_size = profiles.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= file_size
+
+
+def server_timing(timings):
+    # Formats phase timings as a Server-Timing header, in milliseconds
+    return ', '.join('{0};dur={1:.1f}'.format(name, seconds * 1000)
+                     for name, seconds in sorted(timings.items()))
@@ -0,0 +1,100 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from subtle.components import SUPPORTED_EXTENSIONS
+from subtle.types import Video
+from web import log
+
+
+def iter_videos(root):
+    """
+    Walks a directory tree with os.scandir and yields the path of every
+    supported video file, without collecting the whole tree first
+    """
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        sub_directories = []
+        try:
+            for entry in os.scandir(directory):
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if not entry.name.startswith('.'):
+                            sub_directories.append(entry.path)
+                    elif entry.name.endswith(SUPPORTED_EXTENSIONS) and \
+                            entry.is_file():
+                        yield entry.path
+                except OSError:
+                    log.warning("Could not read '{0}'".format(entry.path))
+        except OSError:
+            log.warning("Could not open directory '{0}'".format(directory))
+        # Visit sub directories in alphabetical order
+        pending.extend(sorted(sub_directories, reverse=True))
+
+
+class ScanProgress(object):
+    found = 0
+    hashed = 0
+    failed = 0
+    finished = False
+
+    def __init__(self):
+        self.started = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.started
+
+    @property
+    def rate(self):
+        # Hashed files per second
+        return self.hashed / self.elapsed if self.elapsed > 0 else 0.0
+
+    def __str__(self):
+        return "{0} found, {1} hashed, {2} failed ({3:.1f} files/s)" \
+            .format(self.found, self.hashed, self.failed, self.rate)
+
+
+class LibraryScanner(object):
+    """
+    Hashes every video below a root directory with a bounded pool of
+    worker threads, yielding each Video as soon as it has been hashed
+    """
+
+    def __init__(self, root, workers=8, on_progress=None):
+        self.root = root
+        self.workers = workers
+        self.on_progress = on_progress
+        self.progress = ScanProgress()
+
+    def scan(self):
+        self.progress = ScanProgress()
+        # Only keep a few files per worker in flight, so memory use doesn't
+        # depend on the size of the library
+        max_pending = self.workers * 4
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = set()
+            for path in iter_videos(self.root):
+                self.progress.found += 1
+                pending.add(pool.submit(Video, path))
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    yield from self._collect(done)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from self._collect(done)
+        self.progress.finished = True
+        if self.on_progress is not None:
+            self.on_progress(self.progress)
+
+    def _collect(self, done):
+        for future in done:
+            video = future.result()
+            if video.file_hash is not None and len(video.file_hash) == 16:
+                self.progress.hashed += 1
+                yield video
+            else:
+                self.progress.failed += 1
+                log.warning("Could not hash '{0}'".format(video.full_path))
+            if self.on_progress is not None:
+                self.on_progress(self.progress)
@@ -0,0 +1,375 @@
+import asyncio
+import random
+import socket
+import time
+from contextlib import contextmanager
+from http.client import ResponseNotReady
+from threading import Condition, Event, Lock, local
+from xmlrpc.client import ProtocolError
+from subtle.metrics import rpc_calls, rpc_coalesced, rpc_duration, \
+    rpc_errors, rpc_retries
+from subtle.profiling import phase
+from web import log
+
+# Request priorities, most urgent first
+INTERACTIVE = 0
+BACKGROUND = 1
+BULK = 2
+
+
+class _InFlight(object):
+    """A call that other threads are waiting for the result of"""
+
+    def __init__(self, priority, done=None):
+        self.priority = priority
+        self.done = done if done is not None else Event()
+        self.result = None
+        self.error = None
+
+
+class RequestScheduler(object):
+    """
+    Makes every call to OpenSubtitles through a ServerPool, at most 'rate'
+    calls per 'per' seconds. Threads that wait for a turn are served by
+    priority, so web requests go before background and bulk jobs. Calls
+    that fail because the server is busy or unreachable are retried after
+    a random, exponentially growing delay, and identical calls that are in
+    flight at the same time are only sent once, with the priority of the
+    most urgent caller. If a RateLimitStore is set as 'store', the calls of
+    every process that uses it count towards the same limit. Calls are made
+    just like with a ServerPool, e.g. scheduler.ServerInfo()
+    """
+
+    # Name of the shared bucket in the store
+    bucket = 'opensubtitles'
+
+    # Calls that don't change anything on the server, and can be shared
+    coalesced_methods = frozenset((
+        'ServerInfo', 'CheckMovieHash', 'SearchSubtitles',
+        'DownloadSubtitles'))
+    # HTTP and XML RPC status codes that mean the server is busy
+    retry_statuses = frozenset((429, 500, 502, 503, 504))
+    retry_errors = (ResponseNotReady, ConnectionError, TimeoutError,
+                    socket.timeout)
+
+    def __init__(self, pool, rate=40, per=10, max_retries=4, backoff=1.0,
+                 max_backoff=30):
+        self.pool = pool
+        self.rate = rate
+        self.per = per
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.store = None
+        self.retries = 0
+        self.coalesced = 0
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._waiting = [0, 0, 0]
+        self._condition = Condition()
+        self._in_flight = dict()
+        self._in_flight_lock = Lock()
+        self._local = local()
+
+    @property
+    def current_priority(self):
+        return getattr(self._local, 'priority', INTERACTIVE)
+
+    @contextmanager
+    def priority(self, priority):
+        # Makes the calls of the current thread with another priority
+        previous = self.current_priority
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def set_priority(self, priority):
+        # Sets the priority of every call the current thread makes
+        self._local.priority = priority
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(float(self.rate), self._tokens +
+                           (now - self._updated) * self.rate / self.per)
+        self._updated = now
+
+    def _take(self):
+        # Takes a token and returns 0, or returns how many seconds it will
+        # take until there is one. The local bucket is only used with the
+        # condition held, the store is asked without it
+        if self.store is not None:
+            return self.store.take(self.bucket, self.rate, self.per)
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) * self.per / self.rate
+
+    def _requeue(self, request, priority):
+        # Counts a waiting request under its new priority, if it was raised
+        if request.priority != priority:
+            self._waiting[priority] -= 1
+            priority = request.priority
+            self._waiting[priority] += 1
+        return priority
+
+    def _acquire(self, request):
+        # Waits until there's a token left and no thread with a higher
+        # priority is waiting for one. The priority of the request can be
+        # raised in the meantime. The store locks the database to take a
+        # token, which other threads shouldn't have to wait for to get in
+        # line, so it's asked after letting go of the condition
+        with self._condition:
+            priority = request.priority
+            self._waiting[priority] += 1
+        try:
+            while True:
+                with self._condition:
+                    priority = self._requeue(request, priority)
+                    if any(self._waiting[:priority]):
+                        self._condition.wait()
+                        continue
+                    if self.store is None:
+                        wait = self._take()
+                        if wait <= 0:
+                            return
+                        self._condition.wait(wait)
+                        continue
+                wait = self._take()
+                if wait <= 0:
+                    return
+                with self._condition:
+                    self._condition.wait(wait)
+        finally:
+            with self._condition:
+                self._waiting[priority] -= 1
+                self._condition.notify_all()
+
+    def _pause(self):
+        # Uses up the tokens when the server says it's busy, so other
+        # threads back off as well
+        if self.store is not None:
+            self.store.empty(self.bucket, self.rate, self.per)
+            return
+        with self._condition:
+            self._refill()
+            self._tokens = min(self._tokens, 0.0)
+
+    def _raise_priority(self, request, priority):
+        # Called with the in flight lock held, when a more urgent caller
+        # joins a call that's waiting for its turn
+        if priority < request.priority:
+            request.priority = priority
+            with self._condition:
+                self._condition.notify_all()
+
+    def _is_busy(self, result):
+        # OpenSubtitles can also report being busy in the response itself
+        try:
+            return int(result['status'].split()[0]) in self.retry_statuses
+        except (TypeError, KeyError, AttributeError, ValueError, IndexError):
+            return False
+
+    def _call(self, method, args):
+        # Makes a single call, and records how long it took and how it failed
+        rpc_calls.inc(method)
+        started = time.perf_counter()
+        try:
+            with phase('xmlrpc'):
+                result = self.pool.call(method, *args)
+        except ProtocolError as e:
+            rpc_errors.inc(method, str(e.errcode))
+            raise
+        except Exception as e:
+            rpc_errors.inc(method, type(e).__name__)
+            raise
+        finally:
+            rpc_duration.observe(time.perf_counter() - started, method)
+        if self._is_busy(result):
+            rpc_errors.inc(method, result['status'].split()[0])
+        return result
+
+    def _send(self, method, args, request):
+        attempt = 0
+        while True:
+            self._acquire(request)
+            try:
+                result = self._call(method, args)
+                if not self._is_busy(result) or attempt >= self.max_retries:
+                    return result
+                reason = result['status']
+            except ProtocolError as e:
+                if e.errcode not in self.retry_statuses or \
+                        attempt >= self.max_retries:
+                    raise
+                reason = "{0} {1}".format(e.errcode, e.errmsg)
+            except self.retry_errors as e:
+                if attempt >= self.max_retries:
+                    raise
+                reason = repr(e)
+            self._pause()
+            delay = random.uniform(0, min(self.max_backoff,
+                                          self.backoff * 2 ** attempt))
+            attempt += 1
+            self.retries += 1
+            rpc_retries.inc(method)
+            log.info("{0} failed ({1}), retrying in {2:.1f}s"
+                     .format(method, reason, delay))
+            time.sleep(delay)
+
+    def _join(self, method, args, done=None):
+        # Returns the call that's in flight for the same method and
+        # arguments, and whether the caller has to make it
+        priority = self.current_priority
+        if method not in self.coalesced_methods:
+            return _InFlight(priority, done), True
+        key = (method, repr(args))
+        with self._in_flight_lock:
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                in_flight = self._in_flight[key] = _InFlight(priority, done)
+                return in_flight, True
+            self.coalesced += 1
+            rpc_coalesced.inc(method)
+            self._raise_priority(in_flight, priority)
+            return in_flight, False
+
+    def _leave(self, method, args):
+        if method in self.coalesced_methods:
+            with self._in_flight_lock:
+                del self._in_flight[(method, repr(args))]
+
+    def call(self, method, *args):
+        in_flight, leader = self._join(method, args)
+        if not leader:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.result
+
+        try:
+            in_flight.result = self._send(method, args, in_flight)
+            return in_flight.result
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            self._leave(method, args)
+            in_flight.done.set()
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda *args: self.call(method, *args)
+
+
+class AsyncRequestScheduler(RequestScheduler):
+    """
+    RequestScheduler for coroutines, which makes its calls with 'send', a
+    coroutine function that takes the method and its arguments. Coroutines
+    get the priority set for the thread that runs their event loop. A
+    store is used from the default executor, so its transactions don't
+    block the event loop
+    """
+
+    retry_errors = RequestScheduler.retry_errors + (
+        asyncio.TimeoutError, asyncio.IncompleteReadError)
+    # Seconds between checks whether a more urgent call is still waiting
+    poll_interval = 0.05
+
+    def __init__(self, send, rate=40, per=10, max_retries=4, backoff=1.0,
+                 max_backoff=30):
+        super().__init__(None, rate, per, max_retries, backoff, max_backoff)
+        self.send = send
+
+    async def _acquire(self, request):
+        priority = request.priority
+        self._waiting[priority] += 1
+        try:
+            while True:
+                priority = self._requeue(request, priority)
+                wait = self.poll_interval
+                if not any(self._waiting[:priority]):
+                    if self.store is not None:
+                        wait = await asyncio.get_running_loop() \
+                            .run_in_executor(None, self._take)
+                    else:
+                        with self._condition:
+                            wait = self._take()
+                    if wait <= 0:
+                        return
+                await asyncio.sleep(wait)
+        finally:
+            self._waiting[priority] -= 1
+
+    async def _pause(self):
+        if self.store is not None:
+            await asyncio.get_running_loop().run_in_executor(
+                None, super()._pause)
+        else:
+            super()._pause()
+
+    async def _call(self, method, args):
+        rpc_calls.inc(method)
+        started = time.perf_counter()
+        try:
+            result = await self.send(method, *args)
+        except ProtocolError as e:
+            rpc_errors.inc(method, str(e.errcode))
+            raise
+        except Exception as e:
+            rpc_errors.inc(method, type(e).__name__)
+            raise
+        finally:
+            rpc_duration.observe(time.perf_counter() - started, method)
+        if self._is_busy(result):
+            rpc_errors.inc(method, result['status'].split()[0])
+        return result
+
+    async def _send(self, method, args, request):
+        attempt = 0
+        while True:
+            await self._acquire(request)
+            try:
+                result = await self._call(method, args)
+                if not self._is_busy(result) or attempt >= self.max_retries:
+                    return result
+                reason = result['status']
+            except ProtocolError as e:
+                if e.errcode not in self.retry_statuses or \
+                        attempt >= self.max_retries:
+                    raise
+                reason = "{0} {1}".format(e.errcode, e.errmsg)
+            except self.retry_errors as e:
+                if attempt >= self.max_retries:
+                    raise
+                reason = repr(e)
+            await self._pause()
+            delay = random.uniform(0, min(self.max_backoff,
+                                          self.backoff * 2 ** attempt))
+            attempt += 1
+            self.retries += 1
+            rpc_retries.inc(method)
+            log.info("{0} failed ({1}), retrying in {2:.1f}s"
+                     .format(method, reason, delay))
+            await asyncio.sleep(delay)
+
+    async def call(self, method, *args):
+        in_flight, leader = self._join(method, args, asyncio.Event())
+        if not leader:
+            await in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.result
+
+        try:
+            in_flight.result = await self._send(method, args, in_flight)
+            return in_flight.result
+        except Exception as e:
+            in_flight.error = e
+            raise
+        finally:
+            self._leave(method, args)
+            in_flight.done.set()
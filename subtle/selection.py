@@ -0,0 +1,42 @@
+from collections import Counter
+
+
+def match_score(sub_result, match_ranking):
+    # Lower is better: the best search strategy first, then most downloaded
+    rank = match_ranking.index(sub_result.matched_by) \
+        if sub_result.matched_by in match_ranking else len(match_ranking)
+    return rank, -sub_result.download_count
+
+
+def score(sub_result, match_ranking, fps=None, is_HD=None, is_HI=None):
+    """
+    Lower is better. Subtitles are compared by how they were found first,
+    then by whether they were made for the video's frame rate, then by
+    whether they are (not) for HD video and the hearing impaired as
+    preferred, and finally by how often they were downloaded. A preference
+    of None means it doesn't matter
+    """
+    rank, downloads = match_score(sub_result, match_ranking)
+    other_fps = fps is not None and sub_result.fps > 0 and \
+        abs(sub_result.fps - fps) >= 0.01
+    return (rank, other_fps,
+            is_HD is not None and sub_result.is_HD != is_HD,
+            is_HI is not None and sub_result.is_HI != is_HI,
+            downloads)
+
+
+def pick_best(sub_results, match_ranking, fps=None, is_HD=None, is_HI=None):
+    """Picks the subtitle most likely to fit the video from SubResults"""
+    if not sub_results:
+        return None
+    return min(sub_results,
+               key=lambda s: score(s, match_ranking, fps, is_HD, is_HI))
+
+
+def video_fps(results):
+    # The frame rate of a video, going by the subtitles found by its hash,
+    # which were made for that exact file. None if there aren't any
+    frame_rates = Counter(round(sub.fps, 3)
+                          for subs in results.values() for sub in subs
+                          if sub.matched_by == 'moviehash' and sub.fps > 0)
+    return frame_rates.most_common(1)[0][0] if frame_rates else None
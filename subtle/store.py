@@ -0,0 +1,171 @@
+import contextlib
+import os
+import time
+import uuid
+import zlib
+from subtle.cache import SQLiteStore
+from subtle.components import base64_chunks, write_compressed_subtitle
+from web import log
+
+
+class SubtitleStore(SQLiteStore):
+    """
+    Keeps every subtitle downloaded from OpenSubtitles in 'directory',
+    gzipped as it was sent, by its download ID. Another video that needs
+    the same subtitle gets a hardlink to the copy that was saved before,
+    if it's still there and unchanged, or else a copy from the store, so
+    OpenSubtitles doesn't have to be asked again. The least recently used
+    subtitles are removed once they take up more than 'max_size' bytes
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS subtitles (
+            download_id INTEGER PRIMARY KEY,
+            size INTEGER NOT NULL,
+            is_utf8 INTEGER NOT NULL,
+            last_used REAL NOT NULL,
+            saved_path TEXT,
+            saved_size INTEGER,
+            saved_mtime_ns INTEGER);
+        CREATE INDEX IF NOT EXISTS subtitles_last_used
+            ON subtitles (last_used);
+    '''
+
+    def __init__(self, directory, max_size=100 * 1024 ** 2):
+        super().__init__(os.path.join(directory, 'store.db'))
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def _blob_path(self, download_id):
+        # Spread the subtitles over 100 directories
+        return os.path.join(self.directory, '{0:02}'.format(download_id % 100),
+                            '{0}.gz'.format(download_id))
+
+    def put(self, download_id, payload):
+        # Stores a subtitle from a DownloadSubtitles response, which is
+        # base64 encoded and gzipped
+        blob_path = self._blob_path(download_id)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        temp_path = "{0}.{1}.tmp".format(blob_path, uuid.uuid4().hex)
+        try:
+            with open(temp_path, 'wb') as blob:
+                for chunk in base64_chunks(payload):
+                    blob.write(chunk)
+            os.replace(temp_path, blob_path)
+        except BaseException:
+            # open() itself may have failed
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
+            raise
+        with self._lock:
+            self.execute('INSERT OR REPLACE INTO subtitles (download_id, '
+                         'size, is_utf8, last_used) VALUES (?, ?, 1, ?)',
+                         (download_id, os.path.getsize(blob_path),
+                          time.time()))
+            self.prune()
+
+    def save(self, download_id, path):
+        """
+        Saves a stored subtitle to path. Returns None if it isn't stored,
+        and otherwise whether it's valid UTF-8
+        """
+        with self._lock:
+            row = self.execute('SELECT is_utf8, saved_path, saved_size, '
+                               'saved_mtime_ns FROM subtitles WHERE '
+                               'download_id = ?', (download_id,))
+        if not row:
+            return None
+        is_utf8, saved_path, saved_size, saved_mtime_ns = row[0]
+        saved = self._stat(saved_path)
+        if saved is not None and saved == (saved_size, saved_mtime_ns):
+            if os.path.abspath(saved_path) == os.path.abspath(path):
+                self._used(download_id)
+                return bool(is_utf8)
+            if self._link(saved_path, path):
+                self._used(download_id)
+                return bool(is_utf8)
+        try:
+            with open(self._blob_path(download_id), 'rb') as blob:
+                is_utf8 = write_compressed_subtitle(
+                    iter(lambda: blob.read(65536), b''), path)
+        except FileNotFoundError:
+            # Removed by another worker in the meantime
+            self.execute('DELETE FROM subtitles WHERE download_id = ?',
+                         (download_id,))
+            return None
+        except zlib.error:
+            log.warning("Removed corrupt subtitle {0} from the subtitle "
+                        "store".format(download_id))
+            self.execute('DELETE FROM subtitles WHERE download_id = ?',
+                         (download_id,))
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._blob_path(download_id))
+            return None
+        self.saved(download_id, path, is_utf8)
+        return is_utf8
+
+    def saved(self, download_id, path, is_utf8=True):
+        # Remembers where a stored subtitle was saved, to link to later
+        stat = self._stat(path)
+        if stat is None:
+            return
+        self.execute('UPDATE subtitles SET is_utf8 = ?, last_used = ?, '
+                     'saved_path = ?, saved_size = ?, saved_mtime_ns = ? '
+                     'WHERE download_id = ?',
+                     (int(is_utf8), time.time(), path) + stat +
+                     (download_id,))
+
+    @staticmethod
+    def _stat(path):
+        try:
+            stat = os.stat(path)
+            return stat.st_size, stat.st_mtime_ns
+        except (OSError, TypeError):
+            return None
+
+    @staticmethod
+    def _link(source, path):
+        # Hardlinks source to path, replacing path if it exists. Returns
+        # False if that's not possible, e.g. across file systems
+        temp_path = "{0}.{1}.tmp".format(path, uuid.uuid4().hex)
+        try:
+            os.link(source, temp_path)
+        except OSError:
+            return False
+        try:
+            os.replace(temp_path, path)
+        except OSError:
+            os.remove(temp_path)
+            return False
+        return True
+
+    def _used(self, download_id):
+        self.execute('UPDATE subtitles SET last_used = ? WHERE '
+                     'download_id = ?', (time.time(), download_id))
+
+    def prune(self):
+        # Removes the least recently used subtitles until the rest fit
+        with self._lock:
+            size = self.execute('SELECT COALESCE(SUM(size), 0) FROM '
+                                'subtitles')[0][0]
+            if size <= self.max_size:
+                return 0
+            removed = []
+            for download_id, blob_size in self.execute(
+                    'SELECT download_id, size FROM subtitles ORDER BY '
+                    'last_used'):
+                if size <= self.max_size:
+                    break
+                removed.append((download_id,))
+                size -= blob_size
+            self.connection.executemany(
+                'DELETE FROM subtitles WHERE download_id = ?', removed)
+        for download_id, in removed:
+            try:
+                os.remove(self._blob_path(download_id))
+            except OSError:
+                pass
+        log.info("Removed {0} subtitles from the subtitle store"
+                 .format(len(removed)))
+        return len(removed)
@@ -0,0 +1,142 @@
+import http.client
+import os
+import ssl
+import time
+from threading import Condition
+from urllib.parse import urlsplit
+from xmlrpc.client import ServerProxy, Transport, SafeTransport
+
+
+class _HTTPSConnection(http.client.HTTPSConnection):
+    """
+    HTTPS connection that resumes the TLS session of an earlier connection
+    in the same pool, which saves a full handshake on reconnect
+    """
+
+    def __init__(self, host, pool, **kwargs):
+        super().__init__(host, **kwargs)
+        self.pool = pool
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(
+            self.sock, server_hostname=self.host,
+            session=self.pool.tls_session)
+
+    def close(self):
+        # Remember the session before the server closes the connection
+        session = getattr(self.sock, 'session', None)
+        if session is not None:
+            self.pool.tls_session = session
+        super().close()
+
+
+class _PooledTransport(Transport):
+    """Transport that keeps its connection alive and times out calls"""
+
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+
+    def _new_connection(self, host):
+        return http.client.HTTPConnection(host, timeout=self.pool.timeout)
+
+    def make_connection(self, host):
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        self._connection = host, self._new_connection(chost)
+        return self._connection[1]
+
+    def session(self):
+        # The TLS session of the current connection, if any
+        connection = self._connection[1]
+        sock = getattr(connection, 'sock', None) if connection else None
+        return getattr(sock, 'session', None)
+
+
+class _PooledSafeTransport(_PooledTransport, SafeTransport):
+
+    def _new_connection(self, host):
+        return _HTTPSConnection(host, self.pool, timeout=self.pool.timeout,
+                                context=self.pool.context)
+
+
+class ServerPool(object):
+    """
+    A bounded pool of XML-RPC connections that can be shared by threads.
+    Every call checks out a connection, which is kept alive and checked back
+    in afterwards, so several calls can be in flight at the same time.
+    Calls are made just like with a ServerProxy, e.g. pool.ServerInfo()
+    """
+
+    def __init__(self, url, size=4, timeout=30):
+        self.url = url
+        self.size = size
+        self.timeout = timeout
+        self.context = ssl.create_default_context()
+        self.tls_session = None
+        self._is_https = urlsplit(url).scheme == 'https'
+        self._condition = Condition()
+        self._idle = []
+        self._in_use = 0
+        self._pid = os.getpid()
+
+    def _create(self):
+        transport = _PooledSafeTransport(self) if self._is_https \
+            else _PooledTransport(self)
+        return ServerProxy(self.url, transport=transport, allow_none=True)
+
+    def checkout(self):
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            # Connections can't be shared with a forked worker
+            if self._pid != os.getpid():
+                self._idle = []
+                self._in_use = 0
+                self._pid = os.getpid()
+            while self._in_use >= self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError("No connection to {0} became available"
+                                       .format(self.url))
+                self._condition.wait(remaining)
+            self._in_use += 1
+            if self._idle:
+                return self._idle.pop()
+        return self._create()
+
+    def checkin(self, proxy, reuse=True):
+        with self._condition:
+            if proxy is not None and self._is_https:
+                session = proxy('transport').session()
+                if session is not None:
+                    self.tls_session = session
+            if reuse and proxy is not None and self._pid == os.getpid():
+                self._idle.append(proxy)
+            elif proxy is not None:
+                proxy('close')()
+            self._in_use -= 1
+            self._condition.notify()
+
+    def call(self, method, *args):
+        proxy = self.checkout()
+        try:
+            result = getattr(proxy, method)(*args)
+        except Exception:
+            # Don't reuse a connection that's in an unknown state
+            self.checkin(proxy, reuse=False)
+            raise
+        self.checkin(proxy)
+        return result
+
+    def close(self):
+        with self._condition:
+            for proxy in self._idle:
+                proxy('close')()
+            self._idle = []
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+        return lambda *args: self.call(method, *args)
@@ -1,6 +1,9 @@
 import os
 import uuid
-from subtle.components import hash_file
+from array import array
+from subtle.components import HASH_BLOCK_SIZE, hash_file
+from subtle.metrics import hash_bytes, hash_cache_lookups, hash_duration
+from subtle.profiling import phase
 from web import log
 
 
@@ -12,6 +15,8 @@ class Video(object):
     file_hash = None
     imdb_id = 0
     year = ''
+    # Shared HashCache, set up from config.json
+    hash_cache = None
 
     @property
     def file_name(self):
@@ -30,10 +35,22 @@ class Video(object):
     def __init__(self, path):
         try:
             self.full_path = path
-            self.file_size = os.path.getsize(self.full_path)
-            video_file = open(self.full_path, "rb")
-            self.file_hash = hash_file(video_file, self.file_size)
-            video_file.close()
+            stat = os.stat(self.full_path)
+            self.file_size = stat.st_size
+            if Video.hash_cache is not None:
+                self.file_hash = Video.hash_cache.get(self.full_path, stat)
+                hash_cache_lookups.inc(
+                    'miss' if self.file_hash is None else 'hit')
+            if self.file_hash is None:
+                with hash_duration.time(), phase('hash'):
+                    video_file = open(self.full_path, "rb")
+                    self.file_hash = hash_file(video_file, self.file_size)
+                    video_file.close()
+                if len(self.file_hash) == 16:
+                    hash_bytes.inc(amount=HASH_BLOCK_SIZE * 2)
+                if Video.hash_cache is not None and \
+                        len(self.file_hash) == 16:
+                    Video.hash_cache.put(self.full_path, stat, self.file_hash)
 
         except OSError as e:
             if e.args[0] == 2:
@@ -48,24 +65,73 @@ class Video(object):
 
 
 class SubResult(object):
-    file_name = ''
-    video_id = None
-    is_HI = False
-    is_HD = False
-    rating = -1.0
-    download_id = ''
-    download_count = -1
-    fps = 0.0
-    language = ''
-    lang_id = ''
-    matched_by = ''
-
-    def __init__(self, video_id):
+    __slots__ = ('file_name', 'video_id', 'is_HI', 'is_HD', 'rating',
+                 'download_id', 'download_count', 'fps', 'language',
+                 'lang_id', 'matched_by')
+
+    def __init__(self, video_id, file_name='', download_id='', lang_id='',
+                 language='', rating=-1.0, is_HD=False, is_HI=False,
+                 download_count=-1, fps=0.0, matched_by=''):
         if type(video_id) is uuid.UUID:
             self.video_id = video_id
         else:
             raise TypeError('Error: The provided video_id'
                             ' is not a valid unique identifier')
+        self.file_name = file_name
+        self.download_id = download_id
+        self.lang_id = lang_id
+        self.language = language
+        self.rating = rating
+        self.is_HD = is_HD
+        self.is_HI = is_HI
+        self.download_count = download_count
+        self.fps = fps
+        self.matched_by = matched_by
 
     def __str__(self):
         return self.file_name
+
+    def to_dict(self):
+        # Everything but the ID of the video, e.g. to send it as JSON
+        return {name: getattr(self, name) for name in self.__slots__
+                if name != 'video_id'}
+
+
+class SubResults(list):
+    """
+    The SubResults in one language, best matches first, along with the
+    order of the results for every way they can be sorted. Sorting them
+    differently only picks the results in another order
+    """
+
+    sort_keys = ('download_count', 'rating', 'file_name')
+
+    def __init__(self, sub_results=()):
+        super().__init__(sub_results)
+        self.orderings = dict()
+        for key in self.sort_keys:
+            values = [getattr(sub_result, key) for sub_result in self]
+            for descending in (False, True):
+                # Sorting is stable, so equal results keep the best match
+                # first in both directions
+                self.orderings[key, descending] = array('I', sorted(
+                    range(len(values)), key=values.__getitem__,
+                    reverse=descending))
+
+    def ordered(self, sort_by, descending=True):
+        # The results sorted by one of the sort keys, or as they are if
+        # it's not a key they can be sorted by
+        ordering = self.orderings.get((sort_by, descending))
+        if ordering is None:
+            return list(self)
+        return [self[index] for index in ordering]
+
+    def filtered(self, sort_by, descending=True, is_HI=None, is_HD=None,
+                 fps=None, min_rating=None):
+        # The results in the given order, leaving out those that don't have
+        # the given flags, frame rate or at least the given rating
+        return [sub for sub in self.ordered(sort_by, descending)
+                if (is_HI is None or sub.is_HI == is_HI) and
+                (is_HD is None or sub.is_HD == is_HD) and
+                (fps is None or abs(sub.fps - fps) < 0.01) and
+                (min_rating is None or sub.rating >= min_rating)]
@@ -0,0 +1,43 @@
+"""
+Subtle reads config.json from the working directory when it's imported, so
+the tests run in a directory of their own, with a config.json that turns
+off every store on disk
+"""
+import json
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_DIR = tempfile.mkdtemp(prefix='subtle-tests-')
+
+config = {
+    "os_username": "tester",
+    "os_password": "",
+    "hash": "5f4dcc3b5aa765d61d8327deb882cf99",
+    "root": TEST_DIR,
+    "debug": "no",
+    "token_store": "",
+    "rate_limit_store": "",
+    "hash_cache": "",
+    "result_cache": "",
+    "subtitle_store": "",
+    "library_index": "",
+    "metrics_store": ""
+}
+with open(os.path.join(TEST_DIR, 'config.json'), 'w') as json_settings:
+    json.dump(config, json_settings, indent=4)
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+os.chdir(TEST_DIR)
+import web  # noqa: E402,F401
+
+
+def make_video(name, size=256 * 1024):
+    # A file big enough to be hashed, in a directory of its own
+    directory = tempfile.mkdtemp(dir=TEST_DIR)
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as video_file:
+        video_file.write(os.urandom(size))
+    return path
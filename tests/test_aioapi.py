@@ -0,0 +1,141 @@
+import asyncio
+import os
+import unittest
+from xmlrpc.client import dumps, loads
+from tests import make_video
+from benchmarks.stub_server import StubServer
+from subtle.aioapi import AsyncOSHandler
+from subtle.types import Video
+
+
+class AsyncStubServer(object):
+    """
+    Answers XML RPC calls with the methods of a StubServer, on an asyncio
+    server in the event loop of the test instead of a thread of its own
+    """
+
+    def __init__(self, stub):
+        self.stub = stub
+        self.calls = []
+        self.connections = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return self
+
+    @property
+    def url(self):
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return 'http://{0}:{1}/xml-rpc'.format(host, port)
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = dict()
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                params, method = loads(await reader.readexactly(
+                    int(headers['content-length'])))
+                self.calls.append((method, params))
+                body = dumps((getattr(self.stub, method)(*params),),
+                             methodresponse=True,
+                             allow_none=True).encode('utf-8')
+                writer.write("HTTP/1.1 200 OK\r\n"
+                             "Content-Type: text/xml\r\n"
+                             "Content-Length: {0}\r\n"
+                             "\r\n".format(len(body)).encode('latin-1') +
+                             body)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def methods(self):
+        return [method for method, params in self.calls]
+
+
+class AsyncOSHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.stub = StubServer(results=20, subtitle_size=2000,
+                               languages=('eng', 'dut'))
+        self.server = self.loop.run_until_complete(
+            AsyncStubServer(self.stub).start())
+        self.handler = AsyncOSHandler(self.server.url)
+        self.handler.user_name = 'tester'
+        self.handler.hash = 'hash'
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.handler.close())
+        self.loop.run_until_complete(self.server.stop())
+        self.loop.close()
+        self.stub.stop()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_login(self):
+        self.run_async(self.handler.login())
+        self.assertTrue(self.handler.logged_in)
+        self.assertTrue(self.handler.user_token.startswith('stub'))
+        self.assertEqual(self.handler.language, ['eng', 'dut'])
+
+    def test_search_and_download(self):
+        video = Video(make_video('Movie.mkv'))
+
+        async def fetch():
+            await self.handler.login()
+            await self.handler.get_video_info(video)
+            results = await self.handler.search_subtitles(video)
+            best = results['eng'][0]
+            saved = await self.handler.download_subtitles([(video, best)])
+            return results, best, saved
+
+        results, best, saved = self.run_async(fetch())
+        sub_filename = saved[video.full_path, best.download_id]
+        self.assertEqual(video.title, 'Movie {0}'.format(video.file_hash[:6]))
+        self.assertEqual(sorted(results), ['dut', 'eng'])
+        self.assertEqual(os.path.basename(sub_filename), 'Movie.en.srt')
+        self.assertTrue(os.path.getsize(sub_filename) > 0)
+        self.assertEqual(self.server.methods()[:2],
+                         ['LogIn', 'CheckMovieHash'])
+        self.assertEqual(self.server.methods()[-1], 'DownloadSubtitles')
+        # Every call went over the same keep-alive connection
+        self.assertEqual(self.server.connections, 1)
+
+    def test_search_without_results(self):
+        self.stub.results = 0
+        video = Video(make_video('Movie.mkv'))
+
+        async def search():
+            await self.handler.login()
+            return await self.handler.search_subtitles(video)
+
+        self.assertEqual(self.run_async(search()), {})
+
+    def test_concurrent_calls_are_coalesced(self):
+        async def server_info():
+            return await asyncio.gather(*[self.handler.get_server_info()
+                                          for _ in range(5)])
+
+        results = self.run_async(server_info())
+        self.assertEqual(len(results), 5)
+        self.assertEqual(self.server.methods(), ['ServerInfo'])
+        self.assertEqual(self.handler.scheduler.coalesced, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+import os
+import tempfile
+import time
+import unittest
+from tests import TEST_DIR, make_video
+from subtle.cache import HashCache, RateLimitStore, ResultCache
+from subtle.types import Video
+
+
+class HashCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(dir=TEST_DIR)
+        self.cache = HashCache(os.path.join(self.directory, 'hashes.db'))
+
+    def tearDown(self):
+        self.cache.close()
+
+    def make_file(self, name, data=b'video'):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as video_file:
+            video_file.write(data)
+        return path
+
+    def test_hit(self):
+        path = self.make_file('a.mkv')
+        self.cache.put(path, os.stat(path), '0123456789abcdef')
+        self.assertEqual(self.cache.get(path, os.stat(path)),
+                         '0123456789abcdef')
+
+    def test_miss_after_modification(self):
+        path = self.make_file('a.mkv')
+        self.cache.put(path, os.stat(path), '0123456789abcdef')
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNone(self.cache.get(path, os.stat(path)))
+        # Same modification time, but a different size
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        with open(path, 'ab') as video_file:
+            video_file.write(b'more')
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertIsNone(self.cache.get(path, os.stat(path)))
+
+    def test_renamed_file_hits(self):
+        path = self.make_file('a.mkv')
+        self.cache.put(path, os.stat(path), '0123456789abcdef')
+        new_path = os.path.join(self.directory, 'b.mkv')
+        os.rename(path, new_path)
+        self.assertEqual(self.cache.get(new_path, os.stat(new_path)),
+                         '0123456789abcdef')
+
+    def test_prune_drops_deleted_files_first(self):
+        self.cache.max_entries = 10
+        paths = [self.make_file('{0}.mkv'.format(i)) for i in range(12)]
+        stats = [os.stat(path) for path in paths]
+        for path, stat in zip(paths, stats):
+            self.cache.put(path, stat, '0123456789abcdef')
+        # The most recently used file is gone, the rest are still there
+        os.remove(paths[-1])
+        self.cache.stale_check_limit = 100
+        self.assertEqual(self.cache.prune(), 3)
+        self.assertIsNone(self.cache.get(paths[-1], stats[-1]))
+        self.assertIsNone(self.cache.get(paths[0], stats[0]))
+        self.assertIsNone(self.cache.get(paths[1], stats[1]))
+        self.assertIsNotNone(self.cache.get(paths[2], stats[2]))
+
+    def test_prune_checks_a_limited_number_of_files(self):
+        self.cache.max_entries = 10
+        paths = [self.make_file('{0}.mkv'.format(i)) for i in range(12)]
+        stats = [os.stat(path) for path in paths]
+        for path, stat in zip(paths, stats):
+            self.cache.put(path, stat, '0123456789abcdef')
+        os.remove(paths[-1])
+        # Only the two least recently used files are checked, so the
+        # deleted one stays and the oldest ones go instead
+        self.cache.stale_check_limit = 2
+        self.assertEqual(self.cache.prune(), 3)
+        self.assertIsNotNone(self.cache.get(paths[-1], stats[-1]))
+        self.assertIsNone(self.cache.get(paths[2], stats[2]))
+        self.assertIsNotNone(self.cache.get(paths[3], stats[3]))
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(dir=TEST_DIR), 'results.db')
+        self.cache = ResultCache(self.path, retry_after=60,
+                                 max_retry_after=300)
+        self.video = Video(make_video('Movie.mkv'))
+
+    def tearDown(self):
+        self.cache.close()
+
+    def assertRetriedAfter(self, entry, seconds):
+        self.assertAlmostEqual(entry.expires - time.time(), seconds, delta=1)
+
+    def test_results(self):
+        self.cache.put(self.video, ['eng'], {'eng': ['result']})
+        entry = self.cache.get(self.video, ['eng'])
+        self.assertEqual(entry.results, {'eng': ['result']})
+        self.assertRetriedAfter(entry, self.cache.ttl)
+        # Other languages are cached separately
+        self.assertIsNone(self.cache.get(self.video, ['eng', 'dut']))
+
+    def test_negative_backoff(self):
+        for misses, seconds in [(1, 60), (2, 120), (3, 240), (4, 300),
+                                (5, 300)]:
+            entry = self.cache.put(self.video, ['eng'], {})
+            self.assertEqual(entry.misses, misses)
+            self.assertIsNone(entry.results)
+            self.assertRetriedAfter(entry, seconds)
+        self.assertIsNone(self.cache.get(self.video, ['eng']).results)
+
+    def test_backoff_starts_over_after_results(self):
+        self.cache.put(self.video, ['eng'], {})
+        self.cache.put(self.video, ['eng'], {})
+        self.cache.put(self.video, ['eng'], {'eng': ['result']})
+        entry = self.cache.put(self.video, ['eng'], {})
+        self.assertEqual(entry.misses, 1)
+        self.assertRetriedAfter(entry, 60)
+
+    def test_expired_negative_result(self):
+        self.cache.retry_after = 0.05
+        self.cache.put(self.video, ['eng'], {})
+        time.sleep(0.1)
+        self.assertIsNone(self.cache.get(self.video, ['eng']))
+        # How often it was looked up in vain is still known
+        self.assertEqual(self.cache.put(self.video, ['eng'], {}).misses, 2)
+
+    def test_backoff_survives_restarts(self):
+        self.cache.put(self.video, ['eng'], {})
+        self.cache.put(self.video, ['eng'], {})
+        other = ResultCache(self.path, retry_after=60, max_retry_after=300)
+        try:
+            entry = other.put(self.video, ['eng'], {})
+        finally:
+            other.close()
+        self.assertEqual(entry.misses, 3)
+        self.assertRetriedAfter(entry, 240)
+
+
+class RateLimitStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(dir=TEST_DIR), 'rate.db')
+        self.store = RateLimitStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+
+    def test_take(self):
+        for _ in range(5):
+            self.assertEqual(self.store.take('api', 5, 10), 0)
+        # Empty, and one token comes back every two seconds
+        self.assertAlmostEqual(self.store.take('api', 5, 10), 2, delta=0.1)
+        self.assertAlmostEqual(self.store.take('api', 5, 10, 3), 6,
+                               delta=0.1)
+        # Buckets don't share their tokens
+        self.assertEqual(self.store.take('prefetch', 5, 10), 0)
+
+    def test_count_is_taken_all_or_nothing(self):
+        self.assertEqual(self.store.take('api', 5, 10, 4), 0)
+        self.assertGreater(self.store.take('api', 5, 10, 2), 0)
+        # The one token that's left wasn't taken by the failed attempt
+        self.assertEqual(self.store.take('api', 5, 10), 0)
+
+    def test_refill(self):
+        self.assertEqual(self.store.take('api', 100, 1, 100), 0)
+        time.sleep(0.05)
+        self.assertEqual(self.store.take('api', 100, 1, 2), 0)
+
+    def test_empty(self):
+        self.store.empty('api', 5, 10)
+        self.assertGreater(self.store.take('api', 5, 10), 0)
+
+    def test_shared_between_stores(self):
+        other = RateLimitStore(self.path)
+        try:
+            self.assertEqual(self.store.take('api', 2, 10, 2), 0)
+            self.assertGreater(other.take('api', 2, 10), 0)
+        finally:
+            other.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import base64
+import gzip
+import os
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from tests import TEST_DIR
+from benchmarks.hash_file import legacy_hash_file, make_sparse_file
+from subtle.components import TimedEvent, directory_subtitles, hash_file, \
+    missing_languages, subtitle_language, write_subtitle
+
+SUBTITLE = '1\n00:00:01,000 --> 00:00:02,000\nSubtítulo\n\n' * 2000
+
+
+def payload(data):
+    return base64.b64encode(gzip.compress(data)).decode('ascii')
+
+
+class HashFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(dir=TEST_DIR)
+
+    def assertSameHash(self, path):
+        size = os.path.getsize(path)
+        self.assertEqual(hash_file(open(path, 'rb'), size),
+                         legacy_hash_file(open(path, 'rb'), size))
+
+    def make_file(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as video_file:
+            video_file.write(data)
+        return path
+
+    def test_matches_reference(self):
+        for size in (128 * 1024, 128 * 1024 + 1, 200003, 1024 ** 2):
+            self.assertSameHash(self.make_file('{0}.mkv'.format(size),
+                                               os.urandom(size)))
+
+    def test_overflow(self):
+        # Every long long is -1, so the sum wraps around many times
+        self.assertSameHash(self.make_file('ff.mkv', b'\xff' * 300000))
+
+    def test_large_file(self):
+        # The size is part of the hash, and doesn't fit in 32 bits
+        self.assertSameHash(make_sparse_file(self.directory, 'large.mkv',
+                                             5 * 1024 ** 3 + 7))
+
+    def test_too_small(self):
+        path = self.make_file('small.mkv', os.urandom(128 * 1024 - 1))
+        self.assertEqual(hash_file(open(path, 'rb'), os.path.getsize(path)),
+                         'SizeError')
+
+
+class WriteSubtitleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(dir=TEST_DIR)
+        self.path = os.path.join(self.directory, 'Movie.en.srt')
+
+    def test_utf8(self):
+        self.assertTrue(write_subtitle(payload(SUBTITLE.encode('utf-8')),
+                                       self.path, chunk_size=1000))
+        with open(self.path, encoding='utf-8') as sub_file:
+            self.assertEqual(sub_file.read(), SUBTITLE)
+        self.assertEqual(os.listdir(self.directory), ['Movie.en.srt'])
+
+    def test_not_utf8(self):
+        data = SUBTITLE.encode('latin-1')
+        self.assertFalse(write_subtitle(payload(data), self.path))
+        # Written as is
+        with open(self.path, 'rb') as sub_file:
+            self.assertEqual(sub_file.read(), data)
+
+    def test_truncated(self):
+        compressed = gzip.compress(SUBTITLE.encode('utf-8'))
+        truncated = base64.b64encode(
+            compressed[:len(compressed) // 2]).decode('ascii')
+        with self.assertRaises(zlib.error):
+            write_subtitle(truncated, self.path)
+        # Neither the subtitle nor the temporary file are left behind
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_replaces_existing_subtitle(self):
+        with open(self.path, 'w') as sub_file:
+            sub_file.write('old')
+        write_subtitle(payload(b'new'), self.path)
+        with open(self.path) as sub_file:
+            self.assertEqual(sub_file.read(), 'new')
+
+
+class SubtitleLanguageTest(unittest.TestCase):
+
+    def test_language_codes(self):
+        self.assertEqual(subtitle_language('Movie.en.srt', 'Movie.'), 'en')
+        # Codes OpenSubtitles made up itself
+        self.assertEqual(subtitle_language('Movie.pb.srt', 'Movie.'), 'pb')
+        # Dots in the name of the video
+        self.assertEqual(subtitle_language('Mr. Robot.S01.nl.srt',
+                                           'Mr. Robot.S01.'), 'nl')
+
+    def test_other_videos(self):
+        self.assertIsNone(subtitle_language('Movie.part2.en.srt', 'Movie.'))
+        self.assertIsNone(subtitle_language('Movie 2.en.srt', 'Movie.'))
+        self.assertIsNone(subtitle_language('Movie 2.srt', 'Movie.'))
+
+    def test_not_a_language(self):
+        self.assertIsNone(subtitle_language('Movie.srt', 'Movie.'))
+        self.assertIsNone(subtitle_language('Movie..srt', 'Movie.'))
+        self.assertIsNone(subtitle_language('Movie.eng.srt', 'Movie.'))
+        self.assertIsNone(subtitle_language('Movie.e1.srt', 'Movie.'))
+        self.assertIsNone(subtitle_language('Movie.en.sub', 'Movie.'))
+        self.assertIsNone(subtitle_language('Movie.en.srt.tmp', 'Movie.'))
+
+
+class MissingLanguagesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(dir=TEST_DIR)
+        for name in ('Movie.mkv', 'Movie.en.srt', 'Movie.part2.mkv',
+                     'Movie.part2.nl.srt', 'Movie 2.srt', 'notes.txt'):
+            open(os.path.join(self.directory, name), 'w').close()
+        self.video = os.path.join(self.directory, 'Movie.mkv')
+
+    def test_directory_subtitles(self):
+        self.assertEqual(directory_subtitles(os.listdir(self.directory)),
+                         {'Movie': {'en'}, 'Movie.part2': {'nl'}})
+
+    def test_without_listing(self):
+        self.assertEqual(missing_languages(self.video, ['eng', 'dut']),
+                         ['dut'])
+        self.assertEqual(missing_languages(
+            os.path.join(self.directory, 'Movie.part2.mkv'), ['eng', 'dut']),
+            ['eng'])
+
+    def test_with_listing(self):
+        subtitles = directory_subtitles(os.listdir(self.directory))
+        self.assertEqual(missing_languages(self.video, ['eng', 'dut'],
+                                           subtitles), ['dut'])
+        self.assertEqual(missing_languages(
+            os.path.join(self.directory, 'Other.mkv'), ['eng'], subtitles),
+            ['eng'])
+
+
+class TimedEventTest(unittest.TestCase):
+
+    def test_threaded_action_does_not_hold_up_other_events(self):
+        release = threading.Event()
+        slow_runs = []
+        fast_runs = []
+
+        def slow():
+            slow_runs.append(time.monotonic())
+            release.wait(5)
+
+        slow_event = TimedEvent(0.05, slow, threaded=True)
+        fast_event = TimedEvent(0.05, lambda: fast_runs.append(1))
+        try:
+            time.sleep(0.5)
+            # The fast event kept running while the slow one was stuck,
+            # and the slow one wasn't started again in the meantime
+            self.assertGreater(len(fast_runs), 3)
+            self.assertEqual(len(slow_runs), 1)
+        finally:
+            slow_event.stop()
+            fast_event.stop()
+            release.set()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import os
+import tempfile
+import time
+import unittest
+from tests import TEST_DIR
+from subtle.library import LibraryIndex
+
+
+class LibraryIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(dir=TEST_DIR)
+        self.index = LibraryIndex(os.path.join(self.root, 'library.db'))
+        self.make('A.mkv', 'A.en.srt', 'A.nl.srt')
+        self.make('B.mkv', 'B.en.srt', 'B.part2.nl.srt')
+        self.make('C.avi')
+        self.make(os.path.join('Series', 'D.mp4'), 'Series/D.nl.srt')
+        self.index.update(self.root)
+
+    def tearDown(self):
+        self.index.close()
+
+    def make(self, *names):
+        for name in names:
+            path = os.path.join(self.root, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def test_count_missing(self):
+        self.assertEqual(self.index.count_missing(['eng']), (4, 2))
+        self.assertEqual(self.index.count_missing(['eng', 'dut']), (4, 3))
+        # ISO 639-1 codes work as well
+        self.assertEqual(self.index.count_missing(['nl']), (4, 2))
+        self.assertEqual(self.index.count_missing([]), (4, 0))
+
+    def test_missing(self):
+        self.assertEqual(self.index.missing(['eng', 'dut']), [
+            (self.path('B.mkv'), None, ['en']),
+            (self.path('C.avi'), None, []),
+            (self.path(os.path.join('Series', 'D.mp4')), None, ['nl'])])
+        self.assertEqual(self.index.missing([]), [])
+
+    def test_missing_pages(self):
+        paths = [path for path, _, _ in
+                 self.index.missing(['eng', 'dut'], limit=2, offset=1)]
+        self.assertEqual(paths, [self.path('C.avi'),
+                                 self.path(os.path.join('Series', 'D.mp4'))])
+
+    def test_update_after_change(self):
+        self.make('C.en.srt', 'C.nl.srt')
+        # Directory modification times can be too coarse to notice
+        os.utime(self.root, ns=(0, time.time_ns() + 10 ** 9))
+        self.assertEqual(self.index.update(self.root), 1)
+        self.assertEqual(self.index.count_missing(['eng', 'dut']), (4, 2))
+        self.assertNotIn(self.path('C.avi'), [
+            path for path, _, _ in self.index.missing(['eng', 'dut'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
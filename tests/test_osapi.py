@@ -0,0 +1,126 @@
+import os
+import tempfile
+import unittest
+from tests import TEST_DIR
+from benchmarks.stub_server import StubServer
+from subtle.osapi import OSHandler
+from subtle.types import Video
+
+
+class RecordingStubServer(StubServer):
+    """StubServer that remembers the hashes of every CheckMovieHash call,
+    and doesn't know the videos in 'unknown'"""
+
+    def __init__(self, **kwargs):
+        self.batches = []
+        self.unknown = set()
+        super().__init__(**kwargs)
+
+    def CheckMovieHash(self, token, hashes):
+        with self.lock:
+            self.batches.append(list(hashes))
+        result = super().CheckMovieHash(token, hashes)
+        for file_hash in self.unknown:
+            result['data'].pop(file_hash, None)
+        return result
+
+
+def make_videos(count):
+    # Sparse files of different sizes, which hash differently without
+    # taking up any space
+    directory = tempfile.mkdtemp(dir=TEST_DIR)
+    paths = []
+    for index in range(count):
+        path = os.path.join(directory, 'Movie {0}.mkv'.format(index))
+        with open(path, 'wb') as video_file:
+            video_file.truncate(256 * 1024 + index)
+        paths.append(path)
+    return [Video(path) for path in paths]
+
+
+class GetVideoInfoManyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = RecordingStubServer().start()
+        self.handler = OSHandler(self.stub.url)
+        self.handler.user_name = 'tester'
+        self.handler.hash = 'hash'
+        self.handler.login()
+
+    def tearDown(self):
+        self.handler.logout()
+        self.stub.stop()
+
+    def test_batches(self):
+        videos = make_videos(450)
+        self.handler.get_video_info_many(videos)
+        self.assertEqual([len(batch) for batch in self.stub.batches],
+                         [200, 200, 50])
+        # Each batch holds the next 200 videos, every hash once
+        self.assertEqual(
+            [file_hash for batch in self.stub.batches for file_hash in batch],
+            [file_hash for i in range(0, 450, 200)
+             for file_hash in sorted(video.file_hash
+                                     for video in videos[i:i + 200])])
+        for video in videos:
+            self.assertEqual(video.imdb_id,
+                             str(int(video.file_hash[:6], 16)))
+            self.assertEqual(video.title,
+                             'Movie {0}'.format(video.file_hash[:6]))
+            self.assertEqual(video.year, '2000')
+
+    def test_results_are_merged_by_hash(self):
+        videos = make_videos(3)
+        # The same file twice is only asked about once
+        videos.append(Video(videos[0].full_path))
+        self.stub.unknown.add(videos[1].file_hash)
+        self.handler.get_video_info_many(videos + [None])
+        self.assertEqual(len(self.stub.batches), 1)
+        self.assertEqual(len(self.stub.batches[0]), 3)
+        self.assertEqual(videos[0].title, videos[3].title)
+        self.assertEqual(videos[0].imdb_id, videos[3].imdb_id)
+        # Videos OpenSubtitles doesn't know keep their file name as title
+        self.assertEqual(videos[1].title, 'Movie 1.mkv')
+        self.assertEqual(videos[1].imdb_id, 0)
+        self.assertEqual(videos[2].title,
+                         'Movie {0}'.format(videos[2].file_hash[:6]))
+
+    def test_single_video(self):
+        video = make_videos(1)[0]
+        self.handler.get_video_info(video)
+        self.assertEqual(self.stub.batches, [[video.file_hash]])
+        self.assertEqual(video.year, '2000')
+
+
+class DownloadSubtitlesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = RecordingStubServer(results=5).start()
+        self.handler = OSHandler(self.stub.url)
+        self.handler.user_name = 'tester'
+        self.handler.hash = 'hash'
+        self.handler.login()
+
+    def tearDown(self):
+        self.handler.logout()
+        self.stub.stop()
+
+    def test_same_subtitle_for_two_videos(self):
+        first, second = make_videos(2)
+        best = self.handler.search_subtitles(first)['eng'][0]
+        saved = self.handler.download_subtitles([(first, best),
+                                                 (second, best)])
+        # Both copies are listed, not just the last one
+        self.assertEqual(
+            saved, {(first.full_path, best.download_id):
+                    os.path.splitext(first.full_path)[0] + '.en.srt',
+                    (second.full_path, best.download_id):
+                    os.path.splitext(second.full_path)[0] + '.en.srt'})
+        for sub_filename in saved.values():
+            self.assertTrue(os.path.getsize(sub_filename) > 0)
+        self.assertEqual(self.handler.download_subtitle(first, best),
+                         saved[first.full_path, best.download_id])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,19 @@
+import unittest
+from tests import make_video
+from subtle.osapi import OSHandler
+from subtle.prefetch import Prefetcher
+
+
+class PrefetcherTest(unittest.TestCase):
+
+    def test_skips_without_session(self):
+        handler = OSHandler('http://127.0.0.1:9/xml-rpc')
+        prefetcher = Prefetcher(handler, result_cache=None)
+        # Would fail on the missing result cache if it went any further
+        prefetcher._prefetch([make_video('Movie.mkv')])
+        # The check didn't count as activity
+        self.assertFalse(handler.keep_alive)
+
+
+if __name__ == '__main__':
+    unittest.main()
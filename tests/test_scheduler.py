@@ -0,0 +1,82 @@
+import asyncio
+import threading
+import unittest
+from tests import TEST_DIR  # noqa: F401
+from subtle.scheduler import AsyncRequestScheduler, RequestScheduler
+
+
+class Pool(object):
+
+    def call(self, method, *args):
+        return {'status': '200 OK'}
+
+
+class RecordingStore(object):
+    """Stands in for a RateLimitStore, and records how it's called"""
+
+    def __init__(self, scheduler=None):
+        self.scheduler = scheduler
+        self.threads = []
+        self.blocked = []
+
+    def _record(self):
+        self.threads.append(threading.get_ident())
+        if self.scheduler is not None:
+            # Whether another thread has to wait for the condition
+            thread = threading.Thread(target=self._try_condition)
+            thread.start()
+            thread.join()
+
+    def _try_condition(self):
+        acquired = self.scheduler._condition.acquire(timeout=1)
+        if acquired:
+            self.scheduler._condition.release()
+        self.blocked.append(not acquired)
+
+    def take(self, name, rate, per, count=1):
+        self._record()
+        return 0
+
+    def empty(self, name, rate, per):
+        self._record()
+
+
+class RequestSchedulerTest(unittest.TestCase):
+
+    def test_store_is_used_without_the_condition(self):
+        scheduler = RequestScheduler(Pool())
+        scheduler.store = RecordingStore(scheduler)
+        self.assertEqual(scheduler.ServerInfo(), {'status': '200 OK'})
+        scheduler._pause()
+        self.assertEqual(scheduler.store.blocked, [False, False])
+
+    def test_local_bucket(self):
+        scheduler = RequestScheduler(Pool(), rate=2, per=10)
+        self.assertEqual(scheduler._take(), 0)
+        self.assertEqual(scheduler._take(), 0)
+        self.assertAlmostEqual(scheduler._take(), 5, delta=0.1)
+
+
+class AsyncRequestSchedulerTest(unittest.TestCase):
+
+    def test_store_is_used_off_the_event_loop(self):
+        async def send(method, *args):
+            return {'status': '200 OK'}
+
+        async def call():
+            await scheduler.call('ServerInfo')
+            await scheduler._pause()
+
+        scheduler = AsyncRequestScheduler(send)
+        scheduler.store = RecordingStore()
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(call())
+        finally:
+            loop.close()
+        self.assertEqual(len(scheduler.store.threads), 2)
+        self.assertNotIn(threading.get_ident(), scheduler.store.threads)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+from flask import session
+from tests import TEST_DIR, make_video
+from benchmarks.stub_server import StubServer
+from subtle import os_handler
+from subtle.transport import ServerPool
+from web import app
+from web.state import UserState
+from web.views import state_store
+
+
+class ResultPageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubServer(results=30, languages=('eng',)).start()
+        self.pool = os_handler.scheduler.pool
+        os_handler.scheduler.pool = ServerPool(self.stub.url)
+        self.client = app.test_client()
+        with self.client.session_transaction() as client_session:
+            client_session['id'] = 'results-test'
+        self.select(make_video('Movie.mkv'))
+
+    def tearDown(self):
+        os_handler.logout()
+        os_handler.scheduler.pool = self.pool
+        self.stub.stop()
+
+    def select(self, path):
+        state = UserState(TEST_DIR)
+        state.video_path = path
+        with app.test_request_context():
+            session['id'] = 'results-test'
+            state_store.save(state)
+
+    def get(self, etag=None, **args):
+        headers = {'If-None-Match': etag} if etag is not None else {}
+        return self.client.get('/subtle/api/results', query_string=args,
+                               headers=headers)
+
+    def test_page(self):
+        response = self.get(lang='eng', per_page=10, page=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        page = response.get_json()
+        self.assertEqual(list(page['languages']), ['eng'])
+        self.assertEqual(page['languages']['eng']['total'], 30)
+        self.assertEqual(page['languages']['eng']['pages'], 3)
+        self.assertEqual(len(page['languages']['eng']['results']), 10)
+        self.assertEqual(self.get(lang='dut').get_json()['languages'], {})
+
+    def test_not_modified(self):
+        response = self.get(per_page=10)
+        etag = response.headers['ETag']
+        self.assertIsNotNone(response.headers.get('Last-Modified'))
+        self.assertEqual(self.stub.calls.get('SearchSubtitles'), 1)
+        response = self.get(etag, per_page=10)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+        # The results were only searched for once
+        self.assertEqual(self.stub.calls.get('SearchSubtitles'), 1)
+
+    def test_changed_arguments(self):
+        etag = self.get(per_page=10).headers['ETag']
+        response = self.get(etag, per_page=10, page=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def test_other_video(self):
+        etag = self.get().headers['ETag']
+        self.select(make_video('Other.mkv', 300 * 1024))
+        response = self.get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,4 @@
 from flask import Flask
-from web.types import Navigator
 import logging as log
 import os
 
@@ -14,5 +13,4 @@ logger = log.getLogger()
 root_location = os.path.abspath(os.sep)
 app = Flask(__name__, static_url_path='/subtle')
 app.config.from_object('flaskconf')
-navigator = Navigator()
 from web import views
@@ -0,0 +1,72 @@
+import pickle
+import time
+import uuid
+from flask import session
+from subtle.cache import SQLiteStore
+from web.types import Navigator
+
+
+class UserState(object):
+    """
+    Everything Subtle remembers about a single user: the folder they're
+    browsing, the video they selected and the subtitles found for it
+    """
+
+    video_path = None
+    query = None
+
+    def __init__(self, root):
+        self.navigator = Navigator()
+        self.navigator.root = root
+
+
+class SessionStore(SQLiteStore):
+    """
+    Keeps the state of every user in SQLite, so each request can be handled
+    by any of the web server's worker processes
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            updated REAL NOT NULL,
+            state BLOB NOT NULL);
+        CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated);
+    '''
+
+    def __init__(self, path, root, max_age=7 * 86400):
+        super().__init__(path)
+        self.root = root
+        self.max_age = max_age
+
+    @staticmethod
+    def session_id():
+        # Identifies the user with a random ID in their session cookie
+        if 'id' not in session:
+            session['id'] = uuid.uuid4().hex
+        return session['id']
+
+    def load(self):
+        # Returns the user's state, and the pickled state to compare with
+        # when saving it
+        row = self.execute('SELECT state FROM sessions WHERE id = ?',
+                           (self.session_id(),))
+        if row:
+            try:
+                return pickle.loads(row[0][0]), row[0][0]
+            except (pickle.UnpicklingError, AttributeError, TypeError,
+                    EOFError):
+                # Saved by an older version of Subtle, so start over
+                pass
+        return UserState(self.root), None
+
+    def save(self, state, original=None):
+        blob = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+        if blob == original:
+            return
+        self.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                     (self.session_id(), time.time(), blob))
+
+    def prune(self):
+        self.execute('DELETE FROM sessions WHERE updated < ?',
+                     (time.time() - self.max_age,))
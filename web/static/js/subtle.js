@@ -9,4 +9,55 @@ jQuery(document).ready(function($) {
         });
         window.location = $(this).data("url");                        
     });
+
+    // Results beyond the first page are loaded from the API on request
+    function resultRow(lang, sub, images) {
+        var flags = $("<td>").addClass("vert-aligned center-text");
+        flags.append($("<img>").attr({height: 20, src: sub.is_HD ? images.data("hd") : images.data("nhd")})
+            .attr("title", sub.is_HD ? "Subtitle for high definition video" : null));
+        flags.append(" ");
+        flags.append($("<img>").attr({height: 20, src: sub.is_HI ? images.data("hi") : images.data("nhi")})
+            .attr("title", sub.is_HI ? "Subtitle for hearing impaired" : null));
+        var download = $("<input>").attr({
+            type: "image", src: images.data("download"), width: 30, alt: "Download",
+            title: "Download this subtitle", style: "cursor: pointer"
+        }).hover(function() {
+            this.src = images.data("download-r");
+        }, function() {
+            this.src = images.data("download");
+        });
+        var form = $("<form>").attr({action: "/subtle/download/" + lang + "/" + sub.download_id, method: "post"})
+            .append(download);
+        return $("<tr>").append(
+            flags,
+            $("<td>").addClass("vert-aligned").text(sub.file_name),
+            $("<td>").addClass("vert-aligned center-text").text(sub.download_count),
+            $("<td>").addClass("vert-aligned center-text").text(sub.rating),
+            $("<td>").addClass("vert-aligned center-text").text(sub.fps),
+            $("<td>").addClass("vert-aligned center-text").append(form));
+    }
+
+    $(".load-more").click(function() {
+        var button = $(this);
+        var body = $("tbody.results[data-lang='" + button.data("lang") + "']");
+        var images = $("#result_images");
+        var page = body.data("page") + 1;
+        button.prop("disabled", true);
+        $.getJSON(body.data("url") + "&page=" + page, function(data) {
+            var lang = body.data("lang");
+            var found = data.languages[lang];
+            $.each(found ? found.results : [], function(index, sub) {
+                body.append(resultRow(lang, sub, images));
+            });
+            body.data("page", page);
+            var left = found ? found.total - page * data.per_page : 0;
+            if (left > 0) {
+                button.text("Show more results (" + left + " left)").prop("disabled", false);
+            } else {
+                button.remove();
+            }
+        }).fail(function() {
+            button.prop("disabled", false);
+        });
+    });
 });
\ No newline at end of file
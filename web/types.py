@@ -4,6 +4,8 @@ import os
 class SubtitleQuery(object):
     Results = None
     Video = None
+    # When the results were found, for the Last-Modified header
+    updated = 0
 
     def __init__(self, video):
         self.Video = video
@@ -12,8 +14,16 @@ class SubtitleQuery(object):
 class Navigator(object):
     __path = None
     __root = None
-    dirs = None
-    files = None
+    # DirectoryListing of the current path
+    listing = None
+
+    @property
+    def dirs(self):
+        return self.listing.dirs if self.listing else []
+
+    @property
+    def files(self):
+        return self.listing.files if self.listing else []
 
     @property
     def path(self):
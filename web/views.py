@@ -1,16 +1,90 @@
-from flask import render_template, url_for, redirect, request, flash
+from flask import render_template, url_for, redirect, request, flash, g, \
+    get_flashed_messages, jsonify, stream_with_context, Response
 from web import app
+from subtle.components import TimedEvent
 from subtle.types import Video
-from subtle import os_handler, root_location
+from subtle.listing import ListingCache
+from subtle.metrics import metrics, request_count, request_duration, \
+    result_cache_lookups
+from subtle import library, os_handler, prefetcher, profiler, \
+    result_cache, root_location, settings
+from subtle.profiling import phase, server_timing
+from web.state import SessionStore
 from web.types import SubtitleQuery
-from web import navigator
 from xmlrpc.client import ProtocolError
 from http.client import ResponseNotReady
+import hashlib
+import hmac
 import os
+import time
 
-current_query = None
-current_video_path = None
-navigator.root = root_location
+state_store = SessionStore(settings.get("state_store", "state.db"),
+                           root_location)
+# Forget the state of users who haven't been back for a while
+TimedEvent(3600, state_store.prune)
+listing_cache = ListingCache()
+page_size = int(settings.get("page_size", 200))
+results_page_size = int(settings.get("results_page_size", 50))
+max_results_page_size = 500
+stream_results = settings.get("stream_results", "no").lower() == 'yes'
+
+
+# Endpoints that don't need the user's state
+stateless_endpoints = ('static', 'get_metrics')
+profile_key = settings.get("profile_key", "")
+
+
+# Profiling hooks go first, so they measure the other hooks as well. They're
+# only added when profiling is set up, to keep requests fast otherwise
+if profiler is not None:
+    @app.before_request
+    def start_profile():
+        flag = request.args.get('profile', '')
+        if settings.get("profile", "no").lower() == 'yes' or \
+                (profile_key and hmac.compare_digest(flag, profile_key)):
+            g.profiling = True
+            g.profile = profiler.start()
+
+    def end_profile():
+        g.profiling = False
+        return profiler.stop(g.profile, request.endpoint or 'unknown')
+
+    @app.after_request
+    def stop_profile(response):
+        if g.get('profiling'):
+            response.headers['Server-Timing'] = server_timing(end_profile())
+        return response
+
+    @app.teardown_request
+    def discard_profile(error=None):
+        # after_request is skipped when a view raises, but the profiler
+        # still has to be turned off
+        if g.get('profiling'):
+            end_profile()
+
+
+@app.before_request
+def load_state():
+    g.started = time.perf_counter()
+    if request.endpoint not in stateless_endpoints:
+        g.state, g.original_state = state_store.load()
+
+
+@app.after_request
+def save_state(response):
+    if 'state' in g:
+        state_store.save(g.state, g.original_state)
+    if 'started' in g:
+        endpoint = request.endpoint or 'unknown'
+        request_duration.observe(time.perf_counter() - g.started, endpoint)
+        request_count.inc(endpoint, str(response.status_code))
+    return response
+
+
+@app.route('/subtle/metrics')
+def get_metrics():
+    return Response(metrics.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
 
 
 @app.route('/')
@@ -26,80 +100,255 @@ def home():
     return render_template("index.html",
                            title='Welcome to Subtle',
                            greeting=greeting,
-                           no_results=current_query is None)
+                           no_results=g.state.query is None)
+
+
+def find_results():
+    # Looks up the subtitles of the selected video if that hasn't been done
+    # yet, saying what it's doing before every slow step
+    if g.state.query is not None:
+        return
+    yield "Logging in to OpenSubtitles..."
+    os_handler.login()
+    yield "Reading the video..."
+    current_query = SubtitleQuery(Video(g.state.video_path))
+    cached = result_cache.get(current_query.Video, os_handler.language)
+    result_cache_lookups.inc('miss' if cached is None else 'hit')
+    if cached is not None:
+        cached.apply(current_query.Video)
+        current_query.Results = cached.results
+    else:
+        yield "Looking up the video..."
+        os_handler.get_video_info(current_query.Video)
+        yield "Searching for subtitles..."
+        current_query.Results = os_handler.search_subtitles(
+            current_query.Video)
+        if current_query.Results is None:
+            # Try again on the next request rather than remember nothing
+            raise TimeoutError("Could not search for subtitles")
+        result_cache.put(current_query.Video, os_handler.language,
+                         current_query.Results)
+    current_query.updated = int(time.time())
+    g.state.query = current_query
+
+
+def load_query():
+    # Returns the query of the selected video, with its subtitles
+    for step in find_results():
+        pass
+    return g.state.query
+
+
+def sort_args():
+    sort_by = request.args.get('sort_by', default="download_count", type=str)
+    desc = True \
+        if request.args.get('desc', default="True", type=str) == "True" \
+        else False
+    return sort_by, desc
+
+
+def flag_arg(name):
+    # True or False for 'yes' or 'no', or None to not filter on the flag
+    value = request.args.get(name, default='', type=str).lower()
+    return {'yes': True, 'no': False}.get(value)
+
+
+def result_sections(current_query, sort_by, desc):
+    # The table of each language on the results page. Only the first page
+    # of results is rendered, the rest is loaded from the API when asked for
+    video_title = current_query.Video.title
+    video_title = video_title[:15] + '...' \
+        if len(video_title) > 15 else video_title
+    for lang, subs in (current_query.Results or {}).items():
+        yield {'lang': lang, 'language': subs[0].language,
+               'video_title': video_title, 'total': len(subs),
+               'results': subs.ordered(sort_by, desc)[:results_page_size]}
+
+
+def stream_result(sort_by, desc):
+    # Sends the page right away, then its progress while the results are
+    # looked up, and then the table of each language
+    def sections():
+        error = None
+        try:
+            for step in find_results():
+                yield {'step': step}
+            # The response was sent before the results were found, so the
+            # state has to be saved here
+            state_store.save(g.state, g.original_state)
+        except (ProtocolError, ResponseNotReady):
+            error = "OpenSubtitles is currently over capacity. " \
+                    "Try again later."
+        except OSError:
+            error = "Could not connect to OpenSubtitles. Try again later."
+        except ValueError:
+            error = "Could not log in to OpenSubtitles. Please check " \
+                    "your credentials in config.json."
+        yield {'done': True}
+        if error is not None:
+            yield {'error': error}
+            return
+        for section in result_sections(g.state.query, sort_by, desc):
+            yield section
+
+    # Take the flashed messages out of the session now, as it's saved
+    # before the page is rendered
+    get_flashed_messages(with_categories=True)
+    context = dict(title='Results', sort_by=sort_by, is_desc=desc,
+                   order="Ascending" if not desc else "Descending",
+                   sections=sections(), page_size=results_page_size,
+                   streaming=True, no_results=False)
+    app.update_template_context(context)
+    template = app.jinja_env.get_template("results.html")
+    response = Response(stream_with_context(template.stream(context)))
+    # Keep proxies like nginx from holding on to the page until it's done
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @app.route('/subtle/results')
 def get_result():
     try:
-        sort_by = request.args.get('sort_by', default="download_count",
-                                   type=str)
-        desc = True \
-            if request.args.get('desc', default="True", type=str) == "True" \
-            else False
-        global current_query
-
-        if current_video_path is None:
+        sort_by, desc = sort_args()
+        if g.state.video_path is None:
             flash("Please select a video file first!", 'info')
             return redirect(url_for('browse'))
-        elif current_query is None:
-            current_query = SubtitleQuery(Video(current_video_path))
-            os_handler.get_video_info(current_query.Video)
-            current_query.Results = os_handler.search_subtitles(
-                current_query.Video)
-
-        for lang in current_query.Results:
-            current_query.Results[lang].sort(
-                key=lambda x: getattr(x, sort_by), reverse=desc)
-        
-        video_title = current_query.Video.title
-        video_title = video_title[:15] + '...' \
-            if len(video_title) > 15 else video_title
-
-        return render_template("results.html",
-                               title='Results',
-                               video_title=video_title,
-                               video=current_query.Video,
-                               sort_by=sort_by,
-                               is_desc=desc,
-                               order="Ascending" if not desc else "Descending",
-                               results=current_query.Results,
-                               no_results=current_query is None)
+        if stream_results and g.state.query is None:
+            return stream_result(sort_by, desc)
+        current_query = load_query()
+
+        with phase('sort'):
+            sections = list(result_sections(current_query, sort_by, desc))
+
+        with phase('render'):
+            return render_template(
+                "results.html",
+                title='Results',
+                video=current_query.Video,
+                sort_by=sort_by,
+                is_desc=desc,
+                order="Ascending" if not desc else "Descending",
+                sections=sections,
+                page_size=results_page_size,
+                no_results=current_query is None)
     except (ProtocolError, ResponseNotReady):
         flash("OpenSubtitles is currently over capacity. Try again later.",
               'error')
         return redirect(url_for('browse'))
+    except OSError:
+        flash("Could not connect to OpenSubtitles. Try again later.",
+              'error')
+        return redirect(url_for('browse'))
+    except ValueError:
+        flash("Could not log in to OpenSubtitles. Please check your "
+              "credentials in config.json.", 'error')
+        return redirect(url_for('browse'))
+
+
+def api_error(message, status):
+    response = jsonify(error=message)
+    response.status_code = status
+    return response
+
+
+@app.route('/subtle/api/results')
+def get_result_page():
+    """
+    One page of the results of the selected video as JSON, for every
+    language or only 'lang'. The results can be filtered with 'hi' and
+    'hd' (yes or no), 'fps' and 'min_rating', and sorted with 'sort_by'
+    and 'desc' like on the results page
+    """
+    try:
+        sort_by, desc = sort_args()
+        page = max(1, request.args.get('page', default=1, type=int))
+        per_page = min(max_results_page_size, max(1, request.args.get(
+            'per_page', default=results_page_size, type=int)))
+        lang = request.args.get('lang', type=str)
+        if g.state.video_path is None:
+            return api_error("Please select a video file first!", 404)
+        current_query = load_query()
+    except (ProtocolError, ResponseNotReady):
+        return api_error("OpenSubtitles is currently over capacity. "
+                         "Try again later.", 503)
+    except OSError:
+        return api_error("Could not connect to OpenSubtitles. "
+                         "Try again later.", 502)
+    except ValueError:
+        return api_error("Could not log in to OpenSubtitles. Please check "
+                         "your credentials in config.json.", 502)
+
+    # The results don't change until another video is selected, so the
+    # page is the same as long as the video, its results and the
+    # arguments are
+    video = current_query.Video
+    etag = hashlib.sha1(repr((
+        video.file_hash, video.file_size, current_query.updated,
+        sorted(request.args.items(multi=True)))).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        languages = dict()
+        with phase('sort'):
+            for code, subs in (current_query.Results or {}).items():
+                if lang is not None and code != lang:
+                    continue
+                matches = subs.filtered(
+                    sort_by, desc, is_HI=flag_arg('hi'),
+                    is_HD=flag_arg('hd'),
+                    fps=request.args.get('fps', type=float),
+                    min_rating=request.args.get('min_rating', type=float))
+                languages[code] = {
+                    'language': subs[0].language,
+                    'total': len(matches),
+                    'pages': (len(matches) + per_page - 1) // per_page,
+                    'results': [sub.to_dict() for sub in matches[
+                        (page - 1) * per_page:page * per_page]]}
+        response = jsonify(
+            video={'title': video.title, 'year': video.year,
+                   'imdb_id': video.imdb_id},
+            sort_by=sort_by, desc=desc, page=page, per_page=per_page,
+            languages=languages)
+    response.set_etag(etag)
+    response.last_modified = current_query.updated
+    # Results are kept per user, so caches have to ask every time
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
 
 
 @app.route('/subtle/browse')
 def browse():
+    navigator = g.state.navigator
     try:
-        os_handler.login()
-        path = request.args.get('dir', default=-2, type=int)
-        if path is -2:
-            path = navigator.root
-        elif path is -1:
+        path = request.args.get('dir', type=int)
+        if path is None:
+            # Stay in the current directory when only changing pages
+            path = navigator.path if 'page' in request.args \
+                else navigator.root
+        elif path == -1:
             path = navigator.parent
         else:
             path = navigator.dirs[int(path)]
         navigator.path = os.path.join(navigator.path, path)
-        navigator.dirs = sorted([d for d in os.listdir(navigator.path)
-                                if os.path.isdir(
-                                    os.path.join(navigator.path, d)) and
-                                not d.startswith('.')])
-        supported_extensions = ('.mkv', '.avi', '.mp4')
-        navigator.files = sorted([f for f in os.listdir(navigator.path)
-                                 if os.path.isfile(
-                                     os.path.join(navigator.path, f)) and
-                                 f.endswith(supported_extensions)])
+        navigator.listing = listing_cache.get(navigator.path,
+                                              navigator.listing)
+        directories, files, page, pages = navigator.listing.page(
+            request.args.get('page', default=1, type=int), page_size)
+        if prefetcher is not None:
+            prefetcher.enqueue(os.path.join(navigator.path, file)
+                               for index, file in files)
 
         return render_template("browse.html",
                                title='Select a video',
-                               directories=navigator.dirs,
-                               files=navigator.files,
+                               directories=directories,
+                               files=files,
+                               page=page,
+                               pages=pages,
                                path=navigator.path,
-                               no_results=current_query is None,
-                               not_root=(path != navigator.root))
+                               no_results=g.state.query is None,
+                               not_root=(os.path.abspath(navigator.path) !=
+                                         os.path.abspath(navigator.root)))
     except IndexError:
         flash("Something went wrong, please try again", 'error')
         return redirect(url_for('browse'))
@@ -109,20 +358,47 @@ def browse():
         return redirect(url_for('browse'))
 
 
+@app.route('/subtle/missing')
+def get_missing():
+    if library is None:
+        flash("The library index is disabled in config.json.", 'info')
+        return redirect(url_for('browse'))
+    if library.is_empty:
+        library.update_in_background(root_location)
+    languages = os_handler.known_languages()
+    lang = request.args.get('lang', type=str)
+    selected = [lang] if lang in languages else languages
+    total, missing_count = library.count_missing(selected)
+    pages = max(1, -(-missing_count // page_size))
+    page = min(max(1, request.args.get('page', default=1, type=int)), pages)
+    videos = [(os.path.relpath(path, root_location), file_hash, existing)
+              for path, file_hash, existing in library.missing(
+                  selected, page_size, (page - 1) * page_size)]
+    return render_template("missing.html",
+                           title='Missing subtitles',
+                           languages=languages,
+                           lang=lang if lang in languages else None,
+                           videos=videos,
+                           total=total,
+                           missing=missing_count,
+                           page=page,
+                           pages=pages,
+                           updating=library.updating,
+                           no_results=g.state.query is None)
+
+
 @app.route('/subtle/select')
 def select():
     try:
-        os_handler.login()
         file_id = request.args.get('file', type=int)
-        global current_video_path
+        navigator = g.state.navigator
         new_video_path = os.path.join(navigator.path, navigator.files[file_id])
         if os.path.isfile(new_video_path):
-            current_video_path = new_video_path
-            global current_query
-            current_query = None
+            g.state.video_path = new_video_path
+            g.state.query = None
             return redirect(url_for('get_result'))
         else:
-            current_video_path = None
+            g.state.video_path = None
             flash("Error: could not open the selected file. Please try again.",
                   'error')
             return redirect(url_for('browse'))
@@ -136,7 +412,7 @@ def select():
 def download_subtitle(lang, download_id):
     try:
         os_handler.login()
-        global current_query
+        current_query = g.state.query
         if current_query is not None:
             sub = next(
                     s for s in current_query.Results[lang] if
@@ -153,4 +429,12 @@ def download_subtitle(lang, download_id):
     except PermissionError:
         flash("Could not save sub to folder. Do I have the right permissions?",
               'error')
-        return redirect(url_for('get_result'))
\ No newline at end of file
+        return redirect(url_for('get_result'))
+    except OSError:
+        flash("Could not connect to OpenSubtitles. Try again later.",
+              'error')
+        return redirect(url_for('get_result'))
+    except ValueError:
+        flash("Could not log in to OpenSubtitles. Please check your "
+              "credentials in config.json.", 'error')
+        return redirect(url_for('get_result'))